@@ -1,13 +1,62 @@
 """
-Business: Создает новую сделку (заявку) в AmoCRM
-Args: event с body (name, phone, amount - опционально)
-Returns: JSON с ID созданной сделки
+Business: Ставит новую сделку (заявку) в очередь на создание в AmoCRM
+Args: event с body (name, phone, amount - опционально),
+      заголовок Idempotency-Key (или idempotency_key в body) - опционально
+Returns: JSON с локальным ID заявки в очереди
 """
 
 import json
 import os
-import requests
-from typing import Dict, Any
+import hashlib
+import psycopg2
+from typing import Dict, Any, Optional
+
+import phones
+
+IDEMPOTENCY_TTL_HOURS = 24
+
+def get_idempotency_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> str:
+    '''Ключ идемпотентности из заголовка Idempotency-Key или поля idempotency_key в теле'''
+    request_headers = event.get('headers') or {}
+    for header_name, header_value in request_headers.items():
+        if header_name.lower() in ('idempotency-key', 'x-idempotency-key') and header_value:
+            return str(header_value).strip()[:255]
+    return str(body_data.get('idempotency_key') or '').strip()[:255]
+
+def get_request_hash(body_data: Dict[str, Any]) -> str:
+    payload = {k: v for k, v in body_data.items() if k != 'idempotency_key'}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def claim_idempotency_key(cur, endpoint: str, key: str, request_hash: str) -> Optional[tuple]:
+    '''Регистрирует ключ (просроченный перезаписывает). None - запрос новый, иначе сохранённая запись'''
+    cur.execute(
+        """INSERT INTO t_p14771149_mfo_client_cabinet.idempotency_keys 
+           (endpoint, idempotency_key, request_hash, expires_at) 
+           VALUES (%s, %s, %s, NOW() + make_interval(hours => %s)) 
+           ON CONFLICT (endpoint, idempotency_key) DO UPDATE 
+           SET request_hash = EXCLUDED.request_hash, response_status = NULL, response_body = NULL, 
+               created_at = NOW(), expires_at = EXCLUDED.expires_at 
+           WHERE idempotency_keys.expires_at <= NOW() 
+           RETURNING idempotency_key""",
+        (endpoint, key, request_hash, IDEMPOTENCY_TTL_HOURS)
+    )
+    if cur.fetchone():
+        return None
+    cur.execute(
+        """SELECT request_hash, response_status, response_body 
+           FROM t_p14771149_mfo_client_cabinet.idempotency_keys 
+           WHERE endpoint = %s AND idempotency_key = %s""",
+        (endpoint, key)
+    )
+    return cur.fetchone()
+
+def save_idempotent_response(cur, endpoint: str, key: str, status_code: int, response_body: str) -> None:
+    cur.execute(
+        """UPDATE t_p14771149_mfo_client_cabinet.idempotency_keys 
+           SET response_status = %s, response_body = %s 
+           WHERE endpoint = %s AND idempotency_key = %s""",
+        (status_code, response_body, endpoint, key)
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -18,7 +67,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Allow-Headers': 'Content-Type, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -43,6 +92,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     name = body.get('name', '')
     phone = body.get('phone', '')
     amount = body.get('amount', 0)
+    idempotency_key = get_idempotency_key(event, body)
     
     if not name or not phone:
         return {
@@ -51,98 +101,93 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Параметры name и phone обязательны'})
         }
     
-    subdomain = os.environ.get('AMOCRM_SUBDOMAIN', '').replace('.amocrm.ru', '')
-    access_token = os.environ.get('AMOCRM_ACCESS_TOKEN')
+    if not phones.is_valid(phone):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Некорректный номер телефона'})
+        }
     
-    if not subdomain or not access_token:
+    try:
+        amount = int(amount)
+    except (TypeError, ValueError):
         return {
-            'statusCode': 500,
+            'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Не настроены секреты AmoCRM'})
+            'body': json.dumps({'error': 'Параметр amount должен быть целым числом'})
         }
     
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'База данных не настроена'})
+        }
     
     try:
-        # Поиск или создание контакта
-        search_url = f'https://{subdomain}.amocrm.ru/api/v4/contacts'
-        search_response = requests.get(
-            search_url,
-            headers=headers,
-            params={'query': phone},
-            timeout=10
-        )
-        
-        if search_response.status_code == 401:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Токен недействителен'})
-            }
+        # Контакт и сделку создаст lead-outbox-drain при отправке пачки в AmoCRM
+        conn = psycopg2.connect(database_url)
+        cur = conn.cursor()
         
-        contact_id = None
-        if search_response.status_code == 200:
-            contacts = search_response.json().get('_embedded', {}).get('contacts', [])
-            if contacts:
-                contact_id = contacts[0]['id']
-        
-        # Создание контакта если не найден
-        if not contact_id:
-            contact_data = {
-                'name': name,
-                'custom_fields_values': [
-                    {
-                        'field_code': 'PHONE',
-                        'values': [{'value': phone, 'enum_code': 'WORK'}]
+        # Повтор с тем же ключом получает исходный ответ без новой заявки
+        if idempotency_key:
+            request_hash = get_request_hash(body)
+            stored = claim_idempotency_key(cur, 'amocrm-create-deal', idempotency_key, request_hash)
+            if stored:
+                conn.rollback()
+                cur.close()
+                conn.close()
+                stored_hash, stored_status, stored_body = stored
+                if stored_hash != request_hash:
+                    return {
+                        'statusCode': 422,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Ключ идемпотентности уже использован с другими параметрами'})
                     }
-                ]
-            }
-            
-            create_contact_response = requests.post(
-                search_url,
-                headers=headers,
-                json=[contact_data],
-                timeout=10
-            )
-            create_contact_response.raise_for_status()
-            contact_id = create_contact_response.json()['_embedded']['contacts'][0]['id']
-        
-        # Создание сделки
-        lead_data = {
-            'name': f'Заявка от {name}',
-            'price': int(amount),
-            '_embedded': {
-                'contacts': [{'id': contact_id}]
-            }
-        }
+                if stored_status is None:
+                    return {
+                        'statusCode': 409,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Заявка с этим ключом ещё обрабатывается'})
+                    }
+                return {
+                    'statusCode': stored_status,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Idempotent-Replayed': 'true'},
+                    'body': stored_body
+                }
         
-        leads_url = f'https://{subdomain}.amocrm.ru/api/v4/leads'
-        lead_response = requests.post(
-            leads_url,
-            headers=headers,
-            json=[lead_data],
-            timeout=10
+        cur.execute(
+            """INSERT INTO t_p14771149_mfo_client_cabinet.lead_outbox 
+               (source, phone, contact_name, lead_name, price) 
+               VALUES (%s, %s, %s, %s, %s) 
+               RETURNING id""",
+            ('amocrm-create-deal', phones.to_e164(phone), name, f'Заявка от {name}', amount)
         )
-        lead_response.raise_for_status()
-        lead_id = lead_response.json()['_embedded']['leads'][0]['id']
+        outbox_id = cur.fetchone()[0]
+        
+        response_body = json.dumps({
+            'success': True,
+            'lead_id': outbox_id,
+            'queued': True,
+            'message': 'Заявка успешно создана'
+        })
+        if idempotency_key:
+            save_idempotent_response(cur, 'amocrm-create-deal', idempotency_key, 200, response_body)
+        
+        conn.commit()
+        cur.close()
+        conn.close()
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'lead_id': lead_id,
-                'contact_id': contact_id,
-                'message': 'Заявка успешно создана'
-            })
+            'body': response_body
         }
         
-    except requests.exceptions.RequestException as e:
+    except psycopg2.Error as e:
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка API AmoCRM: {str(e)}'})
+            'body': json.dumps({'error': f'Ошибка сохранения заявки: {str(e)}'})
         }
\ No newline at end of file
@@ -4,12 +4,22 @@ Args: event с queryStringParameters (phone - номер телефона в ф
 Returns: JSON с данными клиента и его сделками
 """
 
+import asyncio
 import json
 import os
-import requests
+import httpx
 from typing import Dict, Any, List, Optional
+import aio
+import phone_filter
+import amocrm_metadata
+import amocrm_stream
+import retry_policy
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return aio.run(handler_async(event, context))
+
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''Та же функция для асинхронного рантайма: пока ждём AmoCRM, процесс обслуживает другие запросы'''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -44,19 +54,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Не настроены секреты AmoCRM'})
         }
     
+    # Номера, которых точно нет в зеркале amocrm_clients, отсекаем без запроса в AmoCRM
+    if not await asyncio.to_thread(phone_filter.might_exist, phone, os.environ.get('DATABASE_URL')):
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Клиент не найден'})
+        }
+    
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
     
+    deadline_at = retry_policy.deadline(context)
+    
     try:
         # Поиск контакта по телефону
         search_url = f'https://{subdomain}.amocrm.ru/api/v4/contacts'
-        search_response = requests.get(
-            search_url,
+        search_response = await aio.request(
+            'amocrm', 'GET', search_url, deadline_at,
             headers=headers,
-            params={'query': phone},
-            timeout=10
+            params={'query': phone}
         )
         
         if search_response.status_code == 401:
@@ -67,9 +86,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         search_response.raise_for_status()
-        contacts_data = search_response.json()
+        # Ничего не найдено - AmoCRM отвечает 204 без тела
+        contacts_data = search_response.json() if search_response.status_code != 204 else {}
         
         if not contacts_data.get('_embedded', {}).get('contacts'):
+            if phone_filter.PRECHECK_ENABLED:
+                phone_filter.record_false_positive()
+                print(f'[AMOCRM-GET-DEALS] Ложное срабатывание фильтра: {phone_filter.stats()}')
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -81,26 +104,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         # Получение сделок контакта
         leads_url = f'https://{subdomain}.amocrm.ru/api/v4/leads'
-        leads_response = requests.get(
-            leads_url,
+        leads_response = await aio.request(
+            'amocrm', 'GET', leads_url, deadline_at,
+            stream=True,
             headers=headers,
-            params={'filter[contacts][0]': contact_id, 'with': 'contacts'},
-            timeout=10
+            params={'filter[contacts][0]': contact_id, 'with': 'contacts'}
         )
-        leads_response.raise_for_status()
-        leads_data = leads_response.json()
+        try:
+            leads_response.raise_for_status()
+            # Из страницы сделок читаем только нужные поля, не собирая весь ответ в память
+            leads = await amocrm_stream.astream_embedded(leads_response, 'leads', amocrm_stream.project_lead)
+        finally:
+            await leads_response.aclose()
         
         deals = []
-        for lead in leads_data.get('_embedded', {}).get('leads', []):
+        for lead in leads:
             deals.append({
-                'id': str(lead['id']),
-                'name': lead.get('name', 'Без названия'),
-                'price': lead.get('price', 0),
-                'status_id': lead.get('status_id'),
-                'created_at': lead.get('created_at'),
-                'updated_at': lead.get('updated_at')
+                'id': str(lead.id),
+                'name': lead.name or 'Без названия',
+                'price': lead.price,
+                'status_id': lead.status_id,
+                'pipeline_id': lead.pipeline_id,
+                'created_at': lead.created_at,
+                'updated_at': lead.updated_at
             })
         
+        # Названия статусов и воронок - из кеша справочников, без лишних запросов в AmoCRM
+        await asyncio.to_thread(
+            amocrm_metadata.enrich, deals, os.environ.get('DATABASE_URL'), f'https://{subdomain}.amocrm.ru', access_token
+        )
+        
         # Формирование данных клиента
         custom_fields = contact.get('custom_fields_values', [])
         phone_field = next((f for f in custom_fields if f['field_code'] == 'PHONE'), None)
@@ -125,7 +158,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
         
-    except requests.exceptions.RequestException as e:
+    except retry_policy.UpstreamUnavailable as e:
+        # 429/5xx не прошли и после повторов - временно, клиенту стоит прийти позже, а не считать это ошибкой
+        print(f'[AMOCRM-GET-DEALS] AmoCRM недоступен: {e} {retry_policy.stats().get("amocrm")}')
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': e.retry_after
+            },
+            'body': json.dumps({'error': 'AmoCRM временно недоступен, повторите позже'})
+        }
+        
+    except ValueError as e:
+        # Оборванный или не-JSON ответ: EmbeddedParser.close() и response.json() бросают ValueError
+        print(f'[AMOCRM-GET-DEALS] Некорректный ответ AmoCRM: {e}')
+        return {
+            'statusCode': 502,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'AmoCRM вернул неполный ответ, повторите позже'})
+        }
+        
+    except httpx.HTTPError as e:
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
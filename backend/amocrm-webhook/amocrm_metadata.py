@@ -0,0 +1,139 @@
+'''
+Кеш воронок и статусов AmoCRM для обогащения сделок (status_name, status_color, pipeline_name).
+Источник - /api/v4/leads/pipelines; результат хранится в amocrm_metadata_cache на сутки и
+в памяти тёплого экземпляра на 5 минут (и в host_cache, если процессов на сервере несколько),
+так что обычный запрос не ходит в AmoCRM вовсе.
+Сбрасывается вебхуком (amocrm-webhook) или при встрече статуса, которого нет в кеше.
+'''
+
+import json
+import time
+from typing import Dict, Any, List, Optional, Tuple
+import psycopg2
+import requests
+import host_cache
+
+CACHE_KEY = 'leads_pipelines'
+HOST_CACHE_KEY = 'amocrm:metadata:' + CACHE_KEY
+DB_TTL_HOURS = 24
+MEMORY_TTL_SECONDS = 300
+# Неизвестный статус в сделке - повод перечитать воронки, но не чаще раза в 5 минут
+UNKNOWN_REFRESH_INTERVAL_SECONDS = 300
+
+_state: Dict[str, Any] = {'metadata': None, 'loaded_at': 0.0, 'forced_at': 0.0}
+
+
+def fetch_pipelines(base_url: str, access_token: str) -> Dict[str, Any]:
+    '''Сжимает ответ AmoCRM до словарей pipeline_id -> имя и "pipeline_id:status_id" -> имя/цвет'''
+    response = requests.get(
+        f'{base_url}/api/v4/leads/pipelines',
+        headers={'Authorization': f'Bearer {access_token}'},
+        timeout=10
+    )
+    response.raise_for_status()
+
+    pipelines: Dict[str, str] = {}
+    statuses: Dict[str, Dict[str, Any]] = {}
+    for pipeline in response.json().get('_embedded', {}).get('pipelines', []):
+        pipelines[str(pipeline['id'])] = pipeline.get('name')
+        for status in pipeline.get('_embedded', {}).get('statuses', []):
+            statuses[f"{pipeline['id']}:{status['id']}"] = {
+                'name': status.get('name'),
+                'color': status.get('color')
+            }
+    return {'pipelines': pipelines, 'statuses': statuses}
+
+
+def read_cached(conn) -> Tuple[Optional[Dict[str, Any]], bool]:
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT payload, expires_at > NOW() FROM t_p14771149_mfo_client_cabinet.amocrm_metadata_cache WHERE cache_key = %s",
+        (CACHE_KEY,)
+    )
+    row = cur.fetchone()
+    cur.close()
+    return (row[0], row[1]) if row else (None, False)
+
+
+def _store(conn, metadata: Dict[str, Any]) -> None:
+    cur = conn.cursor()
+    cur.execute(
+        f"""INSERT INTO t_p14771149_mfo_client_cabinet.amocrm_metadata_cache (cache_key, payload, fetched_at, expires_at)
+           VALUES (%s, %s, NOW(), NOW() + INTERVAL '{DB_TTL_HOURS} hours')
+           ON CONFLICT (cache_key) DO UPDATE SET
+               payload = EXCLUDED.payload, fetched_at = EXCLUDED.fetched_at, expires_at = EXCLUDED.expires_at""",
+        (CACHE_KEY, json.dumps(metadata, ensure_ascii=False))
+    )
+    conn.commit()
+    cur.close()
+
+
+def load(database_url: Optional[str], base_url: str, access_token: str, force: bool = False) -> Optional[Dict[str, Any]]:
+    '''Память -> Postgres -> AmoCRM. При ошибке AmoCRM отдаёт устаревшую копию, если она есть'''
+    now = time.monotonic()
+    if not force and _state['metadata'] is not None and now - _state['loaded_at'] < MEMORY_TTL_SECONDS:
+        return _state['metadata']
+    if not force:
+        shared = host_cache.get(HOST_CACHE_KEY)
+        if shared is not None:
+            _state.update({'metadata': shared, 'loaded_at': now})
+            return shared
+
+    conn = None
+    try:
+        metadata, fresh = None, False
+        if database_url:
+            conn = psycopg2.connect(database_url)
+            metadata, fresh = read_cached(conn)
+        if force or not fresh:
+            try:
+                metadata = fetch_pipelines(base_url, access_token)
+                if conn is not None:
+                    _store(conn, metadata)
+            except requests.exceptions.RequestException as e:
+                print(f'[AMOCRM-METADATA] Не удалось загрузить воронки: {e}')
+                metadata = metadata or _state['metadata']
+    except psycopg2.Error as e:
+        print(f'[AMOCRM-METADATA] Кеш в БД недоступен: {e}')
+        metadata = _state['metadata']
+    finally:
+        if conn is not None:
+            conn.close()
+
+    if metadata is not None:
+        _state.update({'metadata': metadata, 'loaded_at': now})
+        host_cache.put(HOST_CACHE_KEY, metadata, MEMORY_TTL_SECONDS)
+    return metadata
+
+
+def is_known(metadata: Optional[Dict[str, Any]], pipeline_id: Any, status_id: Any) -> bool:
+    return bool(metadata) and f'{pipeline_id}:{status_id}' in metadata['statuses']
+
+
+def enrich(deals: List[Dict[str, Any]], database_url: Optional[str], base_url: str, access_token: str) -> List[Dict[str, Any]]:
+    '''Дописывает в сделки status_name, status_color и pipeline_name по кешу, без запросов в AmoCRM'''
+    metadata = load(database_url, base_url, access_token)
+    unknown = any(not is_known(metadata, deal.get('pipeline_id'), deal.get('status_id')) for deal in deals)
+    if unknown and time.monotonic() - _state['forced_at'] > UNKNOWN_REFRESH_INTERVAL_SECONDS:
+        _state['forced_at'] = time.monotonic()
+        metadata = load(database_url, base_url, access_token, force=True)
+
+    for deal in deals:
+        status = (metadata or {}).get('statuses', {}).get(f"{deal.get('pipeline_id')}:{deal.get('status_id')}") or {}
+        deal['status_name'] = status.get('name')
+        deal['status_color'] = status.get('color')
+        deal['pipeline_name'] = (metadata or {}).get('pipelines', {}).get(str(deal.get('pipeline_id')))
+    return deals
+
+
+def invalidate(conn) -> None:
+    '''Помечает кеш устаревшим для всех экземпляров; следующий запрос перечитает воронки'''
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE t_p14771149_mfo_client_cabinet.amocrm_metadata_cache SET expires_at = NOW() WHERE cache_key = %s",
+        (CACHE_KEY,)
+    )
+    conn.commit()
+    cur.close()
+    _state.update({'metadata': None, 'loaded_at': 0.0})
+    host_cache.delete(HOST_CACHE_KEY)
@@ -0,0 +1,186 @@
+'''
+Business: Приём вебхуков AmoCRM о сделках (leads.add/update/status): фиксирует смену статуса
+          в webhook_notifications и deal_status_history (срезы воронки), сбрасывает кеш воронок,
+          если пришёл неизвестный статус
+Args: event - dict с httpMethod, body (form-urlencoded leads[status][0][id]=... или JSON)
+             и queryStringParameters.token - секрет AMOCRM_WEBHOOK_SECRET из адреса вебхука
+      context - объект с request_id, function_name
+Returns: HTTP response с количеством принятых событий
+'''
+
+import hmac
+import json
+import os
+import re
+import urllib.parse
+import base64
+from typing import Dict, Any, List, Tuple
+import psycopg2
+from psycopg2.extras import execute_values
+import amocrm_metadata
+
+LEAD_EVENTS = ('add', 'update', 'status')
+FORM_KEY = re.compile(r'^leads\[(\w+)\]\[(\d+)\]\[(\w+)\]$')
+
+# Время в прошлом статусе берётся из предыдущей записи истории по сделке; смены одной сделки
+# внутри пачки связываются заранее (entered_old_at), их LATERAL ещё не увидит
+HISTORY_SQL = """
+    INSERT INTO t_p14771149_mfo_client_cabinet.deal_status_history
+        (lead_id, pipeline_id, old_status_id, new_status_id, changed_at, entered_old_at)
+    SELECT v.lead_id, v.pipeline_id, v.old_status_id, v.new_status_id, v.changed_at,
+           COALESCE(v.entered_old_at, prev.changed_at)
+    FROM (VALUES %s) AS v(lead_id, pipeline_id, old_status_id, new_status_id, changed_at, entered_old_at)
+    LEFT JOIN LATERAL (
+        SELECT h.changed_at FROM t_p14771149_mfo_client_cabinet.deal_status_history h
+        WHERE h.lead_id = v.lead_id AND h.new_status_id = v.old_status_id AND h.changed_at <= v.changed_at
+        ORDER BY h.changed_at DESC
+        LIMIT 1
+    ) prev ON v.entered_old_at IS NULL
+    ORDER BY v.changed_at
+    ON CONFLICT ON CONSTRAINT unique_deal_status_change DO NOTHING"""
+HISTORY_TEMPLATE = (
+    '(%s::bigint, %s::bigint, %s::bigint, %s::bigint, '
+    'COALESCE(to_timestamp(%s)::timestamp, LOCALTIMESTAMP), to_timestamp(%s)::timestamp)'
+)
+
+
+def parse_lead_events(event: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    '''AmoCRM шлёт form-urlencoded с ключами вида leads[status][0][status_id]; JSON тоже принимаем'''
+    raw = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        raw = base64.b64decode(raw).decode('utf-8')
+
+    if raw.lstrip().startswith('{'):
+        leads = json.loads(raw).get('leads', {})
+        return {name: list(leads.get(name, [])) for name in LEAD_EVENTS}
+
+    grouped: Dict[str, Dict[int, Dict[str, Any]]] = {name: {} for name in LEAD_EVENTS}
+    for key, value in urllib.parse.parse_qsl(raw):
+        match = FORM_KEY.match(key)
+        if match and match.group(1) in grouped:
+            grouped[match.group(1)].setdefault(int(match.group(2)), {})[match.group(3)] = value
+    return {name: [items[index] for index in sorted(items)] for name, items in grouped.items()}
+
+
+def history_rows(status_leads: List[Dict[str, Any]]) -> List[Tuple]:
+    '''Строки для deal_status_history; время смены - last_modified/updated_at из вебхука (unix)'''
+    changes = []
+    for lead in status_leads:
+        if not lead.get('id') or not lead.get('status_id'):
+            continue
+        changed_at = lead.get('last_modified') or lead.get('updated_at')
+        changes.append((
+            int(lead['id']),
+            int(lead['pipeline_id']) if lead.get('pipeline_id') else None,
+            int(lead['old_status_id']) if lead.get('old_status_id') else None,
+            int(lead['status_id']),
+            int(changed_at) if changed_at else None
+        ))
+
+    rows = []
+    previous: Dict[int, Tuple] = {}
+    for change in sorted(changes, key=lambda c: (c[0], c[4] or 0)):
+        lead_id, _, old_status_id, _, changed_at = change
+        before = previous.get(lead_id)
+        entered_old_at = before[4] if before and before[3] == old_status_id and changed_at else None
+        rows.append(change + (entered_old_at,))
+        previous[lead_id] = change
+    return rows
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # AmoCRM не подписывает вебхуки, поэтому секрет передаётся в адресе (?token=...). Без него
+    # любой мог бы записать смену статуса и сбросить кеш воронок; не настроен секрет - функция закрыта
+    webhook_secret = os.environ.get('AMOCRM_WEBHOOK_SECRET', '')
+    request_token = (event.get('queryStringParameters') or {}).get('token') or ''
+    if not webhook_secret or not hmac.compare_digest(request_token, webhook_secret):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        events = parse_lead_events(event)
+        leads = [lead for name in LEAD_EVENTS for lead in events[name] if lead.get('id')]
+        status_changes = [
+            (int(lead['id']), int(lead['status_id']), int(lead['old_status_id']) if lead.get('old_status_id') else None)
+            for lead in events['status'] if lead.get('id') and lead.get('status_id')
+        ]
+        history = history_rows(events['status'])
+    except (ValueError, AttributeError) as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Invalid webhook payload: {e}'}),
+            'isBase64Encoded': False
+        }
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        if status_changes:
+            execute_values(
+                cur,
+                """INSERT INTO t_p14771149_mfo_client_cabinet.webhook_notifications
+                   (lead_id, new_status_id, old_status_id) VALUES %s""",
+                status_changes
+            )
+        if history:
+            execute_values(cur, HISTORY_SQL, history, template=HISTORY_TEMPLATE, page_size=len(history))
+        conn.commit()
+        cur.close()
+
+        # Статус, которого нет в кеше воронок, - воронку поменяли в AmoCRM: сбрасываем кеш для всех
+        metadata, _ = amocrm_metadata.read_cached(conn)
+        unknown = [
+            lead for lead in leads
+            if lead.get('status_id') and not amocrm_metadata.is_known(metadata, lead.get('pipeline_id'), lead.get('status_id'))
+        ]
+        if unknown and metadata is not None:
+            amocrm_metadata.invalidate(conn)
+            print(f'[AMOCRM-WEBHOOK] Кеш воронок сброшен: неизвестный статус у сделки {unknown[0].get("id")}')
+    finally:
+        conn.close()
+
+    print(f'[AMOCRM-WEBHOOK] leads={len(leads)} status_changes={len(status_changes)}')
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': True, 'leads': len(leads), 'status_changes': len(status_changes)}),
+        'isBase64Encoded': False
+    }
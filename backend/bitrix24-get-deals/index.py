@@ -6,11 +6,57 @@ Returns: HTTP response с данными сделок клиента
 
 import json
 import os
-import urllib.request
 import urllib.parse
 from typing import Dict, Any, List
+import aio
+import phones
+import retry_policy
+
+DEAL_SELECT = ['ID', 'TITLE', 'STAGE_ID', 'OPPORTUNITY', 'DATE_CREATE', 'DATE_MODIFY']
+CONTACT_SELECT = ['ID', 'NAME', 'LAST_NAME']
+# Битрикс24 отдаёт по 50 строк на страницу списка и принимает до 50 команд в batch
+BITRIX_PAGE_SIZE = 50
+BATCH_MAX_COMMANDS = 50
+# Ссылка на первый найденный контакт внутри того же batch-запроса
+CONTACT_REF = '$result[find][CONTACT][0]'
+
+async def call_batch(webhook_url: str, commands: Dict[str, str], deadline_at: float) -> Dict[str, Any]:
+    '''Выполняет несколько методов за один HTTP-запрос через batch; в batch только чтение, его можно повторять'''
+    response = await aio.request(
+        'bitrix24', 'POST', f"{webhook_url}/batch.json", deadline_at, json={'halt': 0, 'cmd': commands}
+    )
+    response.raise_for_status()
+    batch_data = response.json()
+    if 'error' in batch_data:
+        raise RuntimeError(batch_data.get('error_description') or batch_data['error'])
+    return batch_data.get('result', {})
+
+def select_params(fields: List[str]) -> str:
+    return urllib.parse.urlencode([('select[]', field) for field in fields])
+
+def deal_list_command(contact_id: Any, start: int) -> str:
+    '''crm.deal.list по контакту с проекцией полей; contact_id может быть ссылкой $result[...]'''
+    return f"crm.deal.list?filter[CONTACT_ID]={contact_id}&order[ID]=ASC&start={start}&{select_params(DEAL_SELECT)}"
+
+async def fetch_remaining_deals(webhook_url: str, contact_id: Any, start: int, total: int, deadline_at: float) -> List[Dict[str, Any]]:
+    '''Догружает страницы сделок после первой: все известные смещения уходят batch-запросами по 50 команд'''
+    offsets = list(range(start, total, BITRIX_PAGE_SIZE))
+    deals: List[Dict[str, Any]] = []
+    for chunk_start in range(0, len(offsets), BATCH_MAX_COMMANDS):
+        chunk = offsets[chunk_start:chunk_start + BATCH_MAX_COMMANDS]
+        batch_result = await call_batch(webhook_url, {
+            f'deals_{offset}': deal_list_command(contact_id, offset) for offset in chunk
+        }, deadline_at)
+        pages = batch_result.get('result') or {}
+        for offset in chunk:
+            deals.extend(pages.get(f'deals_{offset}') or [])
+    return deals
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return aio.run(handler_async(event, context))
+
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''Та же функция для асинхронного рантайма: пока ждём Битрикс24, процесс обслуживает другие запросы'''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -53,21 +99,27 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Phone parameter required'})
         }
     
+    deadline_at = retry_policy.deadline(context)
+    
     try:
-        clean_phone = phone.replace('+', '').replace('-', '').replace('(', '').replace(')', '').replace(' ', '')
+        clean_phone = phones.normalize(phone)
         
-        # Ищем контакт через crm.duplicate.findbycomm
-        search_params = urllib.parse.urlencode({
-            'PHONE': clean_phone,
-            'TYPE': 'PHONE'
+        # Поиск контакта, его имя и первая страница сделок - одним batch-запросом
+        find_params = urllib.parse.urlencode({
+            'entity_type': 'CONTACT',
+            'type': 'PHONE',
+            'values[]': clean_phone
         })
-        duplicate_url = f"{webhook_url}/crm.duplicate.findbycomm?{search_params}"
-        
-        dup_req = urllib.request.Request(duplicate_url)
-        with urllib.request.urlopen(dup_req, timeout=10) as response:
-            duplicate_data = json.loads(response.read().decode())
+        batch_result = await call_batch(webhook_url, {
+            'find': f"crm.duplicate.findbycomm?{find_params}",
+            'contact': f"crm.contact.list?filter[ID]={CONTACT_REF}&{select_params(CONTACT_SELECT)}",
+            'deals': deal_list_command(CONTACT_REF, 0)
+        }, deadline_at)
+        results = batch_result.get('result') or {}
         
-        contact_entities = duplicate_data.get('result', {}).get('CONTACT', [])
+        # Если дублей нет, Битрикс24 возвращает пустой список вместо объекта
+        duplicate_data = results.get('find') or {}
+        contact_entities = duplicate_data.get('CONTACT', []) if isinstance(duplicate_data, dict) else []
         
         if not contact_entities:
             return {
@@ -79,35 +131,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         contact_id = contact_entities[0]
         
-        # Получаем полные данные контакта
-        contact_get_url = f"{webhook_url}/crm.contact.get?id={contact_id}"
-        contact_get_req = urllib.request.Request(contact_get_url)
-        
-        with urllib.request.urlopen(contact_get_req, timeout=10) as contact_response:
-            contact_result = json.loads(contact_response.read().decode())
-        
-        contact = contact_result.get('result', {})
+        contact_rows = results.get('contact') or []
+        contact = contact_rows[0] if contact_rows else {}
         client_name = f"{contact.get('NAME', '')} {contact.get('LAST_NAME', '')}".strip()
         
-        # Получаем сделки контакта
-        deal_params = urllib.parse.urlencode({
-            'filter[CONTACT_ID]': contact_id,
-            'select[]': 'ID',
-            'select[]': 'TITLE',
-            'select[]': 'STAGE_ID',
-            'select[]': 'OPPORTUNITY',
-            'select[]': 'DATE_CREATE',
-            'select[]': 'DATE_MODIFY'
-        })
-        
-        deal_url = f"{webhook_url}/crm.deal.list?{deal_params}"
-        deal_req = urllib.request.Request(deal_url)
+        batch_errors = batch_result.get('result_error') or {}
+        if 'deals' in batch_errors:
+            raise RuntimeError(f"crm.deal.list: {batch_errors['deals']}")
         
-        with urllib.request.urlopen(deal_req, timeout=10) as response:
-            deal_result = json.loads(response.read().decode())
+        raw_deals = list(results.get('deals') or [])
+        if (batch_result.get('result_next') or {}).get('deals'):
+            total_deals = (batch_result.get('result_total') or {}).get('deals', len(raw_deals))
+            raw_deals.extend(await fetch_remaining_deals(webhook_url, contact_id, len(raw_deals), total_deals, deadline_at))
         
         deals = []
-        for deal in deal_result.get('result', []):
+        for deal in raw_deals:
             deals.append({
                 'id': int(deal['ID']),
                 'name': deal.get('TITLE', 'Без названия'),
@@ -133,6 +171,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             })
         }
         
+    except retry_policy.UpstreamUnavailable as e:
+        print(f'[BITRIX24-GET-DEALS] Битрикс24 недоступен: {e} {retry_policy.stats().get("bitrix24")}')
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': e.retry_after
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Bitrix24 temporarily unavailable, retry later'})
+        }
+        
     except Exception as e:
         return {
             'statusCode': 500,
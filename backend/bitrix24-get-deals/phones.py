@@ -0,0 +1,63 @@
+'''
+Нормализация российских номеров телефонов. Канонический вид - 11 цифр с ведущей 7
+(79991234567), для хранения в amocrm_clients/clients - он же с плюсом (+79991234567).
+Функции деплоятся независимо, поэтому файл лежит копией в каталоге каждой функции,
+работающей с телефонами; копии должны совпадать.
+'''
+
+import re
+from typing import Iterable, List
+
+_NON_DIGITS = re.compile(r'[^0-9]+')
+
+
+def _is_canonical(phone: str) -> bool:
+    # Быстрый путь для номеров, которые уже пришли в каноническом виде (из БД, из зеркала)
+    return len(phone) == 11 and phone[0] == '7' and phone.isdigit() and phone.isascii()
+
+
+def normalize(phone: str) -> str:
+    '''79991234567 из любых форм: +7 (999) 123-45-67, 8 999 123 45 67, 9991234567'''
+    phone = phone or ''
+    if _is_canonical(phone):
+        return phone
+    digits = _NON_DIGITS.sub('', phone)
+    if len(digits) == 11 and digits[0] == '8':
+        return '7' + digits[1:]
+    if len(digits) == 10:
+        return '7' + digits
+    return digits
+
+
+def to_e164(phone: str) -> str:
+    '''+79991234567 - формат, в котором телефоны лежат в БД'''
+    digits = normalize(phone)
+    return '+' + digits if digits else ''
+
+
+def is_valid(phone: str) -> bool:
+    digits = normalize(phone)
+    return len(digits) == 11 and digits[0] == '7'
+
+
+def normalize_many(phones: Iterable[str]) -> List[str]:
+    '''Нормализует и убирает дубли за один проход, сохраняя порядок первых вхождений.
+    Рассчитано на сотни тысяч номеров при синхронизации зеркала и массовых импортах.'''
+    sub = _NON_DIGITS.sub
+    seen = {}
+    for phone in phones:
+        if not phone:
+            continue
+        if _is_canonical(phone):
+            seen[phone] = None
+            continue
+        digits = sub('', phone)
+        size = len(digits)
+        if size == 11 and digits[0] == '8':
+            digits = '7' + digits[1:]
+        elif size == 10:
+            digits = '7' + digits
+        elif not size:
+            continue
+        seen[digits] = None
+    return list(seen)
@@ -1,6 +1,7 @@
 import json
 import os
 import psycopg2
+import phones
 from typing import Dict, Any
 from datetime import datetime
 
@@ -51,13 +52,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    # Нормализуем телефон: убираем все кроме цифр, добавляем +
-    clean_phone = ''.join(filter(str.isdigit, phone))
-    if clean_phone.startswith('8'):
-        clean_phone = '7' + clean_phone[1:]
-    if not clean_phone.startswith('7'):
-        clean_phone = '7' + clean_phone
-    normalized_phone = '+' + clean_phone
+    # Нормализуем телефон к виду +79991234567
+    normalized_phone = phones.to_e164(phone)
     
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
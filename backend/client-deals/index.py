@@ -1,12 +1,49 @@
 import json
 import os
-import psycopg2
+import phones
+from db import RequestDB
 from typing import Dict, Any
 
+def summary_response(db: RequestDB, normalized_phone: str) -> Dict[str, Any]:
+    '''Единая заявка клиента из client_deal_summary (ведётся триггерами на amocrm_deals)'''
+    row = db.fetch_one(
+        """SELECT s.deal_ids, s.deals_count, s.total_price, s.latest_status, s.latest_status_id,
+                  s.latest_status_name, s.latest_status_color, s.latest_pipeline_id, s.latest_pipeline_name,
+                  s.first_created_at, s.last_updated_at
+           FROM t_p14771149_mfo_client_cabinet.amocrm_clients c
+           JOIN t_p14771149_mfo_client_cabinet.client_deal_summary s ON s.client_id = c.id
+           WHERE c.phone = %s""",
+        (normalized_phone,)
+    )
+    
+    deals = []
+    if row:
+        deals.append({
+            'id': ','.join(row[0]),
+            'name': f'Заявки клиента ({row[1]} шт.)',
+            'price': float(row[2]),
+            'status': row[3],
+            'status_id': row[4],
+            'status_name': row[5],
+            'status_color': row[6],
+            'pipeline_id': row[7],
+            'pipeline_name': row[8],
+            'created_at': row[9].isoformat() if row[9] else None,
+            'updated_at': row[10].isoformat() if row[10] else None,
+            'count': row[1]
+        })
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'deals': deals}),
+        'isBase64Encoded': False
+    }
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Get client deals by phone number
-    Args: event - dict with httpMethod, queryStringParameters (phone)
+    Args: event - dict with httpMethod, queryStringParameters (phone, view=summary - one unified deal)
     Returns: HTTP response with deals list
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -43,13 +80,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    # Нормализуем телефон: убираем все кроме цифр, добавляем +
-    clean_phone = ''.join(filter(str.isdigit, phone))
-    if clean_phone.startswith('8'):
-        clean_phone = '7' + clean_phone[1:]
-    if not clean_phone.startswith('7'):
-        clean_phone = '7' + clean_phone
-    normalized_phone = '+' + clean_phone
+    # Нормализуем телефон к виду +79991234567
+    normalized_phone = phones.to_e164(phone)
     
     print(f"DEBUG: Original phone: {phone}, Normalized: {normalized_phone}")
     
@@ -62,41 +94,47 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(database_url)
-    cur = conn.cursor()
-    
-    # Находим client_id по номеру телефона
-    cur.execute(
-        f"SELECT id FROM t_p14771149_mfo_client_cabinet.amocrm_clients WHERE phone = '{normalized_phone}'"
-    )
-    client_row = cur.fetchone()
-    
-    if not client_row:
-        # Клиент не найден - возвращаем пустой список
-        print(f"DEBUG: Client not found for phone {normalized_phone}")
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'deals': []}),
-            'isBase64Encoded': False
-        }
-    
-    client_id = client_row[0]
-    print(f"DEBUG: Found client_id {client_id} for phone {normalized_phone}")
-    
-    # Получаем все сделки клиента
-    cur.execute(
-        f"""SELECT id, name, price, status, status_id, status_name, status_color, 
-                  pipeline_id, pipeline_name, created_at, updated_at, custom_fields 
-           FROM t_p14771149_mfo_client_cabinet.amocrm_deals 
-           WHERE client_id = {client_id} 
-           ORDER BY created_at DESC"""
-    )
+    # Только чтение - запросы идут на реплику, если она настроена
+    db = RequestDB(database_url)
+    try:
+        if params.get('view') == 'summary':
+            return summary_response(db, normalized_phone)
+        
+        # Находим client_id по номеру телефона
+        client_row = db.fetch_one(
+            "SELECT id FROM t_p14771149_mfo_client_cabinet.amocrm_clients WHERE phone = %s",
+            (normalized_phone,)
+        )
+        
+        if not client_row:
+            # Клиент не найден - возвращаем пустой список
+            print(f"DEBUG: Client not found for phone {normalized_phone}")
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'deals': []}),
+                'isBase64Encoded': False
+            }
+        
+        client_id = client_row[0]
+        print(f"DEBUG: Found client_id {client_id} for phone {normalized_phone}")
+        
+        # Получаем все сделки клиента
+        with db.cursor(readonly=True) as cur:
+            cur.execute(
+                """SELECT id, name, price, status, status_id, status_name, status_color, 
+                          pipeline_id, pipeline_name, created_at, updated_at, custom_fields 
+                   FROM t_p14771149_mfo_client_cabinet.amocrm_deals 
+                   WHERE client_id = %s 
+                   ORDER BY created_at DESC""",
+                (client_id,)
+            )
+            rows = cur.fetchall()
+    finally:
+        db.close()
     
     deals = []
-    for row in cur.fetchall():
+    for row in rows:
         deal = {
             'id': str(row[0]),
             'name': row[1],
@@ -115,9 +153,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     print(f"DEBUG: Returning {len(deals)} deals for client_id {client_id}")
     
-    cur.close()
-    conn.close()
-    
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
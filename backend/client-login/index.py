@@ -8,8 +8,8 @@ import json
 import os
 import hashlib
 from typing import Dict, Any
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import RequestDB
 
 def hash_password(password: str) -> str:
     '''Хеширует пароль с солью'''
@@ -52,22 +52,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     dsn = os.environ.get('DATABASE_URL')
     
     try:
-        conn = psycopg2.connect(dsn)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Ищем клиента
-        cur.execute(
-            """
-            SELECT id, phone, full_name, email, password_hash 
-            FROM t_p14771149_mfo_client_cabinet.clients 
-            WHERE phone = %s
-            """,
-            (phone,)
-        )
-        client = cur.fetchone()
-        
-        cur.close()
-        conn.close()
+        # Поиск клиента - только чтение, идёт на реплику, если она настроена
+        db = RequestDB(dsn)
+        try:
+            client = db.fetch_one(
+                """
+                SELECT id, phone, full_name, email, password_hash 
+                FROM t_p14771149_mfo_client_cabinet.clients 
+                WHERE phone = %s
+                """,
+                (phone,),
+                cursor_factory=RealDictCursor
+            )
+        finally:
+            db.close()
         
         if not client:
             return {
@@ -0,0 +1,173 @@
+'''
+Business: Портфель клиента для кабинета - кредитный лимит, активные займы и ближайшие платежи
+Args: event - dict с httpMethod, queryStringParameters (phone или client_id); client_id -
+             служебный поиск, только с заголовком X-Admin-Token
+      context - объект с request_id, function_name
+Returns: HTTP response с limits, loans и totals; заголовок X-Cache - HIT/MISS по проекции
+'''
+
+import hmac
+import json
+import os
+import psycopg2
+from typing import Dict, Any, Optional
+import phones
+
+# Один запрос по индексам clients(id|phone), unique_client_limit и idx_loans_client_active_next_payment.
+# generation читается в том же снимке, что и данные, - по нему проекция сохраняется без гонки со сбросом.
+PORTFOLIO_SQL = """
+    SELECT c.id,
+           COALESCE((SELECT generation FROM t_p14771149_mfo_client_cabinet.client_portfolio_cache
+                     WHERE client_id = c.id), 0),
+           json_build_object(
+               'client_id', c.id,
+               'limits', (
+                   SELECT json_build_object(
+                       'max_loan_amount', l.max_loan_amount,
+                       'current_debt', l.current_debt,
+                       'available_limit', l.available_limit,
+                       'credit_rating', l.credit_rating,
+                       'is_blocked', l.is_blocked,
+                       'blocked_reason', l.blocked_reason,
+                       'updated_at', l.updated_at
+                   )
+                   FROM t_p14771149_mfo_client_cabinet.client_limits l
+                   WHERE l.client_id = c.id
+               ),
+               'loans', COALESCE((
+                   SELECT json_agg(json_build_object(
+                       'id', ln.id,
+                       'amocrm_deal_id', ln.amocrm_deal_id,
+                       'amount', ln.amount,
+                       'paid_amount', ln.paid_amount,
+                       'outstanding', ln.amount - ln.paid_amount,
+                       'rate', ln.rate,
+                       'next_payment_date', ln.next_payment_date,
+                       'created_at', ln.created_at
+                   ) ORDER BY ln.next_payment_date NULLS LAST, ln.id)
+                   FROM t_p14771149_mfo_client_cabinet.loans ln
+                   WHERE ln.client_id = c.id AND ln.status = 'active'
+               ), '[]'::json),
+               'totals', (
+                   SELECT json_build_object(
+                       'active_loans', COUNT(*),
+                       'outstanding', COALESCE(SUM(ln.amount - ln.paid_amount), 0),
+                       'next_payment_date', MIN(ln.next_payment_date)
+                   )
+                   FROM t_p14771149_mfo_client_cabinet.loans ln
+                   WHERE ln.client_id = c.id AND ln.status = 'active'
+               )
+           )
+    FROM t_p14771149_mfo_client_cabinet.clients c
+    WHERE {condition}"""
+
+
+def response(status: int, payload: Dict[str, Any], cache_status: Optional[str] = None) -> Dict[str, Any]:
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if cache_status:
+        headers['X-Cache'] = cache_status
+    return {
+        'statusCode': status,
+        'headers': headers,
+        'body': json.dumps(payload, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def get_cached(cur, condition: str, value: Any) -> Optional[Dict[str, Any]]:
+    cur.execute(
+        f"""SELECT p.payload
+            FROM t_p14771149_mfo_client_cabinet.clients c
+            JOIN t_p14771149_mfo_client_cabinet.client_portfolio_cache p ON p.client_id = c.id
+            WHERE {condition} AND p.payload IS NOT NULL""",
+        (value,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def build_portfolio(conn, condition: str, value: Any) -> Optional[Dict[str, Any]]:
+    '''Считает портфель и сохраняет проекцию, если за время расчёта не было записей по клиенту'''
+    cur = conn.cursor()
+    cur.execute(PORTFOLIO_SQL.format(condition=condition), (value,))
+    row = cur.fetchone()
+    if not row:
+        cur.close()
+        return None
+
+    client_id, generation, portfolio = row
+    cur.execute(
+        """INSERT INTO t_p14771149_mfo_client_cabinet.client_portfolio_cache AS cache
+               (client_id, payload, generation, refreshed_at)
+           VALUES (%s, %s, %s, NOW())
+           ON CONFLICT (client_id) DO UPDATE SET payload = EXCLUDED.payload, refreshed_at = NOW()
+           WHERE cache.generation = EXCLUDED.generation""",
+        (client_id, json.dumps(portfolio), generation)
+    )
+    conn.commit()
+    cur.close()
+    return portfolio
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return response(405, {'error': 'Method not allowed'})
+
+    params = event.get('queryStringParameters') or {}
+    client_id = params.get('client_id', '').strip()
+    phone = params.get('phone', '').strip()
+
+    if client_id:
+        # id последовательные - перебором по ним можно выгрузить чужие портфели, поэтому
+        # поиск по id служебный; без настроенного ADMIN_API_TOKEN он закрыт
+        admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+        headers = event.get('headers') or {}
+        request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+        if not admin_token or not hmac.compare_digest(request_token, admin_token):
+            return response(403, {'error': 'Forbidden'})
+        if not client_id.isdigit():
+            return response(400, {'error': 'client_id должен быть числом'})
+        condition, value = 'c.id = %s', int(client_id)
+    elif phone:
+        # clients.phone хранится в E.164 (+79991234567), клиенты присылают любую запись номера
+        if not phones.is_valid(phone):
+            return response(400, {'error': 'Некорректный номер телефона'})
+        condition, value = 'c.phone = %s', phones.to_e164(phone)
+    else:
+        return response(400, {'error': 'client_id или phone обязателен'})
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return response(500, {'error': 'Database not configured'})
+
+    # Проекция лежит в UNLOGGED-таблице, которой нет на репликах, - работаем с основной БД
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        portfolio = get_cached(cur, condition, value)
+        cur.close()
+        if portfolio is not None:
+            return response(200, portfolio, 'HIT')
+
+        portfolio = build_portfolio(conn, condition, value)
+    finally:
+        conn.close()
+
+    if portfolio is None:
+        return response(404, {'error': 'Клиент не найден'})
+    return response(200, portfolio, 'MISS')
@@ -7,8 +7,8 @@ Returns: HTTP response с success и client данными
 import json
 import os
 from typing import Dict, Any
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import RequestDB
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
@@ -60,40 +60,38 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     full_name = f"{last_name} {first_name} {middle_name}".strip()
     
     try:
-        conn = psycopg2.connect(dsn)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(
-            "SELECT id FROM t_p14771149_mfo_client_cabinet.clients WHERE passport_series = %s AND passport_number = %s",
-            (passport_series, passport_number)
-        )
-        existing = cur.fetchone()
-        
-        if existing:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 409,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': False, 'error': 'Клиент с такими паспортными данными уже существует'})
-            }
-        
-        cur.execute(
-            """
-            INSERT INTO t_p14771149_mfo_client_cabinet.clients 
-            (phone, full_name, last_name, first_name, middle_name, birth_date, passport_series, passport_number, created_at, updated_at) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-            RETURNING id
-            """,
-            (phone, full_name, last_name, first_name, middle_name, birth_date, passport_series, passport_number)
-        )
-        
-        result = cur.fetchone()
-        client_id = result['id']
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        db = RequestDB(dsn)
+        try:
+            # Проверка дубля - только чтение, идёт на реплику, если она настроена и не отстаёт.
+            # Повтор на основной БД при промахе не нужен: проверка и вставка и так не атомарны
+            with db.cursor(readonly=True, cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT id FROM t_p14771149_mfo_client_cabinet.clients WHERE passport_series = %s AND passport_number = %s",
+                    (passport_series, passport_number)
+                )
+                existing = cur.fetchone()
+            
+            if existing:
+                return {
+                    'statusCode': 409,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': False, 'error': 'Клиент с такими паспортными данными уже существует'})
+                }
+            
+            with db.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    INSERT INTO t_p14771149_mfo_client_cabinet.clients 
+                    (phone, full_name, last_name, first_name, middle_name, birth_date, passport_series, passport_number, created_at, updated_at) 
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+                    RETURNING id
+                    """,
+                    (phone, full_name, last_name, first_name, middle_name, birth_date, passport_series, passport_number)
+                )
+                client_id = cur.fetchone()['id']
+            db.commit()
+        finally:
+            db.close()
         
         return {
             'statusCode': 201,
@@ -0,0 +1,323 @@
+'''
+Business: Массовый импорт и выгрузка клиентов (amocrm_clients, clients) через COPY
+Args: event - dict с httpMethod, queryStringParameters (table, format, after_id, limit),
+      body (CSV с заголовком или NDJSON) и заголовком X-Admin-Token
+      context - объект с request_id, function_name
+Returns: POST - статистика слияния, GET - выгрузка в CSV/NDJSON порцией по id
+
+Тело импорта платформа передаёт целиком, поэтому импорт ограничен MAX_IMPORT_BYTES (64 МБ
+после распаковки gzip) - большие файлы присылаются частями. Дальше записи разбираются и
+уходят в COPY потоком, без промежуточных копий всего файла.
+'''
+
+import base64
+import csv
+import gzip
+import hmac
+import io
+import json
+import os
+import time
+import psycopg2
+from typing import Dict, Any, List, Tuple, Iterable
+import phones
+
+SCHEMA = 't_p14771149_mfo_client_cabinet'
+EXPORT_PAGE_SIZE = 100000
+EXPORT_MAX_PAGE_SIZE = 500000
+MAX_IMPORT_BYTES = 64 * 1024 * 1024
+
+# Колонки, которые принимаются при импорте (phone обязателен) и отдаются при выгрузке
+TABLE_COLUMNS = {
+    'amocrm_clients': ['name', 'first_name', 'last_name', 'middle_name', 'email'],
+    'clients': ['full_name', 'first_name', 'last_name', 'middle_name', 'email']
+}
+
+# clients.phone уникален - сливаем через ON CONFLICT; у зеркала amocrm_clients такой гарантии нет,
+# поэтому сначала обновляем совпавшие по телефону строки, затем добавляем новые
+MERGE_SQL = {
+    'clients': f"""
+        WITH merged AS (
+            INSERT INTO {SCHEMA}.clients (phone, full_name, first_name, last_name, middle_name, email)
+            SELECT phone, full_name, first_name, last_name, middle_name, email FROM clients_import_stage
+            ON CONFLICT (phone) DO UPDATE SET
+                full_name = COALESCE(EXCLUDED.full_name, clients.full_name),
+                first_name = COALESCE(EXCLUDED.first_name, clients.first_name),
+                last_name = COALESCE(EXCLUDED.last_name, clients.last_name),
+                middle_name = COALESCE(EXCLUDED.middle_name, clients.middle_name),
+                email = COALESCE(EXCLUDED.email, clients.email),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE (clients.full_name, clients.first_name, clients.last_name, clients.middle_name, clients.email)
+                IS DISTINCT FROM (
+                    COALESCE(EXCLUDED.full_name, clients.full_name),
+                    COALESCE(EXCLUDED.first_name, clients.first_name),
+                    COALESCE(EXCLUDED.last_name, clients.last_name),
+                    COALESCE(EXCLUDED.middle_name, clients.middle_name),
+                    COALESCE(EXCLUDED.email, clients.email)
+                )
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged""",
+    'amocrm_clients': f"""
+        WITH updated AS (
+            UPDATE {SCHEMA}.amocrm_clients a SET
+                name = COALESCE(s.name, a.name),
+                first_name = COALESCE(s.first_name, a.first_name),
+                last_name = COALESCE(s.last_name, a.last_name),
+                middle_name = COALESCE(s.middle_name, a.middle_name),
+                email = COALESCE(s.email, a.email)
+            FROM clients_import_stage s
+            WHERE a.phone = s.phone
+              AND (a.name, a.first_name, a.last_name, a.middle_name, a.email) IS DISTINCT FROM (
+                  COALESCE(s.name, a.name),
+                  COALESCE(s.first_name, a.first_name),
+                  COALESCE(s.last_name, a.last_name),
+                  COALESCE(s.middle_name, a.middle_name),
+                  COALESCE(s.email, a.email)
+              )
+            RETURNING a.id
+        ), inserted AS (
+            INSERT INTO {SCHEMA}.amocrm_clients (phone, name, first_name, last_name, middle_name, email)
+            SELECT s.phone, s.name, s.first_name, s.last_name, s.middle_name, s.email
+            FROM clients_import_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM {SCHEMA}.amocrm_clients a WHERE a.phone = s.phone)
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM updated)"""
+}
+
+
+def response(status: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(payload, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def read_body(event: Dict[str, Any]) -> str:
+    raw = event.get('body') or ''
+    if not event.get('isBase64Encoded'):
+        if len(raw) > MAX_IMPORT_BYTES:
+            raise BodyTooLarge()
+        return raw
+    data = base64.b64decode(raw)
+    # Большие файлы удобнее присылать сжатыми: gzip распознаём по сигнатуре и распаковываем
+    # не больше лимита, чтобы маленький архив не развернулся в гигабайты
+    if data[:2] == b'\x1f\x8b':
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as archive:
+            data = archive.read(MAX_IMPORT_BYTES + 1)
+    if len(data) > MAX_IMPORT_BYTES:
+        raise BodyTooLarge()
+    return data.decode('utf-8-sig')
+
+
+def parse_records(text: str, fmt: str) -> Iterable[Dict[str, Any]]:
+    if fmt == 'ndjson':
+        for line_number, line in enumerate(io.StringIO(text), 1):
+            if line.strip():
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError(f'line {line_number}: expected a JSON object')
+                yield record
+    else:
+        yield from csv.DictReader(io.StringIO(text))
+
+
+def clean_value(value: Any) -> Any:
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def prepare_rows(records: Iterable[Dict[str, Any]], columns: List[str]) -> Tuple[Dict[str, List[Any]], Dict[str, int]]:
+    '''Нормализует телефоны и схлопывает дубли внутри файла (побеждает последняя строка)'''
+    rows: Dict[str, List[Any]] = {}
+    stats = {'received': 0, 'invalid_phone': 0, 'duplicates_in_input': 0}
+    for record in records:
+        stats['received'] += 1
+        raw_phone = str(record.get('phone') or '')
+        if not phones.is_valid(raw_phone):
+            stats['invalid_phone'] += 1
+            continue
+        phone = phones.to_e164(raw_phone)
+        if phone in rows:
+            stats['duplicates_in_input'] += 1
+        rows[phone] = [clean_value(record.get(column)) for column in columns]
+    return rows, stats
+
+
+class CsvRowsReader:
+    '''Файлоподобный источник для COPY FROM STDIN: строки CSV формируются по мере чтения'''
+
+    def __init__(self, rows: Dict[str, List[Any]]):
+        self._rows = iter(rows.items())
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ''
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._pending) < size:
+            item = next(self._rows, None)
+            if item is None:
+                break
+            phone, values = item
+            self._writer.writerow([phone] + values)
+            self._pending += self._buffer.getvalue()
+            self._buffer.seek(0)
+            self._buffer.truncate()
+        if size < 0:
+            chunk, self._pending = self._pending, ''
+        else:
+            chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def copy_into_stage(cur, rows: Dict[str, List[Any]], columns: List[str]) -> None:
+    cur.execute(f"""
+        CREATE TEMP TABLE clients_import_stage (
+            phone VARCHAR(20) PRIMARY KEY,
+            {', '.join(f'{column} VARCHAR(255)' for column in columns)}
+        ) ON COMMIT DROP
+    """)
+    cur.copy_expert(
+        f"COPY clients_import_stage (phone, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        CsvRowsReader(rows)
+    )
+    # У временной таблицы нет статистики - без ANALYZE планировщик ошибается на слиянии
+    cur.execute("ANALYZE clients_import_stage")
+
+
+def import_clients(conn, table: str, text: str, fmt: str) -> Dict[str, Any]:
+    columns = TABLE_COLUMNS[table]
+    rows, stats = prepare_rows(parse_records(text, fmt), columns)
+    stats.update({'inserted': 0, 'updated': 0, 'unchanged': 0})
+    if not rows:
+        return stats
+
+    cur = conn.cursor()
+    copy_into_stage(cur, rows, columns)
+    cur.execute(MERGE_SQL[table])
+    inserted, updated = cur.fetchone()
+    conn.commit()
+    cur.close()
+
+    stats.update({'inserted': inserted, 'updated': updated, 'unchanged': len(rows) - inserted - updated})
+    return stats
+
+
+def export_clients(conn, table: str, fmt: str, after_id: int, limit: int) -> Tuple[str, int]:
+    '''Выгружает порцию строк с id > after_id через COPY TO STDOUT.
+    Возвращает текст и id, с которого продолжать (0 - строк больше нет).
+    Оба запроса должны идти в одной транзакции REPEATABLE READ - см. handler'''
+    columns = ['id', 'phone'] + TABLE_COLUMNS[table]
+    select = f"SELECT {', '.join(columns)} FROM {SCHEMA}.{table} WHERE id > {int(after_id)} ORDER BY id LIMIT {int(limit)}"
+    if fmt == 'ndjson':
+        # row_to_json экранирует управляющие символы, поэтому CSV с разделителем и кавычкой,
+        # которых не бывает в JSON, отдаёт строки как есть - одна запись на строку
+        sql = f"COPY (SELECT row_to_json(t) FROM ({select}) t) TO STDOUT WITH (FORMAT csv, DELIMITER E'\\x02', QUOTE E'\\x01')"
+    else:
+        sql = f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+
+    buffer = io.StringIO()
+    cur = conn.cursor()
+    cur.copy_expert(sql, buffer)
+    # Полная порция - ищем по первичному ключу последний выгруженный id, неполная - выгрузка закончена
+    cur.execute(
+        f"SELECT id FROM {SCHEMA}.{table} WHERE id > %s ORDER BY id OFFSET %s LIMIT 1",
+        (int(after_id), int(limit) - 1)
+    )
+    row = cur.fetchone()
+    cur.close()
+    return buffer.getvalue(), row[0] if row else 0
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method not in ('GET', 'POST'):
+        return response(405, {'error': 'Method not allowed'})
+
+    # Выгрузка отдаёт персональные данные - без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return response(403, {'error': 'Forbidden'})
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return response(500, {'error': 'Database not configured'})
+
+    params = event.get('queryStringParameters') or {}
+    table = params.get('table', '')
+    fmt = params.get('format', 'csv')
+    if table not in TABLE_COLUMNS:
+        return response(400, {'error': f'table must be one of: {", ".join(TABLE_COLUMNS)}'})
+    if fmt not in ('csv', 'ndjson'):
+        return response(400, {'error': 'format must be csv or ndjson'})
+    try:
+        after_id = int(params.get('after_id', 0) or 0)
+        limit = max(1, min(int(params.get('limit', EXPORT_PAGE_SIZE) or EXPORT_PAGE_SIZE), EXPORT_MAX_PAGE_SIZE))
+    except ValueError as e:
+        return response(400, {'error': f'Invalid paging parameter: {e}'})
+
+    started = time.monotonic()
+    conn = psycopg2.connect(database_url)
+    try:
+        if method == 'POST':
+            try:
+                stats = import_clients(conn, table, read_body(event), fmt)
+            except BodyTooLarge:
+                return response(413, {'error': f'Body larger than {MAX_IMPORT_BYTES} bytes: split the import'})
+            except (ValueError, csv.Error, gzip.BadGzipFile, EOFError) as e:
+                conn.rollback()
+                return response(400, {'error': f'Invalid {fmt} body: {e}'})
+            except psycopg2.DataError as e:
+                # Значение не влезло в колонку (VARCHAR(255)) или не приводится к её типу
+                conn.rollback()
+                return response(400, {'error': f'Invalid value in {fmt} body: {e.pgerror or e}'})
+            stats['duration_ms'] = int((time.monotonic() - started) * 1000)
+            print(f"[CLIENTS-BULK] import table={table} {stats}")
+            return response(200, {'success': True, 'table': table, **stats})
+
+        # COPY и поиск следующего id должны видеть одни и те же строки: в READ COMMITTED
+        # у второго запроса свой снимок, и вставки/удаления между ними сдвигают OFFSET
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        body, last_id = export_clients(conn, table, fmt, after_id, limit)
+    finally:
+        conn.close()
+
+    print(f"[CLIENTS-BULK] export table={table} after_id={after_id} last_id={last_id} "
+          f"duration_ms={int((time.monotonic() - started) * 1000)}")
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Next-After-Id',
+            # Пустая строка - выгрузка закончена, иначе передать значение в after_id следующего запроса
+            'X-Next-After-Id': str(last_id) if last_id else ''
+        },
+        'body': base64.b64encode(gzip.compress(body.encode('utf-8'))).decode(),
+        'isBase64Encoded': True
+    }
@@ -0,0 +1,122 @@
+'''
+Потоковый разбор ответов AmoCRM API v4: элементы массива _embedded.<entity> декодируются
+по одному прямо из тела ответа и сразу сжимаются до нужных полей (namedtuple).
+Целиком страница (с with=contacts и custom_fields_values) в памяти не собирается.
+stream_embedded - для ответа requests, astream_embedded - для httpx.AsyncClient.
+'''
+
+import json
+import re
+from collections import namedtuple
+from typing import Any, Callable, Iterator, Iterable, List, Optional, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[\s,]*')
+
+Lead = namedtuple('Lead', ['id', 'name', 'price', 'status_id', 'pipeline_id', 'created_at', 'updated_at'])
+
+
+def project_lead(item: dict) -> Lead:
+    return Lead(
+        item.get('id'), item.get('name'), item.get('price') or 0, item.get('status_id'),
+        item.get('pipeline_id'), item.get('created_at'), item.get('updated_at')
+    )
+
+
+def _array_start(entity: str) -> 're.Pattern':
+    # Верхний _embedded идёт раньше вложенных (они внутри него), поэтому первое совпадение - нужный массив
+    return re.compile(r'"_embedded"\s*:\s*\{\s*"' + re.escape(entity) + r'"\s*:\s*\[')
+
+
+class EmbeddedParser:
+    '''Разбор _embedded.<entity> по кускам ответа: feed отдаёт элементы, которые уже пришли целиком'''
+
+    def __init__(self, entity: str, project: Callable[[dict], Any]) -> None:
+        self.entity = entity
+        self.project = project
+        self.done = False
+        self._start = _array_start(entity)
+        self._buffer = ''
+        self._position: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Any]:
+        if self.done:
+            return []
+        if self._position is None:
+            # Ищем начало массива; держим хвост буфера на случай, если маркер разрезан между кусками
+            self._buffer = self._buffer[-256:] + chunk
+            match = self._start.search(self._buffer)
+            if not match:
+                return []
+            self._position = match.end()
+        else:
+            self._buffer = self._buffer[self._position:] + chunk
+            self._position = 0
+        return self._drain(final=False)
+
+    def close(self) -> List[Any]:
+        '''Ответ закончился: массив должен быть закрыт (ответ без массива - пустой результат)'''
+        if self.done or self._position is None:
+            return []
+        items = self._drain(final=True)
+        if not self.done:
+            raise ValueError(f'Unexpected end of AmoCRM response inside _embedded.{self.entity}')
+        return items
+
+    def _drain(self, final: bool) -> List[Any]:
+        items = []
+        buffer, position = self._buffer, self._position
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position >= len(buffer):
+                break
+            if buffer[position] == ']':
+                self.done = True
+                break
+            try:
+                item, position = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Элемент ещё не пришёл целиком - ждём следующий кусок
+                if final:
+                    raise
+                break
+            items.append(self.project(item))
+        self._position = position
+        return items
+
+
+def iter_embedded(chunks: Iterable[str], entity: str, project: Callable[[dict], Any]) -> Iterator[Any]:
+    '''Отдаёт project(элемент) для каждого элемента _embedded.<entity> по мере чтения кусков ответа'''
+    parser = EmbeddedParser(entity, project)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    yield from parser.close()
+
+
+def stream_embedded(response, entity: str, project: Callable[[dict], Any]) -> Tuple[Any, ...]:
+    '''Разбирает ответ requests, открытый с stream=True. Пустой ответ (204) - пустой кортеж'''
+    if response.status_code == 204:
+        return ()
+    response.encoding = response.encoding or 'utf-8'
+    try:
+        return tuple(iter_embedded(response.iter_content(CHUNK_SIZE, decode_unicode=True), entity, project))
+    finally:
+        response.close()
+
+
+async def astream_embedded(response, entity: str, project: Callable[[dict], Any]) -> Tuple[Any, ...]:
+    '''То же для ответа httpx из AsyncClient.stream(): куски читаются по мере прихода, не блокируя цикл'''
+    if response.status_code == 204:
+        return ()
+    parser = EmbeddedParser(entity, project)
+    items: List[Any] = []
+    async for chunk in response.aiter_text(CHUNK_SIZE):
+        items.extend(parser.feed(chunk))
+        if parser.done:
+            break
+    items.extend(parser.close())
+    return tuple(items)
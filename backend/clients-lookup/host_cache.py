@@ -0,0 +1,193 @@
+'''
+Общий для процессов одного сервера кеш на диске (SQLite в режиме WAL). Нужен при собственном
+развёртывании, когда функции крутятся несколькими рабочими процессами на одной машине: ответ,
+полученный одним процессом (справочники AmoCRM, контакты, ответы MegaCRM), видят остальные.
+
+Включается переменной HOST_CACHE_PATH (например /dev/shm/mfo-host-cache.sqlite); без неё get
+всегда промах, а put ничего не делает - функции работают как раньше, только со своим кешем
+в памяти. Размер ограничен HOST_CACHE_MAX_BYTES: при переполнении сначала удаляются истёкшие
+записи, затем давно не читанные. Любая ошибка SQLite - промах, а не ошибка запроса.
+Функции деплоятся независимо, поэтому файл лежит копией в каталоге каждой функции; копии
+должны совпадать.
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+CACHE_PATH = os.environ.get('HOST_CACHE_PATH', '')
+MAX_BYTES = int(os.environ.get('HOST_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# После вытеснения занято не больше 90% лимита, чтобы не вытеснять на каждой записи
+EVICT_TO_RATIO = 0.9
+# accessed_at обновляется не чаще раза в 10 секунд на запись - чтение почти всегда без записи в БД
+TOUCH_INTERVAL_SECONDS = 10
+BUSY_TIMEOUT_MS = 2000
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0, 'errors': 0, 'read_seconds': 0.0}
+
+
+def enabled() -> bool:
+    return bool(CACHE_PATH)
+
+
+def _connect() -> sqlite3.Connection:
+    # Соединение на поток: sqlite3 не разрешает делить соединение между потоками без блокировок
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(CACHE_PATH, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS entries (
+               key TEXT PRIMARY KEY,
+               value BLOB NOT NULL,
+               size INTEGER NOT NULL,
+               expires_at REAL NOT NULL,
+               accessed_at REAL NOT NULL
+           )'''
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_accessed_at ON entries(accessed_at)')
+    conn.execute('CREATE TABLE IF NOT EXISTS usage (id INTEGER PRIMARY KEY CHECK (id = 1), total_bytes INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO usage (id, total_bytes) VALUES (1, 0)')
+    _local.conn = conn
+    return conn
+
+
+def _count(name: str, value: Any = 1) -> None:
+    with _stats_lock:
+        _stats[name] += value
+
+
+def _fail(operation: str, error: Exception) -> None:
+    _count('errors')
+    print(f'[HOST-CACHE] {operation} не выполнен: {error}')
+    # Соединение после ошибки (например, удалённый файл) не переиспользуем
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def get(key: str) -> Optional[Any]:
+    '''Значение по ключу или None, если записи нет, она истекла или кеш выключен'''
+    if not CACHE_PATH:
+        return None
+    started = time.perf_counter()
+    try:
+        conn = _connect()
+        now = time.time()
+        row = conn.execute('SELECT value, expires_at, accessed_at FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] <= now:
+            _count('misses')
+            return None
+        if now - row[2] > TOUCH_INTERVAL_SECONDS:
+            conn.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+        value = json.loads(row[0])
+        _count('hits')
+        return value
+    except (sqlite3.Error, ValueError) as e:
+        _fail('get', e)
+        return None
+    finally:
+        _count('read_seconds', time.perf_counter() - started)
+
+
+def put(key: str, value: Any, ttl_seconds: float) -> None:
+    '''Записывает значение атомарно для всех процессов: одна транзакция BEGIN IMMEDIATE'''
+    if not CACHE_PATH:
+        return
+    data = json.dumps(value, ensure_ascii=False, default=str).encode('utf-8')
+    size = len(data) + len(key)
+    if size > MAX_BYTES:
+        return
+    now = time.time()
+    try:
+        conn = _connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, data, size, now + ttl_seconds, now)
+            )
+            conn.execute('UPDATE usage SET total_bytes = total_bytes + ? WHERE id = 1', (size - (old[0] if old else 0),))
+            total = conn.execute('SELECT total_bytes FROM usage WHERE id = 1').fetchone()[0]
+            if total > MAX_BYTES:
+                _evict(conn, total, now, keep=key)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        _count('writes')
+    except sqlite3.Error as e:
+        _fail('put', e)
+
+
+def _evict(conn: sqlite3.Connection, total: int, now: float, keep: str) -> None:
+    '''Вызывается внутри транзакции put: истёкшие записи, затем самые давно читанные'''
+    target = int(MAX_BYTES * EVICT_TO_RATIO)
+    victims = []
+    freed = 0
+    for key, size in conn.execute('SELECT key, size FROM entries WHERE expires_at <= ?', (now,)):
+        victims.append((key,))
+        freed += size
+    if total - freed > target:
+        for key, size in conn.execute('SELECT key, size FROM entries WHERE expires_at > ? ORDER BY accessed_at', (now,)):
+            if key == keep:
+                continue
+            victims.append((key,))
+            freed += size
+            if total - freed <= target:
+                break
+    conn.executemany('DELETE FROM entries WHERE key = ?', victims)
+    conn.execute('UPDATE usage SET total_bytes = total_bytes - ? WHERE id = 1', (freed,))
+    _count('evicted', len(victims))
+
+
+def delete(key: str) -> None:
+    delete_prefix(key, exact=True)
+
+
+def delete_prefix(prefix: str, exact: bool = False) -> None:
+    '''Сбрасывает запись (или все записи с префиксом) для всех процессов сервера'''
+    if not CACHE_PATH:
+        return
+    try:
+        conn = _connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if exact:
+                where, params = 'key = ?', (prefix,)
+            else:
+                # Диапазон по первичному ключу вместо LIKE: префикс может содержать % и _
+                where, params = 'key >= ? AND key < ?', (prefix, prefix + '\U0010ffff')
+            freed = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM entries WHERE {where}', params).fetchone()[0]
+            conn.execute(f'DELETE FROM entries WHERE {where}', params)
+            conn.execute('UPDATE usage SET total_bytes = total_bytes - ? WHERE id = 1', (freed,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        _fail('delete', e)
+
+
+def stats() -> Dict[str, Any]:
+    '''Счётчики этого процесса: доля попаданий и среднее время чтения'''
+    with _stats_lock:
+        result = dict(_stats)
+    reads = result['hits'] + result['misses']
+    read_seconds = result.pop('read_seconds')
+    result['enabled'] = enabled()
+    result['hit_ratio'] = round(result['hits'] / reads, 4) if reads else 0.0
+    result['avg_read_ms'] = round(read_seconds * 1000 / reads, 4) if reads else 0.0
+    return result
@@ -0,0 +1,344 @@
+'''
+Business: Пакетный поиск клиентов и сделок по списку телефонов для сверок операторов
+Args: event - dict с httpMethod, body ({"phones": [...]} или по номеру на строку) и заголовком X-Admin-Token
+      context - объект с request_id, function_name
+Returns: NDJSON - по строке на телефон: сначала найденные в зеркале, затем по мере ответов AmoCRM.
+         Промахи, до которых AmoCRM не дошла за время запроса (или ответила 429/5xx и после
+         повторов), отдаются со status "pending" - их стоит прислать повторно
+'''
+
+import base64
+import gzip
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from typing import Dict, Any, List, Iterator, Optional, Tuple
+import psycopg2
+import requests
+from requests.adapters import HTTPAdapter
+import phones
+import amocrm_metadata
+import amocrm_stream
+import retry_policy
+
+MAX_PHONES = 1000
+# AmoCRM пропускает до 7 запросов в секунду на аккаунт - не упираемся в лимит
+AMOCRM_CONCURRENCY = 5
+# Максимум значений в одном filter[id][] запроса сделок
+LEADS_PAGE_SIZE = 250
+AMOCRM_TIMEOUT_SECONDS = 10
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# Один запрос на все телефоны: клиенты зеркала и их сделки, свёрнутые в JSON
+MIRROR_SQL = """
+    SELECT c.phone,
+           json_build_object(
+               'id', c.id::text, 'name', c.name, 'first_name', c.first_name,
+               'last_name', c.last_name, 'phone', c.phone, 'email', c.email
+           ),
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                   'id', d.id::text, 'name', d.name, 'price', d.price, 'status', d.status,
+                   'status_id', d.status_id, 'status_name', d.status_name, 'status_color', d.status_color,
+                   'pipeline_id', d.pipeline_id, 'pipeline_name', d.pipeline_name,
+                   'created_at', d.created_at, 'updated_at', d.updated_at
+               ) ORDER BY d.created_at DESC)
+               FROM t_p14771149_mfo_client_cabinet.amocrm_deals d
+               WHERE d.client_id = c.id
+           ), '[]'::json)
+    FROM t_p14771149_mfo_client_cabinet.amocrm_clients c
+    WHERE c.phone = ANY(%s)"""
+
+
+def ndjson_line(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, ensure_ascii=False, default=str) + '\n'
+
+
+def read_phones(event: Dict[str, Any]) -> List[str]:
+    raw = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        data = base64.b64decode(raw)
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        raw = data.decode('utf-8-sig')
+    if raw.lstrip().startswith('{'):
+        values = json.loads(raw).get('phones') or []
+        if not isinstance(values, list):
+            raise ValueError('phones должен быть списком')
+        return [str(value) for value in values]
+    return [line.strip() for line in raw.splitlines() if line.strip()]
+
+
+def lookup_mirror(database_url: str, numbers: List[str]) -> Dict[str, Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute(MIRROR_SQL, ([phones.to_e164(number) for number in numbers],))
+        found = {phones.normalize(row[0]): (row[1], row[2]) for row in cur.fetchall()}
+        cur.close()
+    finally:
+        conn.close()
+    return found
+
+
+class DeadlineReached(Exception):
+    '''До дедлайна запроса не остаётся времени на попытку - номер отдаётся как pending'''
+
+
+def amocrm_get(session: requests.Session, url: str, deadline_at: float, **kwargs) -> requests.Response:
+    '''GET в AmoCRM по общим правилам повторов; 429/5xx и после повторов - UpstreamUnavailable'''
+    if deadline_at - time.monotonic() < retry_policy.MIN_ATTEMPT_SECONDS:
+        raise DeadlineReached()
+    response = retry_policy.call(
+        'amocrm',
+        lambda timeout: session.get(url, timeout=timeout, **kwargs),
+        deadline_at,
+        timeout=AMOCRM_TIMEOUT_SECONDS,
+        retry_exceptions=RETRY_EXCEPTIONS
+    )
+    if retry_policy.is_transient(response.status_code):
+        response.close()
+        raise retry_policy.UpstreamUnavailable('amocrm', response)
+    response.raise_for_status()
+    return response
+
+
+def search_contact(session: requests.Session, base_url: str, number: str, deadline_at: float) -> Optional[Dict[str, Any]]:
+    '''Контакт по телефону вместе с id его сделок (with=leads) - без отдельного запроса деталей'''
+    response = amocrm_get(session, f'{base_url}/api/v4/contacts', deadline_at, params={'query': number, 'with': 'leads'})
+    if response.status_code == 204:
+        return None
+    contacts = response.json().get('_embedded', {}).get('contacts') or []
+    return contacts[0] if contacts else None
+
+
+def fetch_leads(session: requests.Session, base_url: str, lead_ids: List[int], deadline_at: float) -> List[amocrm_stream.Lead]:
+    '''Сделки сразу многих контактов: filter[id][] до LEADS_PAGE_SIZE значений на запрос'''
+    leads: List[amocrm_stream.Lead] = []
+    for start in range(0, len(lead_ids), LEADS_PAGE_SIZE):
+        page = lead_ids[start:start + LEADS_PAGE_SIZE]
+        response = amocrm_get(
+            session, f'{base_url}/api/v4/leads', deadline_at,
+            params=[('filter[id][]', lead_id) for lead_id in page] + [('limit', LEADS_PAGE_SIZE)],
+            stream=True
+        )
+        try:
+            leads.extend(amocrm_stream.stream_embedded(response, 'leads', amocrm_stream.project_lead))
+        finally:
+            response.close()
+    return leads
+
+
+def contact_data(contact: Dict[str, Any], number: str) -> Dict[str, Any]:
+    custom_fields = contact.get('custom_fields_values') or []
+    phone_field = next((f for f in custom_fields if f.get('field_code') == 'PHONE'), None)
+    email_field = next((f for f in custom_fields if f.get('field_code') == 'EMAIL'), None)
+    return {
+        'id': str(contact['id']),
+        'name': contact.get('name', ''),
+        'first_name': contact.get('first_name', ''),
+        'last_name': contact.get('last_name', ''),
+        'phone': phone_field['values'][0]['value'] if phone_field else number,
+        'email': email_field['values'][0]['value'] if email_field else ''
+    }
+
+
+def pending_line(number: str) -> str:
+    return ndjson_line({'phone': number, 'status': 'pending', 'source': 'amocrm'})
+
+
+def iter_amocrm(numbers: List[str], base_url: str, access_token: str, database_url: Optional[str],
+                deadline_at: float, stats: Dict[str, int]) -> Iterator[str]:
+    '''Промахи зеркала: поиск контактов параллельно (не больше AMOCRM_CONCURRENCY запросов разом),
+    строка отдаётся сразу, как только у контакта нет сделок или их сделки подгружены пачкой.
+    Всё, что не успело до deadline_at или упёрлось в 429/5xx, отдаётся как pending'''
+    session = requests.Session()
+    session.headers.update({'Authorization': f'Bearer {access_token}'})
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=AMOCRM_CONCURRENCY))
+
+    contacts: Dict[str, Dict[str, Any]] = {}
+    pool = ThreadPoolExecutor(max_workers=AMOCRM_CONCURRENCY)
+    try:
+        futures = {pool.submit(search_contact, session, base_url, number, deadline_at): number for number in numbers}
+        done = set()
+        try:
+            for future in as_completed(futures, timeout=max(0.0, deadline_at - time.monotonic())):
+                done.add(future)
+                number = futures[future]
+                try:
+                    contact = future.result()
+                except (DeadlineReached, retry_policy.UpstreamUnavailable):
+                    stats['pending'] += 1
+                    yield pending_line(number)
+                    continue
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    yield ndjson_line({'phone': number, 'status': 'error', 'error': f'Ошибка API AmoCRM: {e}'})
+                    continue
+                if contact is None:
+                    yield ndjson_line({'phone': number, 'status': 'not_found', 'source': 'amocrm'})
+                elif not contact.get('_embedded', {}).get('leads'):
+                    yield ndjson_line({
+                        'phone': number, 'status': 'found', 'source': 'amocrm',
+                        'client': contact_data(contact, number), 'deals': []
+                    })
+                else:
+                    contacts[number] = contact
+        except FuturesTimeoutError:
+            # Дедлайн: ещё не начатые поиски отменяются, начатые укладываются в него своим таймаутом
+            for future, number in futures.items():
+                if future not in done:
+                    future.cancel()
+                    stats['pending'] += 1
+                    yield pending_line(number)
+
+        if not contacts:
+            return
+
+        lead_ids = sorted({lead['id'] for contact in contacts.values() for lead in contact['_embedded']['leads']})
+        try:
+            leads = {lead.id: lead for lead in fetch_leads(session, base_url, lead_ids, deadline_at)}
+        except (DeadlineReached, retry_policy.UpstreamUnavailable):
+            for number in contacts:
+                stats['pending'] += 1
+                yield pending_line(number)
+            return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            for number in contacts:
+                yield ndjson_line({'phone': number, 'status': 'error', 'error': f'Ошибка API AmoCRM: {e}'})
+            return
+
+        deals_by_number: Dict[str, List[Dict[str, Any]]] = {}
+        for number, contact in contacts.items():
+            deals_by_number[number] = [
+                {
+                    'id': str(lead.id), 'name': lead.name or 'Без названия', 'price': lead.price,
+                    'status_id': lead.status_id, 'pipeline_id': lead.pipeline_id,
+                    'created_at': lead.created_at, 'updated_at': lead.updated_at
+                }
+                for lead in (leads.get(item['id']) for item in contact['_embedded']['leads']) if lead
+            ]
+        amocrm_metadata.enrich(
+            [deal for deals in deals_by_number.values() for deal in deals], database_url, base_url, access_token
+        )
+        for number, contact in contacts.items():
+            yield ndjson_line({
+                'phone': number, 'status': 'found', 'source': 'amocrm',
+                'client': contact_data(contact, number), 'deals': deals_by_number[number]
+            })
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        session.close()
+
+
+def iter_lookup(raw_phones: List[str], database_url: str, base_url: Optional[str],
+                access_token: Optional[str], deadline_at: float, stats: Dict[str, int]) -> Iterator[str]:
+    '''Строки NDJSON в порядке готовности: невалидные, найденные в зеркале, затем ответы AmoCRM'''
+    valid: List[str] = []
+    for number in phones.normalize_many(raw_phones):
+        if phones.is_valid(number):
+            valid.append(number)
+        else:
+            stats['invalid'] += 1
+            yield ndjson_line({'phone': number, 'status': 'invalid'})
+
+    found = lookup_mirror(database_url, valid) if valid else {}
+    for number in valid:
+        if number in found:
+            client, deals = found[number]
+            stats['mirror'] += 1
+            yield ndjson_line({'phone': number, 'status': 'found', 'source': 'mirror', 'client': client, 'deals': deals})
+
+    misses = [number for number in valid if number not in found]
+    if not misses:
+        return
+    if not base_url or not access_token:
+        for number in misses:
+            yield ndjson_line({'phone': number, 'status': 'not_found', 'source': 'mirror'})
+        return
+    stats['amocrm'] += len(misses)
+    yield from iter_amocrm(misses, base_url, access_token, database_url, deadline_at, stats)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    # Отдаёт персональные данные клиентов - без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        raw_phones = read_phones(event)
+    except (ValueError, AttributeError) as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Некорректный список телефонов: {e}'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+
+    if not raw_phones or len(raw_phones) > MAX_PHONES:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Нужно от 1 до {MAX_PHONES} телефонов'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    subdomain = os.environ.get('AMOCRM_SUBDOMAIN', '').replace('.amocrm.ru', '')
+    base_url = f'https://{subdomain}.amocrm.ru' if subdomain else None
+
+    started = time.monotonic()
+    deadline_at = retry_policy.deadline(context)
+    stats = {'invalid': 0, 'mirror': 0, 'amocrm': 0, 'pending': 0}
+    # Платформа отдаёт тело целиком, поэтому строки собираются здесь; генератор iter_lookup
+    # годится и для потоковой отдачи там, где рантайм это умеет
+    body = ''.join(iter_lookup(raw_phones, database_url, base_url, os.environ.get('AMOCRM_ACCESS_TOKEN'), deadline_at, stats))
+
+    print(f"[CLIENTS-LOOKUP] phones={len(raw_phones)} stats={stats} duration_ms={int((time.monotonic() - started) * 1000)}")
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/x-ndjson; charset=utf-8', 'Access-Control-Allow-Origin': '*'},
+        'body': body,
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,187 @@
+'''
+Повтор запросов к внешним API (AmoCRM, Битрикс24, MegaCRM) при временных сбоях: 429, 5xx,
+обрыв соединения, таймаут. Правила одни для всех функций:
+  - не больше MAX_ATTEMPTS попыток на вызов;
+  - пауза "full jitter": случайная от 0 до min(MAX_DELAY, BASE_DELAY * 2^(попытка-1)), чтобы
+    повторы многих экземпляров не приходили в CRM одной волной;
+  - Retry-After из ответа (секунды или HTTP-дата) - пауза не короче указанной;
+  - всё в пределах дедлайна запроса: если после паузы не останется MIN_ATTEMPT_SECONDS на
+    попытку, повтора нет и вызывающий получает последний ответ.
+Неидемпотентные вызовы (создание сделок, контактов) повторяются только на 429: AmoCRM
+отклоняет такой запрос, не выполняя его.
+
+Счётчики по каждому upstream (stats()) показывают, во сколько раз повторы умножают нагрузку:
+amplification = попытки / вызовы. Каждый повтор пишется в лог с префиксом [RETRY].
+Функции деплоятся независимо, поэтому файл лежит копией в каталоге каждой функции; копии
+должны совпадать.
+'''
+
+import asyncio
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+MAX_ATTEMPTS = int(os.environ.get('UPSTREAM_RETRY_MAX_ATTEMPTS', '3'))
+BASE_DELAY_SECONDS = 0.25
+MAX_DELAY_SECONDS = 4.0
+MIN_ATTEMPT_SECONDS = 1.0
+# Сколько функция готова отвечать, если платформа не сообщает оставшееся время
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', '25'))
+# Запас до дедлайна платформы на разбор ответа и сериализацию
+DEADLINE_MARGIN_SECONDS = 1.0
+DEFAULT_RETRY_AFTER_SECONDS = 5
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+NON_IDEMPOTENT_RETRY_STATUSES = frozenset({429})
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def deadline(context: Any = None, budget: float = REQUEST_BUDGET_SECONDS) -> float:
+    '''Момент по time.monotonic(), к которому функция должна успеть ответить'''
+    remaining = budget
+    get_remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if callable(get_remaining):
+        try:
+            remaining = min(budget, get_remaining() / 1000 - DEADLINE_MARGIN_SECONDS)
+        except (TypeError, ValueError):
+            pass
+    return time.monotonic() + max(remaining, 0.0)
+
+
+def timeout_for(deadline_at: float, timeout: float) -> float:
+    '''Таймаут одной попытки: обычный, но не дальше дедлайна'''
+    return max(0.1, min(timeout, deadline_at - time.monotonic()))
+
+
+def is_transient(status_code: int) -> bool:
+    return status_code in RETRY_STATUSES
+
+
+def retry_after_seconds(headers: Any) -> Optional[float]:
+    '''Retry-After в секундах: число или HTTP-дата; None - заголовка нет или он не разобран'''
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def client_retry_after(response: Any) -> str:
+    '''Значение Retry-After для ответа 503 клиенту: из ответа CRM или по умолчанию'''
+    seconds = retry_after_seconds(getattr(response, 'headers', None))
+    return str(int(seconds) if seconds is not None else DEFAULT_RETRY_AFTER_SECONDS)
+
+
+class UpstreamUnavailable(Exception):
+    '''Внешний API отвечает 429/5xx или недоступен и после повторов; функции отвечают клиенту 503'''
+    def __init__(self, upstream: str, response: Any = None, error: Optional[BaseException] = None):
+        super().__init__(f'{upstream}: ' + (f'HTTP {response.status_code}' if response is not None else repr(error)))
+        self.upstream = upstream
+        self.response = response
+
+    @property
+    def retry_after(self) -> str:
+        return client_retry_after(self.response)
+
+
+def _count(upstream: str, name: str) -> None:
+    with _stats_lock:
+        counters = _stats.setdefault(upstream, {'calls': 0, 'attempts': 0, 'retries': 0, 'exhausted': 0, 'retry_after': 0})
+        counters[name] += 1
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    '''Счётчики этого процесса по upstream: вызовы, попытки, повторы и усиление нагрузки'''
+    with _stats_lock:
+        result = {upstream: dict(counters) for upstream, counters in _stats.items()}
+    for counters in result.values():
+        counters['amplification'] = round(counters['attempts'] / counters['calls'], 3) if counters['calls'] else 0.0
+    return result
+
+
+def _next_delay(upstream: str, attempt: int, reason: str, headers: Any, deadline_at: float) -> Optional[float]:
+    '''Пауза перед следующей попыткой или None - повторять нельзя (попытки или время кончились)'''
+    if attempt >= MAX_ATTEMPTS:
+        _count(upstream, 'exhausted')
+        print(f'[RETRY] {upstream}: {reason}, попытки исчерпаны ({attempt}) {stats()[upstream]}')
+        return None
+    delay = random.uniform(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+    retry_after = retry_after_seconds(headers)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    if time.monotonic() + delay + MIN_ATTEMPT_SECONDS > deadline_at:
+        _count(upstream, 'exhausted')
+        print(f'[RETRY] {upstream}: {reason}, пауза {delay:.2f}s не укладывается в дедлайн запроса')
+        return None
+    _count(upstream, 'retries')
+    if retry_after is not None:
+        _count(upstream, 'retry_after')
+    print(f'[RETRY] {upstream}: {reason}, попытка {attempt + 1}/{MAX_ATTEMPTS} через {delay:.2f}s')
+    return delay
+
+
+def call(upstream: str, send: Callable[[float], Any], deadline_at: float, timeout: float = 10,
+         idempotent: bool = True, retry_exceptions: Tuple[Type[BaseException], ...] = ()) -> Any:
+    '''
+    send(timeout) выполняет одну попытку (например requests.get) и возвращает ответ.
+    Отдаёт первый не временный ответ или последний временный, если повторять больше нельзя.
+    Исключения из retry_exceptions повторяются так же, последнее пробрасывается.
+    '''
+    statuses = RETRY_STATUSES if idempotent else NON_IDEMPOTENT_RETRY_STATUSES
+    _count(upstream, 'calls')
+    attempt = 0
+    while True:
+        attempt += 1
+        _count(upstream, 'attempts')
+        try:
+            response = send(timeout_for(deadline_at, timeout))
+        except retry_exceptions as e:
+            delay = _next_delay(upstream, attempt, type(e).__name__, None, deadline_at)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        if response.status_code not in statuses:
+            return response
+        delay = _next_delay(upstream, attempt, f'HTTP {response.status_code}', response.headers, deadline_at)
+        if delay is None:
+            return response
+        response.close()
+        time.sleep(delay)
+
+
+async def acall(upstream: str, send: Callable[[float], Awaitable[Any]], deadline_at: float, timeout: float = 10,
+                idempotent: bool = True, retry_exceptions: Tuple[Type[BaseException], ...] = ()) -> Any:
+    '''То же для корутин: send(timeout) - например lambda t: aio.http().get(url, timeout=t)'''
+    statuses = RETRY_STATUSES if idempotent else NON_IDEMPOTENT_RETRY_STATUSES
+    _count(upstream, 'calls')
+    attempt = 0
+    while True:
+        attempt += 1
+        _count(upstream, 'attempts')
+        try:
+            response = await send(timeout_for(deadline_at, timeout))
+        except retry_exceptions as e:
+            delay = _next_delay(upstream, attempt, type(e).__name__, None, deadline_at)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        if response.status_code not in statuses:
+            return response
+        delay = _next_delay(upstream, attempt, f'HTTP {response.status_code}', response.headers, deadline_at)
+        if delay is None:
+            return response
+        # Потоковый ответ (client.send(..., stream=True)) держит соединение, пока его не закрыть
+        await response.aclose()
+        await asyncio.sleep(delay)
@@ -1,13 +1,61 @@
 import json
 import os
-import requests
-from typing import Dict, Any
+import hashlib
+import psycopg2
+import phones
+from typing import Dict, Any, Optional
+
+IDEMPOTENCY_TTL_HOURS = 24
+
+def get_idempotency_key(event: Dict[str, Any], body_data: Dict[str, Any]) -> str:
+    '''Ключ идемпотентности из заголовка Idempotency-Key или поля idempotency_key в теле'''
+    request_headers = event.get('headers') or {}
+    for header_name, header_value in request_headers.items():
+        if header_name.lower() in ('idempotency-key', 'x-idempotency-key') and header_value:
+            return str(header_value).strip()[:255]
+    return str(body_data.get('idempotency_key') or '').strip()[:255]
+
+def get_request_hash(body_data: Dict[str, Any]) -> str:
+    payload = {k: v for k, v in body_data.items() if k != 'idempotency_key'}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def claim_idempotency_key(cur, endpoint: str, key: str, request_hash: str) -> Optional[tuple]:
+    '''Регистрирует ключ (просроченный перезаписывает). None - запрос новый, иначе сохранённая запись'''
+    cur.execute(
+        """INSERT INTO t_p14771149_mfo_client_cabinet.idempotency_keys 
+           (endpoint, idempotency_key, request_hash, expires_at) 
+           VALUES (%s, %s, %s, NOW() + make_interval(hours => %s)) 
+           ON CONFLICT (endpoint, idempotency_key) DO UPDATE 
+           SET request_hash = EXCLUDED.request_hash, response_status = NULL, response_body = NULL, 
+               created_at = NOW(), expires_at = EXCLUDED.expires_at 
+           WHERE idempotency_keys.expires_at <= NOW() 
+           RETURNING idempotency_key""",
+        (endpoint, key, request_hash, IDEMPOTENCY_TTL_HOURS)
+    )
+    if cur.fetchone():
+        return None
+    cur.execute(
+        """SELECT request_hash, response_status, response_body 
+           FROM t_p14771149_mfo_client_cabinet.idempotency_keys 
+           WHERE endpoint = %s AND idempotency_key = %s""",
+        (endpoint, key)
+    )
+    return cur.fetchone()
+
+def save_idempotent_response(cur, endpoint: str, key: str, status_code: int, response_body: str) -> None:
+    cur.execute(
+        """UPDATE t_p14771149_mfo_client_cabinet.idempotency_keys 
+           SET response_status = %s, response_body = %s 
+           WHERE endpoint = %s AND idempotency_key = %s""",
+        (status_code, response_body, endpoint, key)
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Create new deal in AmoCRM
-    Args: event - dict with httpMethod, body (phone, amount, loanTerm, purpose)
-    Returns: HTTP response with deal_id
+    Business: Queue new deal for AmoCRM (sent in batches by lead-outbox-drain)
+    Args: event - dict with httpMethod, body (phone, amount, loanTerm, purpose),
+          optional Idempotency-Key header (or idempotency_key in body)
+    Returns: HTTP response with local deal_id
     '''
     method: str = event.get('httpMethod', 'POST')
     
@@ -17,7 +65,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
@@ -40,6 +88,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     amount = body_data.get('amount', 0)
     loan_term = body_data.get('loanTerm', 0)
     purpose = body_data.get('purpose', '').strip()
+    idempotency_key = get_idempotency_key(event, body_data)
     
     if not phone or not amount:
         return {
@@ -49,77 +98,82 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    # Нормализуем телефон
-    clean_phone = ''.join(filter(str.isdigit, phone))
-    if clean_phone.startswith('8'):
-        clean_phone = '7' + clean_phone[1:]
-    if not clean_phone.startswith('7'):
-        clean_phone = '7' + clean_phone
-    normalized_phone = '+' + clean_phone
+    # Нормализуем телефон к виду +79991234567
+    normalized_phone = phones.to_e164(phone)
     
-    amocrm_subdomain = os.environ.get('AMOCRM_SUBDOMAIN', 'stepanmalik88')
-    # Убираем .amocrm.ru если он уже есть
-    if amocrm_subdomain.endswith('.amocrm.ru'):
-        amocrm_domain = amocrm_subdomain
-    else:
-        amocrm_domain = f'{amocrm_subdomain}.amocrm.ru'
-    amocrm_token = os.environ.get('AMOCRM_ACCESS_TOKEN', '')
-    
-    if not amocrm_token:
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'AmoCRM не настроен'}),
+            'body': json.dumps({'error': 'Database not configured'}),
             'isBase64Encoded': False
         }
     
-    # Создаём сделку в AmoCRM
+    # Ставим заявку в очередь, в AmoCRM её отправит lead-outbox-drain пачкой
     try:
-        print(f"Создание сделки в AmoCRM для {normalized_phone}")
-        headers = {
-            'Authorization': f'Bearer {amocrm_token}',
-            'Content-Type': 'application/json'
-        }
+        conn = psycopg2.connect(database_url)
+        cur = conn.cursor()
         
-        deal_data = [{
-            'name': f'Заявка на {amount} руб. (срок {loan_term} мес.)',
-            'price': int(amount)
-        }]
-        
-        print(f"Данные сделки: {json.dumps(deal_data)}")
+        # Повтор с тем же ключом получает исходный ответ без новой заявки
+        if idempotency_key:
+            request_hash = get_request_hash(body_data)
+            stored = claim_idempotency_key(cur, 'create-deal', idempotency_key, request_hash)
+            if stored:
+                conn.rollback()
+                cur.close()
+                conn.close()
+                stored_hash, stored_status, stored_body = stored
+                if stored_hash != request_hash:
+                    return {
+                        'statusCode': 422,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Idempotency-Key already used with different request'}),
+                        'isBase64Encoded': False
+                    }
+                if stored_status is None:
+                    return {
+                        'statusCode': 409,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Request with this Idempotency-Key is still in progress'}),
+                        'isBase64Encoded': False
+                    }
+                print(f"Повтор заявки по ключу {idempotency_key}")
+                return {
+                    'statusCode': stored_status,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Idempotent-Replayed': 'true'},
+                    'body': stored_body,
+                    'isBase64Encoded': False
+                }
         
-        response = requests.post(
-            f'https://{amocrm_domain}/api/v4/leads',
-            headers=headers,
-            json=deal_data,
-            timeout=10
+        cur.execute(
+            """INSERT INTO t_p14771149_mfo_client_cabinet.lead_outbox 
+               (source, phone, lead_name, price) 
+               VALUES (%s, %s, %s, %s) 
+               RETURNING id""",
+            ('create-deal', normalized_phone, f'Заявка на {amount} руб. (срок {loan_term} мес.)', int(amount))
         )
+        outbox_id = cur.fetchone()[0]
         
-        print(f"AmoCRM ответ: {response.status_code}")
+        response_body = json.dumps({
+            'success': True,
+            'deal_id': str(outbox_id),
+            'queued': True,
+            'message': 'Заявка успешно создана'
+        })
+        if idempotency_key:
+            save_idempotent_response(cur, 'create-deal', idempotency_key, 200, response_body)
         
-        if response.status_code in [200, 201]:
-            result = response.json()
-            if result.get('_embedded', {}).get('leads'):
-                deal_id = result['_embedded']['leads'][0]['id']
-                print(f"Создана сделка ID: {deal_id}")
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'deal_id': str(deal_id),
-                        'message': 'Заявка успешно создана'
-                    }),
-                    'isBase64Encoded': False
-                }
+        conn.commit()
+        cur.close()
+        conn.close()
+        
+        print(f"Заявка {outbox_id} поставлена в очередь для {normalized_phone}")
         
-        error_text = response.text
-        print(f"Ошибка AmoCRM: {error_text}")
         return {
-            'statusCode': 500,
+            'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка создания сделки: {error_text}'}),
+            'body': response_body,
             'isBase64Encoded': False
         }
         
@@ -0,0 +1,112 @@
+'''
+Business: Пересборка срезов воронки (deal_funnel_hourly/daily) из истории статусов; по желанию
+          сначала удаляет записи истории, принятые за окно (подложные вебхуки)
+Args: event - dict с httpMethod (POST), заголовком X-Admin-Token и body с необязательными
+             purge_recorded_from/purge_recorded_to (ISO-время, по recorded_at, конец не включается)
+      context - объект с request_id, function_name
+Returns: HTTP response с числом удалённых записей истории, оставшихся записей и длительностью
+'''
+
+import hmac
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, Optional
+import psycopg2
+
+
+def parse_time(value: Any) -> Optional[datetime]:
+    if value in (None, ''):
+        return None
+    return datetime.fromisoformat(str(value))
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Удаляет историю и перестраивает срезы - служебный вызов, без настроенного ADMIN_API_TOKEN закрыт
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        purge_from = parse_time(body.get('purge_recorded_from'))
+        purge_to = parse_time(body.get('purge_recorded_to'))
+        if (purge_from is None) != (purge_to is None) or (purge_from and purge_from >= purge_to):
+            raise ValueError('purge_recorded_from и purge_recorded_to задаются вместе, начало раньше конца')
+    except (ValueError, AttributeError, TypeError) as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': f'Invalid body: {e}'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    started = time.monotonic()
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT purged_rows, history_rows FROM t_p14771149_mfo_client_cabinet.rebuild_deal_funnel_rollups(%s, %s)",
+            (purge_from, purge_to)
+        )
+        purged, history = cur.fetchone()
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+    duration_ms = int((time.monotonic() - started) * 1000)
+    print(f"[DEAL-FUNNEL-REBUILD] purged={purged} history={history} "
+          f"window={purge_from}..{purge_to} duration_ms={duration_ms}")
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'purged': purged,
+            'history_rows': history,
+            'duration_ms': duration_ms
+        }),
+        'isBase64Encoded': False
+    }
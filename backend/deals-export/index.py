@@ -0,0 +1,310 @@
+'''
+Business: Выгрузка сделок AmoCRM с данными клиентов для отчётности (CSV или XLSX)
+Args: event - dict с httpMethod, queryStringParameters (date_from, date_to, status_id, format,
+      after_id, after_created_at, limit) и заголовком X-Admin-Token
+      context - объект с request_id, function_name
+Returns: порция сделок после курсора; X-Next-After-Id (и X-Next-After-Created-At при фильтре
+         по датам) - с чего продолжать, пусто - выгрузка закончена
+
+Для полной выгрузки без порций - запуск из командной строки:
+    DATABASE_URL=... python index.py --date-from 2024-01-01 --format xlsx --output deals.xlsx
+'''
+
+import argparse
+import base64
+import csv
+import gzip
+import hmac
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple, BinaryIO
+import psycopg2
+
+EXPORT_PAGE_SIZE = 100000
+EXPORT_MAX_PAGE_SIZE = 500000
+# Сколько строк за раз тянет серверный курсор и сколько строк CSV копится перед записью в поток
+FETCH_SIZE = 5000
+# Лимит строк листа Excel (без заголовка); дальше выгрузка продолжается на следующем листе
+XLSX_SHEET_ROWS = 1048575
+
+COLUMNS = [
+    'deal_id', 'deal_name', 'price', 'status', 'status_id', 'status_name', 'pipeline_id', 'pipeline_name',
+    'created_at', 'updated_at', 'client_id', 'client_phone', 'client_name', 'client_email'
+]
+
+EXPORT_SQL = """
+    SELECT d.id, d.name, d.price, d.status, d.status_id, d.status_name, d.pipeline_id, d.pipeline_name,
+           d.created_at, d.updated_at, c.id, c.phone, c.name, c.email
+    FROM t_p14771149_mfo_client_cabinet.amocrm_deals d
+    LEFT JOIN t_p14771149_mfo_client_cabinet.amocrm_clients c ON c.id = d.client_id
+    WHERE {conditions}
+    ORDER BY {order}"""
+CREATED_AT_COLUMN = 8
+
+
+def by_created_at(filters: Dict[str, Any]) -> bool:
+    '''С фильтром по датам порции идут по (created_at, id), без него - по id'''
+    return bool(filters.get('date_from') or filters.get('date_to'))
+
+
+def build_query(filters: Dict[str, Any], after_id: int, limit: Optional[int],
+                after_created_at: Optional[datetime] = None) -> Tuple[str, List[Any]]:
+    '''
+    Порядок совпадает с индексом, который обслуживает фильтр, поэтому каждая порция - короткий
+    проход по индексу от курсора, без сортировки всей выборки:
+      период          - idx_amocrm_deals_created_at_id, порядок (created_at, id);
+      период + статус - idx_amocrm_deals_status_created_at_id (для одного статуса);
+      только статус   - idx_amocrm_deals_status_id, порядок id;
+      без фильтров    - первичный ключ.
+    '''
+    conditions: List[str] = []
+    params: List[Any] = []
+    if by_created_at(filters):
+        order = 'd.created_at, d.id'
+        if after_created_at is not None:
+            conditions.append('(d.created_at, d.id) > (%s, %s)')
+            params.extend([after_created_at, after_id])
+    else:
+        order = 'd.id'
+        conditions.append('d.id > %s')
+        params.append(after_id)
+    if filters.get('date_from'):
+        conditions.append('d.created_at >= %s')
+        params.append(filters['date_from'])
+    if filters.get('date_to'):
+        # date_to включительно: всё, что создано до начала следующего дня
+        conditions.append("d.created_at < %s::date + INTERVAL '1 day'")
+        params.append(filters['date_to'])
+    if len(filters.get('status_ids') or []) == 1:
+        # С = ANY(...) индекс не отдаёт строки в нужном порядке даже для одного значения
+        conditions.append('d.status_id = %s')
+        params.append(filters['status_ids'][0])
+    elif filters.get('status_ids'):
+        conditions.append('d.status_id = ANY(%s)')
+        params.append(filters['status_ids'])
+    sql = EXPORT_SQL.format(conditions=' AND '.join(conditions) or 'TRUE', order=order)
+    if limit:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    return sql, params
+
+
+def iter_rows(conn, filters: Dict[str, Any], after_id: int = 0, limit: Optional[int] = None,
+              after_created_at: Optional[datetime] = None) -> Iterator[tuple]:
+    '''Именованный (серверный) курсор: в памяти только текущие FETCH_SIZE строк'''
+    sql, params = build_query(filters, after_id, limit, after_created_at)
+    cur = conn.cursor(name='deals_export')
+    cur.itersize = FETCH_SIZE
+    try:
+        cur.execute(sql, params)
+        yield from cur
+    finally:
+        cur.close()
+
+
+def _cell(value: Any) -> Any:
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(sep=' ') if hasattr(value, 'hour') else value.isoformat()
+    return value
+
+
+def write_csv(rows: Iterator[tuple], out: BinaryIO, progress: Dict[str, int]) -> None:
+    '''CSV с заголовком; строки копятся по FETCH_SIZE и пишутся в out (файл, stdout, gzip)'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    pending = 0
+    for row in rows:
+        writer.writerow([_cell(value) for value in row])
+        progress['rows'] += 1
+        progress['last_id'] = row[0]
+        progress['last_created_at'] = row[CREATED_AT_COLUMN]
+        pending += 1
+        if pending >= FETCH_SIZE:
+            out.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    out.write(buffer.getvalue().encode('utf-8'))
+
+
+def write_xlsx(rows: Iterator[tuple], path: str, progress: Dict[str, int]) -> None:
+    '''XLSX в режиме constant_memory: строка уходит во временный файл листа сразу после записи'''
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'remove_timezone': True})
+    datetime_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    sheet, sheet_row = None, XLSX_SHEET_ROWS
+    for row in rows:
+        if sheet_row >= XLSX_SHEET_ROWS:
+            sheet = workbook.add_worksheet(f'deals_{len(workbook.worksheets()) + 1}')
+            sheet.write_row(0, 0, COLUMNS)
+            sheet_row = 0
+        sheet_row += 1
+        for col, value in enumerate(row):
+            if hasattr(value, 'hour'):
+                sheet.write_datetime(sheet_row, col, value, datetime_format)
+            elif value is not None:
+                sheet.write(sheet_row, col, float(value) if col == 2 else value)
+        progress['rows'] += 1
+        progress['last_id'] = row[0]
+        progress['last_created_at'] = row[CREATED_AT_COLUMN]
+    if sheet is None:
+        workbook.add_worksheet('deals_1').write_row(0, 0, COLUMNS)
+    workbook.close()
+
+
+def parse_filters(params: Dict[str, Any]) -> Dict[str, Any]:
+    filters: Dict[str, Any] = {}
+    for key in ('date_from', 'date_to'):
+        if params.get(key):
+            filters[key] = date.fromisoformat(str(params[key]).strip())
+    if params.get('status_id'):
+        filters['status_ids'] = [int(value) for value in str(params['status_id']).split(',') if value.strip()]
+    return filters
+
+
+def response(status: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(payload, ensure_ascii=False),
+        'isBase64Encoded': False
+    }
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'GET':
+        return response(405, {'error': 'Method not allowed'})
+
+    # Выгрузка отдаёт персональные данные - без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return response(403, {'error': 'Forbidden'})
+
+    params = event.get('queryStringParameters') or {}
+    fmt = params.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        return response(400, {'error': 'format must be csv or xlsx'})
+    try:
+        filters = parse_filters(params)
+        after_id = int(params.get('after_id', 0) or 0)
+        after_created_at = datetime.fromisoformat(params['after_created_at']) if params.get('after_created_at') else None
+        limit = max(1, min(int(params.get('limit', EXPORT_PAGE_SIZE) or EXPORT_PAGE_SIZE), EXPORT_MAX_PAGE_SIZE))
+    except ValueError as e:
+        return response(400, {'error': f'Invalid filter: {e}'})
+    # С фильтром по датам курсор - пара (created_at, id) из заголовков прошлой порции
+    if by_created_at(filters) and bool(after_id) != (after_created_at is not None):
+        return response(400, {'error': 'after_id и after_created_at передаются вместе'})
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return response(500, {'error': 'Database not configured'})
+
+    started = time.monotonic()
+    progress = {'rows': 0, 'last_id': 0, 'last_created_at': None}
+    conn = psycopg2.connect(database_url)
+    try:
+        conn.set_session(readonly=True)
+        rows = iter_rows(conn, filters, after_id, limit, after_created_at)
+        if fmt == 'csv':
+            compressed = io.BytesIO()
+            with gzip.GzipFile(fileobj=compressed, mode='wb') as out:
+                write_csv(rows, out, progress)
+            body = compressed.getvalue()
+        else:
+            with tempfile.NamedTemporaryFile(suffix='.xlsx') as tmp:
+                write_xlsx(rows, tmp.name, progress)
+                # xlsxwriter пишет файл по имени, своим дескриптором - читаем через tmp с начала
+                tmp.seek(0)
+                body = tmp.read()
+    finally:
+        conn.close()
+
+    # Неполная порция - выгрузка закончена
+    next_after_id = progress['last_id'] if progress['rows'] == limit else 0
+    print(f"[DEALS-EXPORT] format={fmt} filters={filters} after_id={after_id} rows={progress['rows']} "
+          f"next_after_id={next_after_id} bytes={len(body)} duration_ms={int((time.monotonic() - started) * 1000)}")
+
+    next_after_created_at = progress['last_created_at'] if next_after_id and by_created_at(filters) else None
+    result_headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Next-After-Id, X-Next-After-Created-At',
+        'X-Next-After-Id': str(next_after_id) if next_after_id else '',
+        'X-Next-After-Created-At': next_after_created_at.isoformat() if next_after_created_at else ''
+    }
+    if fmt == 'csv':
+        result_headers.update({'Content-Type': 'text/csv; charset=utf-8', 'Content-Encoding': 'gzip'})
+    else:
+        result_headers.update({
+            'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            'Content-Disposition': 'attachment; filename="deals.xlsx"'
+        })
+    return {
+        'statusCode': 200,
+        'headers': result_headers,
+        'body': base64.b64encode(body).decode(),
+        'isBase64Encoded': True
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Полная выгрузка сделок AmoCRM с данными клиентов')
+    parser.add_argument('--date-from')
+    parser.add_argument('--date-to')
+    parser.add_argument('--status-id', help='id статусов через запятую')
+    parser.add_argument('--format', choices=('csv', 'xlsx'), default='csv')
+    parser.add_argument('--output', help='файл; для CSV по умолчанию stdout')
+    args = parser.parse_args()
+
+    if args.format == 'xlsx' and not args.output:
+        parser.error('для xlsx нужен --output')
+
+    filters = parse_filters({'date_from': args.date_from, 'date_to': args.date_to, 'status_id': args.status_id})
+    started = time.monotonic()
+    progress = {'rows': 0, 'last_id': 0, 'last_created_at': None}
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        conn.set_session(readonly=True)
+        rows = iter_rows(conn, filters)
+        if args.format == 'xlsx':
+            write_xlsx(rows, args.output, progress)
+        elif args.output:
+            with open(args.output, 'wb') as out:
+                write_csv(rows, out, progress)
+        else:
+            write_csv(rows, sys.stdout.buffer, progress)
+    finally:
+        conn.close()
+
+    duration = time.monotonic() - started
+    print(f"[DEALS-EXPORT] rows={progress['rows']} duration_s={duration:.1f} "
+          f"rows_per_second={int(progress['rows'] / duration) if duration > 0 else 0}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+'''
+Асинхронная обвязка функций с handler_async: общий httpx.AsyncClient и пул asyncpg на цикл событий.
+
+Асинхронный рантайм вызывает await handler_async(event, context) прямо в своём цикле.
+Синхронный handler(event, context) платформы вызывает run(handler_async(...)): корутина уходит
+в фоновый цикл процесса, который живёт между тёплыми вызовами. Клиент с keep-alive и пул
+соединений переиспользуются, а несколько потоков (selfhost, gthread) ждут CRM одновременно
+в одном цикле вместо того, чтобы держать по потоку на каждый ответ.
+
+request() - запрос через общий клиент с повторами по правилам retry_policy.
+Блокирующие модули (phone_filter, amocrm_metadata) из корутин вызываются через asyncio.to_thread.
+Функции деплоятся независимо, поэтому файл лежит копией в каталоге каждой функции; копии
+должны совпадать.
+'''
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, Coroutine, Dict, Optional, TypeVar
+
+import httpx
+import retry_policy
+
+HTTP_TIMEOUT_SECONDS = 10
+HTTP_POOL_MAX = int(os.environ.get('HTTP_POOL_MAX', '100'))
+DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', '10'))
+
+T = TypeVar('T')
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+# Клиент и пулы привязаны к циклу, в котором созданы; умерший цикл забирает их с собой
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+_pools: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Task]]' = weakref.WeakKeyDictionary()
+_transport: Optional[httpx.AsyncBaseTransport] = None
+
+
+def use_transport(transport: Optional[httpx.AsyncBaseTransport]) -> None:
+    '''Для замеров и проверок: запросы идут в transport (например httpx.MockTransport) вместо сети'''
+    global _transport
+    _transport = transport
+    _clients.clear()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_pid
+    with _loop_lock:
+        # После fork поток цикла в дочернем процессе не существует - запускаем свой
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='aio-loop', daemon=True).start()
+            _loop, _loop_pid = loop, os.getpid()
+        return _loop
+
+
+def run(coro: Coroutine[Any, Any, T]) -> T:
+    '''Выполняет корутину из синхронного кода в фоновом цикле процесса и возвращает результат'''
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError('aio.run вызван из фонового цикла: используйте await')
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def http() -> httpx.AsyncClient:
+    '''Общий клиент текущего цикла: keep-alive к AmoCRM, Битрикс24, MegaCRM между запросами'''
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=HTTP_POOL_MAX, max_keepalive_connections=HTTP_POOL_MAX),
+            transport=_transport
+        )
+        _clients[loop] = client
+    return client
+
+
+async def db_pool(dsn: str) -> Any:
+    '''Пул asyncpg текущего цикла; соединения открываются по мере надобности, не больше DB_POOL_MAX'''
+    # asyncpg нужен только функциям, которые ходят в Postgres из корутин
+    import asyncpg
+
+    loop = asyncio.get_running_loop()
+    pools = _pools.setdefault(loop, {})
+    task = pools.get(dsn)
+    if task is None:
+        # Одна задача на DSN: одновременные первые запросы ждут один и тот же пул
+        # create_pool отдаёт не корутину, а awaitable-пул - ensure_future оборачивает его в задачу
+        task = asyncio.ensure_future(asyncpg.create_pool(dsn, min_size=0, max_size=DB_POOL_MAX))
+        pools[dsn] = task
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        if pools.get(dsn) is task:
+            del pools[dsn]
+        raise
+
+
+async def request(upstream: str, method: str, url: str, deadline_at: float, stream: bool = False,
+                  idempotent: bool = True, **kwargs: Any) -> httpx.Response:
+    '''
+    Запрос через общий клиент с повторами временных ошибок до дедлайна запроса.
+    Если CRM так и отвечает 429/5xx или недоступна - retry_policy.UpstreamUnavailable.
+    Ответ с stream=True вызывающий закрывает сам (await response.aclose()).
+    '''
+    client = http()
+    # Неидемпотентный запрос повторяем только если он точно не ушёл: соединение не установилось
+    retry_exceptions = (httpx.TransportError,) if idempotent else (httpx.ConnectError, httpx.ConnectTimeout)
+    try:
+        response = await retry_policy.acall(
+            upstream,
+            lambda timeout: client.send(client.build_request(method, url, timeout=timeout, **kwargs), stream=stream),
+            deadline_at,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            idempotent=idempotent,
+            retry_exceptions=retry_exceptions
+        )
+    except httpx.TransportError as e:
+        raise retry_policy.UpstreamUnavailable(upstream, error=e) from e
+    if retry_policy.is_transient(response.status_code):
+        await response.aclose()
+        raise retry_policy.UpstreamUnavailable(upstream, response)
+    return response
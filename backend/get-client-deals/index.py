@@ -5,25 +5,48 @@ Args: event - dict с httpMethod, queryStringParameters (phone, full_name)
 Returns: HTTP response со списком заявок клиента из AmoCRM
 '''
 
+import asyncio
 import json
 import os
-import requests
 from typing import Dict, Any, List
+import aio
+import phone_filter
+import amocrm_metadata
+import amocrm_stream
+import phones
+import host_cache
+import retry_policy
 
-def normalize_phone(phone: str) -> str:
-    '''Нормализация телефона к формату для поиска'''
-    clean = ''.join(filter(str.isdigit, phone))
-    if clean.startswith('8'):
-        clean = '7' + clean[1:]
-    if not clean.startswith('7'):
-        clean = '7' + clean
-    return clean
+# Карточка контакта меняется редко; общий кеш сервера избавляет другие процессы от повторного запроса
+CONTACT_CACHE_TTL_SECONDS = 300
+
+async def fetch_contact(amocrm_domain: str, headers: Dict[str, str], contact_id: Any, deadline_at: float) -> Any:
+    '''Карточка контакта AmoCRM или None, если AmoCRM её не отдал'''
+    key = f'amocrm:contact:{amocrm_domain}:{contact_id}'
+    # host_cache - синхронный SQLite: запись ждёт BEGIN IMMEDIATE до busy timeout, и даже чтение
+    # в цикле остановило бы все запросы процесса - оба вызова в поток, как phone_filter
+    contact_data = await asyncio.to_thread(host_cache.get, key)
+    if contact_data is not None:
+        return contact_data
+    
+    contact_detail = await aio.request(
+        'amocrm', 'GET', f'https://{amocrm_domain}/api/v4/contacts/{contact_id}', deadline_at, headers=headers
+    )
+    if contact_detail.status_code != 200:
+        return None
+    contact_data = contact_detail.json()
+    await asyncio.to_thread(host_cache.put, key, contact_data, CONTACT_CACHE_TTL_SECONDS)
+    return contact_data
 
 def normalize_name(name: str) -> str:
     '''Нормализация имени для сравнения'''
     return ' '.join(name.lower().strip().split())
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return aio.run(handler_async(event, context))
+
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''Та же функция для асинхронного рантайма: пока ждём AmoCRM, процесс обслуживает другие запросы'''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -67,21 +90,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    normalized_phone = normalize_phone(phone)
+    normalized_phone = phones.normalize(phone)
     normalized_full_name = normalize_name(full_name)
     
+    # Номера, которых точно нет в зеркале amocrm_clients, отсекаем без запроса в AmoCRM
+    if not await asyncio.to_thread(phone_filter.might_exist, normalized_phone, os.environ.get('DATABASE_URL')):
+        return {
+            'statusCode': 404,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Клиент не найден'}),
+            'isBase64Encoded': False
+        }
+    
     headers = {
         'Authorization': f'Bearer {amocrm_token}',
         'Content-Type': 'application/json'
     }
+    deadline_at = retry_policy.deadline(context)
     
     try:
         # Ищем контакт по телефону
-        search_response = requests.get(
-            f'https://{amocrm_domain}/api/v4/contacts',
+        search_response = await aio.request(
+            'amocrm', 'GET', f'https://{amocrm_domain}/api/v4/contacts', deadline_at,
             headers=headers,
-            params={'query': normalized_phone},
-            timeout=10
+            params={'query': normalized_phone}
         )
         
         if search_response.status_code == 401:
@@ -104,6 +136,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         contacts = contacts_data.get('_embedded', {}).get('contacts', [])
         
         if not contacts:
+            if phone_filter.PRECHECK_ENABLED:
+                phone_filter.record_false_positive()
+                print(f'[GET-CLIENT-DEALS] Ложное срабатывание фильтра: {phone_filter.stats()}')
             return {
                 'statusCode': 404,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -114,21 +149,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         # Проверяем совпадение телефона и ФИО
         matched_contact = None
         for contact in contacts:
-            contact_detail = requests.get(
-                f'https://{amocrm_domain}/api/v4/contacts/{contact.get("id")}',
-                headers=headers,
-                timeout=10
-            )
+            contact_data = await fetch_contact(amocrm_domain, headers, contact.get('id'), deadline_at)
             
-            if contact_detail.status_code == 200:
-                contact_data = contact_detail.json()
-                
+            if contact_data is not None:
                 # Проверяем телефон
                 phone_match = False
                 for field in contact_data.get('custom_fields_values', []):
                     if field.get('field_code') == 'PHONE':
                         for value in field.get('values', []):
-                            contact_phone = normalize_phone(value.get('value', ''))
+                            contact_phone = phones.normalize(value.get('value', ''))
                             if contact_phone == normalized_phone:
                                 phone_match = True
                                 break
@@ -166,14 +195,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'limit': 250
         }
         
-        all_leads_response = requests.get(
-            f'https://{amocrm_domain}/api/v4/leads',
+        all_leads_response = await aio.request(
+            'amocrm', 'GET', f'https://{amocrm_domain}/api/v4/leads', deadline_at,
+            stream=True,
             headers=headers,
-            params=filter_params,
-            timeout=10
+            params=filter_params
         )
+        try:
+            # Из страницы сделок читаем только нужные поля, не собирая весь ответ в память
+            if all_leads_response.status_code == 200:
+                all_leads = await amocrm_stream.astream_embedded(all_leads_response, 'leads', amocrm_stream.project_lead)
+            else:
+                all_leads = None
+        finally:
+            await all_leads_response.aclose()
         
-        if all_leads_response.status_code != 200:
+        if all_leads is None:
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -186,29 +223,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        all_leads_data = all_leads_response.json()
-        all_leads = all_leads_data.get('_embedded', {}).get('leads', [])
-        
         # Объединяем все сделки клиента в одну запись с суммой
-        total_price = sum(lead.get('price', 0) for lead in all_leads)
-        deal_ids = [lead.get('id') for lead in all_leads]
+        total_price = sum(lead.price for lead in all_leads)
+        deal_ids = [lead.id for lead in all_leads]
         
         # Создаём одну объединённую заявку
         if all_leads:
             # Берём самую свежую заявку для отображения
-            latest_lead = max(all_leads, key=lambda x: x.get('updated_at', 0))
+            latest_lead = max(all_leads, key=lambda x: x.updated_at or 0)
             
             unified_deal = {
                 'id': ','.join(map(str, deal_ids)),  # Все ID через запятую
                 'name': f'Заявки клиента ({len(all_leads)} шт.)',
                 'price': total_price,
-                'status_id': latest_lead.get('status_id'),
-                'pipeline_id': latest_lead.get('pipeline_id'),
-                'created_at': min(lead.get('created_at', 0) for lead in all_leads),
-                'updated_at': latest_lead.get('updated_at'),
+                'status_id': latest_lead.status_id,
+                'pipeline_id': latest_lead.pipeline_id,
+                'created_at': min(lead.created_at or 0 for lead in all_leads),
+                'updated_at': latest_lead.updated_at,
                 'count': len(all_leads)
             }
-            deals = [unified_deal]
+            # Названия статуса и воронки - из кеша справочников, без лишних запросов в AmoCRM
+            deals = await asyncio.to_thread(
+                amocrm_metadata.enrich, [unified_deal], os.environ.get('DATABASE_URL'), f'https://{amocrm_domain}', amocrm_token
+            )
         else:
             deals = []
         
@@ -224,6 +261,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    except retry_policy.UpstreamUnavailable as e:
+        # Не 404 и не пустой список: клиент должен понять, что это временно, и прийти позже
+        print(f'[GET-CLIENT-DEALS] AmoCRM недоступен: {e} {retry_policy.stats().get("amocrm")}')
+        return {
+            'statusCode': 503,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': e.retry_after
+            },
+            'body': json.dumps({'success': False, 'error': 'AmoCRM временно недоступен, повторите позже'}),
+            'isBase64Encoded': False
+        }
+    
     except Exception as e:
         return {
             'statusCode': 500,
@@ -0,0 +1,141 @@
+'''
+Фильтр Блума по телефонам из зеркала amocrm_clients: отсекает заведомо неизвестные
+номера до запроса в AmoCRM. Живёт в памяти тёплого экземпляра функции, раз в минуту
+дозагружает новые и изменённые строки по отметке updated_at и раз в час перестраивается целиком.
+Включается переменной окружения PHONE_PRECHECK_ENABLED=1.
+'''
+
+import hashlib
+import math
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+import psycopg2
+import phones
+
+TARGET_FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 10000
+REFRESH_INTERVAL_SECONDS = 60
+REBUILD_INTERVAL_SECONDS = 3600
+# Отметка дозагрузки отступает назад на это время: строка, изменённая транзакцией, которая
+# зафиксировалась позже начала прошлой дозагрузки, всё равно будет прочитана
+REFRESH_OVERLAP_SECONDS = 300
+
+PRECHECK_ENABLED = os.environ.get('PHONE_PRECHECK_ENABLED', '0') == '1'
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, false_positive_rate: float = TARGET_FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def expected_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+_state: Dict[str, Any] = {'filter': None, 'since': None, 'refreshed_at': 0.0, 'built_at': 0.0}
+_stats = {'checks': 0, 'rejected': 0, 'false_positives': 0}
+_lock = threading.Lock()
+
+
+def _load(database_url: str, rebuild: bool) -> None:
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # Время БД до чтения: следующая дозагрузка берёт строки, изменённые после него (с запасом)
+        cur.execute("SELECT LOCALTIMESTAMP - make_interval(secs => %s)", (REFRESH_OVERLAP_SECONDS,))
+        next_since = cur.fetchone()[0]
+        if rebuild:
+            cur.execute("SELECT COUNT(*) FROM t_p14771149_mfo_client_cabinet.amocrm_clients")
+            total = cur.fetchone()[0]
+            bloom = BloomFilter(max(MIN_CAPACITY, total * 2))
+        else:
+            bloom = _state['filter']
+        cur.close()
+
+        # Именованный курсор читает зеркало порциями, не держа весь список в памяти
+        stream = conn.cursor(name='phone_filter_load')
+        stream.itersize = 10000
+        if rebuild:
+            stream.execute("SELECT phone FROM t_p14771149_mfo_client_cabinet.amocrm_clients")
+        else:
+            # И новые строки, и строки с изменённым номером: иначе новый номер был бы ложно отсечён до перестройки
+            stream.execute(
+                "SELECT phone FROM t_p14771149_mfo_client_cabinet.amocrm_clients WHERE updated_at > %s",
+                (_state['since'],)
+            )
+        for (phone,) in stream:
+            normalized = phones.normalize(phone) if phone else ''
+            # Строки из перекрытия окна читаются повторно - уже учтённый номер не раздувает счётчик
+            if normalized and normalized not in bloom:
+                bloom.add(normalized)
+        stream.close()
+    finally:
+        conn.close()
+
+    now = time.monotonic()
+    _state.update({'filter': bloom, 'since': next_since, 'refreshed_at': now})
+    if rebuild:
+        _state['built_at'] = now
+
+
+def might_exist(phone: str, database_url: Optional[str]) -> bool:
+    '''False - номера точно нет в amocrm_clients; True - возможно есть или фильтр недоступен'''
+    if not PRECHECK_ENABLED or not database_url:
+        return True
+
+    with _lock:
+        try:
+            now = time.monotonic()
+            bloom = _state['filter']
+            if bloom is None or now - _state['built_at'] > REBUILD_INTERVAL_SECONDS or bloom.count > bloom.capacity:
+                _load(database_url, rebuild=True)
+            elif now - _state['refreshed_at'] > REFRESH_INTERVAL_SECONDS:
+                _load(database_url, rebuild=False)
+        except psycopg2.Error as e:
+            print(f'[PHONE-FILTER] Не удалось обновить фильтр: {e}')
+            if _state['filter'] is None:
+                return True
+
+        _stats['checks'] += 1
+        if phones.normalize(phone) in _state['filter']:
+            return True
+        _stats['rejected'] += 1
+        return False
+
+
+def record_false_positive() -> None:
+    '''Фильтр пропустил номер, которого не оказалось в AmoCRM'''
+    with _lock:
+        _stats['false_positives'] += 1
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        bloom = _state['filter']
+        result = dict(_stats)
+        unknown_seen = result['rejected'] + result['false_positives']
+        result['observed_false_positive_rate'] = round(result['false_positives'] / unknown_seen, 4) if unknown_seen else 0.0
+        result['expected_false_positive_rate'] = round(bloom.expected_false_positive_rate(), 6) if bloom else 0.0
+        result['phones'] = bloom.count if bloom else 0
+        result['size_bytes'] = len(bloom.bits) if bloom else 0
+    return result
@@ -0,0 +1,388 @@
+'''
+Business: Отправка очереди заявок lead_outbox в AmoCRM пачками, метрики очереди
+Args: event - dict с httpMethod (POST - отправить очередь, GET - глубина очереди и задержка отправки)
+             и заголовком X-Admin-Token; POST по расписанию из backend/schedules.json
+      context - объект с request_id, function_name
+Returns: HTTP response с результатом отправки или метриками очереди
+'''
+
+import hmac
+import json
+import os
+import time
+import requests
+import psycopg2
+import retry_policy
+from psycopg2.extras import RealDictCursor, execute_values
+from typing import Dict, Any, List, Optional, Tuple
+
+# AmoCRM принимает не более 250 сделок в одном POST /api/v4/leads
+LEADS_BATCH_SIZE = 250
+MAX_BATCHES_PER_RUN = 20
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+# Сколько запись считается захваченной дренером, прежде чем её подхватит следующий запуск
+SENDING_LEASE_SECONDS = 300
+
+
+class AmoCRMBatchError(Exception):
+    '''Ошибка отправки пачки в AmoCRM'''
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def get_amocrm_domain() -> str:
+    amocrm_subdomain = os.environ.get('AMOCRM_SUBDOMAIN', 'stepanmalik88')
+    if amocrm_subdomain.endswith('.amocrm.ru'):
+        return amocrm_subdomain
+    return f'{amocrm_subdomain}.amocrm.ru'
+
+
+def claim_batch(conn, limit: int) -> List[Dict[str, Any]]:
+    '''Захватывает пачку готовых к отправке записей, параллельные дренеры их пропустят'''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """UPDATE t_p14771149_mfo_client_cabinet.lead_outbox
+           SET status = 'sending', attempts = attempts + 1,
+               next_attempt_at = NOW() + make_interval(secs => %s)
+           WHERE id IN (
+               SELECT id FROM t_p14771149_mfo_client_cabinet.lead_outbox
+               WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+               ORDER BY next_attempt_at, id
+               LIMIT %s
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, phone, contact_name, lead_name, price, contact_id, attempts""",
+        (SENDING_LEASE_SECONDS, limit)
+    )
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    rows.sort(key=lambda row: row['id'])
+    return rows
+
+
+def resolve_contacts(rows: List[Dict[str, Any]], domain: str, headers: Dict[str, str], conn, deadline_at: float) -> None:
+    '''Находит или создаёт контакты для заявок из amocrm-create-deal, новые контакты создаются одним запросом'''
+    pending_by_phone: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        if row['contact_name'] and not row['contact_id']:
+            pending_by_phone.setdefault(row['phone'], []).append(row)
+
+    if not pending_by_phone:
+        return
+
+    contacts_url = f'https://{domain}/api/v4/contacts'
+    resolved: Dict[str, int] = {}
+
+    for phone in pending_by_phone:
+        search_response = retry_policy.call(
+            'amocrm',
+            lambda timeout: requests.get(contacts_url, headers=headers, params={'query': phone}, timeout=timeout),
+            deadline_at,
+            timeout=10,
+            retry_exceptions=(requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        )
+        if search_response.status_code == 200:
+            contacts = search_response.json().get('_embedded', {}).get('contacts', [])
+            if contacts:
+                resolved[phone] = contacts[0]['id']
+        elif search_response.status_code != 204:
+            raise AmoCRMBatchError(f'Поиск контакта: HTTP {search_response.status_code}', search_response.status_code)
+
+    missing = [phone for phone in pending_by_phone if phone not in resolved]
+    if missing:
+        contacts_data = [
+            {
+                'name': pending_by_phone[phone][0]['contact_name'],
+                'request_id': phone,
+                'custom_fields_values': [
+                    {
+                        'field_code': 'PHONE',
+                        'values': [{'value': phone, 'enum_code': 'WORK'}]
+                    }
+                ]
+            }
+            for phone in missing
+        ]
+        # Создание не идемпотентно: повтор только на 429 и если соединение не установилось
+        create_response = retry_policy.call(
+            'amocrm',
+            lambda timeout: requests.post(contacts_url, headers=headers, json=contacts_data, timeout=timeout),
+            deadline_at,
+            timeout=30,
+            idempotent=False,
+            retry_exceptions=(requests.exceptions.ConnectTimeout,)
+        )
+        if create_response.status_code not in [200, 201]:
+            raise AmoCRMBatchError(f'Создание контактов: HTTP {create_response.status_code}: {create_response.text[:500]}', create_response.status_code)
+        for contact in create_response.json().get('_embedded', {}).get('contacts', []):
+            resolved[str(contact.get('request_id'))] = contact['id']
+
+    updates = []
+    for phone, phone_rows in pending_by_phone.items():
+        contact_id = resolved.get(phone)
+        if not contact_id:
+            continue
+        for row in phone_rows:
+            row['contact_id'] = contact_id
+            updates.append((row['id'], contact_id))
+
+    # Запоминаем контакты сразу, чтобы повторная попытка не создала дубли
+    if updates:
+        cur = conn.cursor()
+        execute_values(
+            cur,
+            """UPDATE t_p14771149_mfo_client_cabinet.lead_outbox AS o
+               SET contact_id = v.contact_id
+               FROM (VALUES %s) AS v(id, contact_id)
+               WHERE o.id = v.id""",
+            updates
+        )
+        conn.commit()
+        cur.close()
+
+
+def post_leads(rows: List[Dict[str, Any]], domain: str, headers: Dict[str, str], deadline_at: float) -> Dict[int, int]:
+    '''Отправляет пачку сделок одним запросом, возвращает соответствие id очереди -> id сделки AmoCRM'''
+    leads_data = []
+    for row in rows:
+        lead = {
+            'name': row['lead_name'],
+            'price': int(row['price']),
+            'request_id': str(row['id'])
+        }
+        if row['contact_id']:
+            lead['_embedded'] = {'contacts': [{'id': row['contact_id']}]}
+        leads_data.append(lead)
+
+    response = retry_policy.call(
+        'amocrm',
+        lambda timeout: requests.post(f'https://{domain}/api/v4/leads', headers=headers, json=leads_data, timeout=timeout),
+        deadline_at,
+        timeout=30,
+        idempotent=False,
+        retry_exceptions=(requests.exceptions.ConnectTimeout,)
+    )
+    if response.status_code not in [200, 201]:
+        raise AmoCRMBatchError(f'HTTP {response.status_code}: {response.text[:500]}', response.status_code)
+
+    lead_ids: Dict[int, int] = {}
+    for lead in response.json().get('_embedded', {}).get('leads', []):
+        request_id = lead.get('request_id')
+        if request_id is not None and str(request_id).isdigit():
+            lead_ids[int(request_id)] = lead['id']
+    return lead_ids
+
+
+def send_rows(rows: List[Dict[str, Any]], domain: str, headers: Dict[str, str], deadline_at: float) -> Tuple[Dict[int, int], Dict[int, str]]:
+    '''Отправляет пачку; при 400 делит её пополам, чтобы одна битая заявка не держала остальные'''
+    try:
+        return post_leads(rows, domain, headers, deadline_at), {}
+    except AmoCRMBatchError as e:
+        if e.status_code == 400 and len(rows) > 1:
+            middle = len(rows) // 2
+            left_sent, left_errors = send_rows(rows[:middle], domain, headers, deadline_at)
+            right_sent, right_errors = send_rows(rows[middle:], domain, headers, deadline_at)
+            return {**left_sent, **right_sent}, {**left_errors, **right_errors}
+        return {}, {row['id']: str(e) for row in rows}
+
+
+def mark_sent(conn, lead_ids: Dict[int, int]) -> None:
+    cur = conn.cursor()
+    execute_values(
+        cur,
+        """UPDATE t_p14771149_mfo_client_cabinet.lead_outbox AS o
+           SET status = 'sent', amocrm_lead_id = v.lead_id, sent_at = NOW(), last_error = NULL
+           FROM (VALUES %s) AS v(id, lead_id)
+           WHERE o.id = v.id""",
+        list(lead_ids.items())
+    )
+    conn.commit()
+    cur.close()
+
+
+def mark_failed(conn, errors: Dict[int, str]) -> int:
+    '''Возвращает записи в очередь с экспоненциальной задержкой, исчерпавшие попытки помечает failed'''
+    cur = conn.cursor()
+    statuses = execute_values(
+        cur,
+        f"""UPDATE t_p14771149_mfo_client_cabinet.lead_outbox AS o
+            SET status = CASE WHEN o.attempts >= {MAX_ATTEMPTS} THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = NOW() + make_interval(secs => LEAST({BACKOFF_BASE_SECONDS} * POWER(2, o.attempts - 1), {BACKOFF_MAX_SECONDS})),
+                last_error = v.error
+            FROM (VALUES %s) AS v(id, error)
+            WHERE o.id = v.id
+            RETURNING o.status""",
+        list(errors.items()),
+        fetch=True
+    )
+    conn.commit()
+    cur.close()
+    return sum(1 for row in statuses if row[0] == 'failed')
+
+
+def drain(conn, domain: str, headers: Dict[str, str], deadline_at: float) -> Dict[str, Any]:
+    started = time.monotonic()
+    stats = {'batches': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+
+    for _ in range(MAX_BATCHES_PER_RUN):
+        # Пачку, которую не успеем отправить, не захватываем - её возьмёт следующий запуск
+        if time.monotonic() + retry_policy.MIN_ATTEMPT_SECONDS > deadline_at:
+            break
+        rows = claim_batch(conn, LEADS_BATCH_SIZE)
+        if not rows:
+            break
+        stats['batches'] += 1
+
+        try:
+            resolve_contacts(rows, domain, headers, conn, deadline_at)
+            lead_ids, errors = send_rows(rows, domain, headers, deadline_at)
+        except (AmoCRMBatchError, requests.exceptions.RequestException) as e:
+            lead_ids, errors = {}, {row['id']: str(e) for row in rows}
+
+        for row in rows:
+            if row['id'] not in lead_ids and row['id'] not in errors:
+                errors[row['id']] = 'AmoCRM не вернул сделку для request_id'
+
+        if lead_ids:
+            mark_sent(conn, lead_ids)
+            stats['sent'] += len(lead_ids)
+        if errors:
+            exhausted = mark_failed(conn, errors)
+            stats['failed'] += exhausted
+            stats['retried'] += len(errors) - exhausted
+            print(f"[OUTBOX] Ошибка отправки {len(errors)} заявок: {next(iter(errors.values()))}")
+            break
+
+    stats['duration_ms'] = int((time.monotonic() - started) * 1000)
+    stats['upstream'] = retry_policy.stats().get('amocrm', {})
+    return stats
+
+
+def purge_expired_idempotency_keys(conn, limit: int = 5000) -> int:
+    '''Удаляет просроченные ключи идемпотентности create-deal/amocrm-create-deal ограниченной пачкой'''
+    cur = conn.cursor()
+    cur.execute(
+        """DELETE FROM t_p14771149_mfo_client_cabinet.idempotency_keys
+           WHERE ctid IN (
+               SELECT ctid FROM t_p14771149_mfo_client_cabinet.idempotency_keys
+               WHERE expires_at <= NOW()
+               LIMIT %s
+           )""",
+        (limit,)
+    )
+    deleted = cur.rowcount
+    conn.commit()
+    cur.close()
+    return deleted
+
+
+def queue_metrics(conn) -> Dict[str, Any]:
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """SELECT COUNT(*) AS queue_depth,
+                  COUNT(*) FILTER (WHERE next_attempt_at <= NOW()) AS ready,
+                  EXTRACT(EPOCH FROM NOW() - MIN(created_at)) AS oldest_age_seconds
+           FROM t_p14771149_mfo_client_cabinet.lead_outbox
+           WHERE status IN ('pending', 'sending')"""
+    )
+    queue = cur.fetchone()
+    cur.execute(
+        """SELECT COUNT(*) AS sent,
+                  AVG(EXTRACT(EPOCH FROM sent_at - created_at)) AS avg_seconds,
+                  percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM sent_at - created_at)) AS p95_seconds
+           FROM t_p14771149_mfo_client_cabinet.lead_outbox
+           WHERE status = 'sent' AND sent_at > NOW() - INTERVAL '1 hour'"""
+    )
+    latency = cur.fetchone()
+    cur.close()
+
+    return {
+        'queue_depth': queue['queue_depth'],
+        'ready': queue['ready'],
+        'oldest_age_seconds': float(queue['oldest_age_seconds'] or 0),
+        'sent_last_hour': latency['sent'],
+        'drain_latency_avg_seconds': float(latency['avg_seconds'] or 0),
+        'drain_latency_p95_seconds': float(latency['p95_seconds'] or 0)
+    }
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method not in ['GET', 'POST']:
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Запуск отправки и метрики очереди - служебные, без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    amocrm_token = os.environ.get('AMOCRM_ACCESS_TOKEN', '')
+    if method == 'POST' and not amocrm_token:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'AmoCRM не настроен'}),
+            'isBase64Encoded': False
+        }
+
+    conn = psycopg2.connect(database_url)
+    try:
+        if method == 'GET':
+            result = queue_metrics(conn)
+        else:
+            headers = {
+                'Authorization': f'Bearer {amocrm_token}',
+                'Content-Type': 'application/json'
+            }
+            result = drain(conn, get_amocrm_domain(), headers, retry_policy.deadline(context))
+            result['expired_idempotency_keys'] = purge_expired_idempotency_keys(conn)
+            result.update(queue_metrics(conn))
+            print(f"[OUTBOX] {json.dumps(result)}")
+    finally:
+        conn.close()
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': True, **result}),
+        'isBase64Encoded': False
+    }
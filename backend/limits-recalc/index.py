@@ -0,0 +1,188 @@
+'''
+Business: Плановый пересчёт кредитных лимитов - текущий долг и доступный лимит по займам клиента
+Args: event - dict с httpMethod (POST - запустить пересчёт), body с необязательным full (true - все клиенты)
+             и заголовком X-Admin-Token; POST по расписанию из backend/schedules.json
+      context - объект с request_id, function_name
+Returns: HTTP response с числом проверенных клиентов, вставленных и обновлённых строк и длительностью
+'''
+
+import hmac
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any
+import psycopg2
+
+DEFAULT_MAX_LOAN_AMOUNT = 100000.00
+# Транзакция, начатая до прошлого запуска, могла зафиксировать updated_at чуть раньше его watermark.
+# Пересчёт идемпотентен, поэтому окно просто перекрываем с запасом.
+WATERMARK_OVERLAP_MINUTES = 10
+RECALC_LOCK_KEY = 'limits-recalc'
+
+CHANGED_CLIENTS_SQL = f"""
+    SELECT DISTINCT client_id FROM t_p14771149_mfo_client_cabinet.loans
+    WHERE client_id IS NOT NULL
+      AND updated_at > %(since)s::timestamp - INTERVAL '{WATERMARK_OVERLAP_MINUTES} minutes'"""
+
+ALL_CLIENTS_SQL = """
+    SELECT client_id FROM t_p14771149_mfo_client_cabinet.loans WHERE client_id IS NOT NULL
+    UNION
+    SELECT client_id FROM t_p14771149_mfo_client_cabinet.client_limits WHERE client_id IS NOT NULL"""
+
+# Долг - непогашенный остаток по активным займам. Одним оператором по всем затронутым клиентам;
+# строки, где долг и лимит не изменились, не переписываются (и не сбрасывают проекцию портфеля).
+RECALC_SQL = """
+    WITH changed AS ({changed}),
+    debt AS (
+        SELECT ch.client_id,
+               COALESCE(SUM(GREATEST(l.amount - COALESCE(l.paid_amount, 0), 0))
+                        FILTER (WHERE l.status = 'active'), 0) AS current_debt
+        FROM changed ch
+        LEFT JOIN t_p14771149_mfo_client_cabinet.loans l ON l.client_id = ch.client_id
+        GROUP BY ch.client_id
+    ),
+    upserted AS (
+        INSERT INTO t_p14771149_mfo_client_cabinet.client_limits AS cl
+            (client_id, max_loan_amount, current_debt, available_limit, updated_at)
+        SELECT client_id, %(default_max)s, current_debt, GREATEST(%(default_max)s - current_debt, 0), NOW()
+        FROM debt
+        ORDER BY client_id
+        ON CONFLICT ON CONSTRAINT unique_client_limit DO UPDATE SET
+            current_debt = EXCLUDED.current_debt,
+            available_limit = CASE WHEN cl.is_blocked THEN 0
+                                   ELSE GREATEST(COALESCE(cl.max_loan_amount, 0) - EXCLUDED.current_debt, 0) END,
+            updated_at = NOW()
+        WHERE cl.current_debt IS DISTINCT FROM EXCLUDED.current_debt
+           OR cl.available_limit IS DISTINCT FROM (
+               CASE WHEN cl.is_blocked THEN 0
+                    ELSE GREATEST(COALESCE(cl.max_loan_amount, 0) - EXCLUDED.current_debt, 0) END
+           )
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT (SELECT COUNT(*) FROM debt),
+           COUNT(*) FILTER (WHERE inserted),
+           COUNT(*) FILTER (WHERE NOT inserted)
+    FROM upserted"""
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Пересчёт всех клиентов - служебный запуск, без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        full = bool(body.get('full'))
+    except (ValueError, AttributeError):
+        full = False
+
+    started = time.monotonic()
+    started_at = datetime.now()
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # Блокировка на транзакцию: два пересчёта подряд безвредны, параллельные - лишняя нагрузка
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (RECALC_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Пересчёт уже выполняется'}, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
+
+        since = None
+        if not full:
+            cur.execute(
+                """SELECT watermark FROM t_p14771149_mfo_client_cabinet.client_limits_recalc_runs
+                   WHERE watermark IS NOT NULL ORDER BY id DESC LIMIT 1"""
+            )
+            row = cur.fetchone()
+            since = row[0] if row else None
+        mode = 'incremental' if since is not None else 'full'
+
+        # Watermark фиксируем до пересчёта: всё, что изменится позже, попадёт в следующий запуск
+        cur.execute("SELECT MAX(updated_at) FROM t_p14771149_mfo_client_cabinet.loans")
+        watermark = cur.fetchone()[0] or since
+
+        changed = CHANGED_CLIENTS_SQL if since is not None else ALL_CLIENTS_SQL
+        cur.execute(
+            RECALC_SQL.format(changed=changed),
+            {'since': since, 'default_max': DEFAULT_MAX_LOAN_AMOUNT}
+        )
+        clients_checked, rows_inserted, rows_updated = cur.fetchone()
+
+        duration_ms = int((time.monotonic() - started) * 1000)
+        cur.execute(
+            """INSERT INTO t_p14771149_mfo_client_cabinet.client_limits_recalc_runs
+               (mode, since_watermark, watermark, clients_checked, rows_inserted, rows_updated, duration_ms, started_at)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            (mode, since, watermark, clients_checked, rows_inserted, rows_updated, duration_ms, started_at)
+        )
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+    print(
+        f"[LIMITS-RECALC] mode={mode} since={since} watermark={watermark} clients={clients_checked} "
+        f"inserted={rows_inserted} updated={rows_updated} duration_ms={duration_ms}"
+    )
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'mode': mode,
+            'watermark': watermark.isoformat() if watermark else None,
+            'clients_checked': clients_checked,
+            'rows_inserted': rows_inserted,
+            'rows_updated': rows_updated,
+            'duration_ms': duration_ms
+        }),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,258 @@
+'''
+Business: Плановый расчёт по активным займам - начисленные проценты, ближайший платёж и просрочка
+Args: event - dict с httpMethod (POST - запустить расчёт), заголовком X-Admin-Token и body
+             с необязательным as_of (YYYY-MM-DD, не позже сегодняшнего дня);
+             вызывается по расписанию из backend/schedules.json
+      context - объект с request_id, function_name
+Returns: HTTP response с количеством обработанных займов и скоростью расчёта (займов в секунду)
+'''
+
+import hmac
+import json
+import os
+import time
+from datetime import date
+from typing import Dict, Any, List, Tuple
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+ACCRUAL_BATCH_SIZE = 10000
+# Ограничение времени одного запуска, чтобы не упереться в таймаут функции; недоделанное
+# доберёт следующий запуск - обработанные займы уже начислены по as_of и в выборку не попадут
+ACCRUAL_TIME_BUDGET_SECONDS = 20
+DAYS_IN_YEAR = 365
+# Займ без даты ближайшего платежа (NULL в next_payment_date)
+NO_DATE = np.iinfo(np.int32).min
+ACCRUAL_LOCK_KEY = 'loan-accrual'
+
+# Деньги приходят целыми копейками, ставка - сотыми долями процента, даты - днями от 1970-01-01:
+# дальше всё считается в массивах int64 без Decimal
+ACTIVE_LOANS_SQL = f"""
+    SELECT id,
+           ROUND(amount * 100)::bigint,
+           ROUND(COALESCE(paid_amount, 0) * 100)::bigint,
+           ROUND(COALESCE(rate, 0) * 100)::bigint,
+           ROUND(COALESCE(accrued_interest, 0) * 100)::bigint,
+           COALESCE(accrued_through, created_at::date, %(as_of)s::date) - DATE '1970-01-01',
+           COALESCE(created_at::date, %(as_of)s::date) - DATE '1970-01-01',
+           COALESCE(next_payment_date - DATE '1970-01-01', {NO_DATE})
+    FROM t_p14771149_mfo_client_cabinet.loans
+    WHERE status = 'active'
+      AND (accrued_through IS NULL OR accrued_through < %(as_of)s::date)
+      AND id > %(after_id)s
+    ORDER BY id
+    LIMIT %(limit)s"""
+
+# Один UPDATE на пачку: триггеры уровня оператора (портфель, сводки) срабатывают раз на пачку
+UPDATE_LOANS_SQL = """
+    UPDATE t_p14771149_mfo_client_cabinet.loans AS l SET
+        accrued_interest = v.accrued_kopecks / 100.0,
+        accrued_through = {as_of},
+        next_payment_date = DATE '1970-01-01' + v.next_payment_day,
+        days_overdue = v.days_overdue,
+        is_overdue = v.days_overdue > 0,
+        status = v.status,
+        updated_at = NOW()
+    FROM (VALUES %s) AS v(id, accrued_kopecks, next_payment_day, days_overdue, status)
+    WHERE l.id = v.id"""
+UPDATE_TEMPLATE = '(%s, %s::bigint, %s::integer, %s::integer, %s)'
+
+
+def add_month(days: np.ndarray) -> np.ndarray:
+    '''Та же дата через месяц; 31 января -> 28/29 февраля, как в графике платежей'''
+    dates = days.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    day_of_month = dates - months.astype('datetime64[D]')
+    next_month = months + 1
+    next_month_length = (next_month + 1).astype('datetime64[D]') - next_month.astype('datetime64[D]')
+    shifted = next_month.astype('datetime64[D]') + np.minimum(day_of_month, next_month_length - np.timedelta64(1, 'D'))
+    return shifted.astype(np.int64)
+
+
+def compute_accruals(rows: List[Tuple], as_of_day: int) -> Dict[str, np.ndarray]:
+    '''
+    Векторный расчёт по пачке: проценты за дни с прошлого начисления на остаток долга,
+    дата платежа для займов без графика, просрочка.
+
+    График - один платёж: к next_payment_date возвращается весь долг с процентами. Если дата
+    не задана, она ставится через месяц после выдачи; перенесённую дату (продление займа в CRM)
+    расчёт берёт как есть и сам не сдвигает. Просрочка - дни после этой даты, пока paid_amount
+    не покрыл сумму займа и начисленные проценты; частичная оплата её не снимает. Полностью
+    погашенные займы закрываются: проценты не начисляются, даты платежа и просрочки нет.
+    '''
+    data = np.array(rows, dtype=np.int64).reshape(-1, 8)
+    amount, paid, rate, accrued, accrued_from, created, next_payment = data[:, 1:].T
+
+    outstanding = np.maximum(amount - paid, 0)
+    days = np.maximum(as_of_day - accrued_from, 0)
+    # Остаток * ставка * дни может не поместиться в int64 для крупных сумм - произведение во float64,
+    # округление до копейки
+    interest = np.rint(outstanding * (rate / (100.0 * 100.0 * DAYS_IN_YEAR)) * days).astype(np.int64)
+    accrued = accrued + interest
+    # Погашен только основной долг - проценты больше не растут, но займ открыт до их оплаты
+    closed = paid >= amount + accrued
+
+    missing = next_payment == NO_DATE
+    next_payment = np.where(missing, add_month(created), next_payment)
+    days_overdue = np.where(closed, 0, np.maximum(as_of_day - next_payment, 0))
+
+    return {
+        'id': data[:, 0],
+        'accrued': accrued,
+        'next_payment': next_payment,
+        'days_overdue': days_overdue,
+        'closed': closed
+    }
+
+
+def write_back(cur, result: Dict[str, np.ndarray], as_of: date) -> None:
+    next_payment = np.where(result['closed'], NO_DATE, result['next_payment'])
+    values = [
+        (loan_id, accrued, None if day == NO_DATE else day, overdue, 'closed' if closed else 'active')
+        for loan_id, accrued, day, overdue, closed in zip(
+            result['id'].tolist(), result['accrued'].tolist(), next_payment.tolist(),
+            result['days_overdue'].tolist(), result['closed'].tolist()
+        )
+    ]
+    query = sql.SQL(UPDATE_LOANS_SQL).format(as_of=sql.Literal(as_of))
+    execute_values(cur, query, values, template=UPDATE_TEMPLATE, page_size=len(values))
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Расчёт меняет начисления по всем займам - без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+        as_of = date.fromisoformat(body['as_of']) if body.get('as_of') else date.today()
+    except (ValueError, TypeError, AttributeError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'as_of должен быть датой в формате YYYY-MM-DD'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    # Начисление вперёд не откатить: accrued_through уйдёт в будущее, и обычные запуски
+    # будут пропускать эти займы
+    if as_of > date.today():
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'as_of не может быть позже сегодняшнего дня'}, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    started = time.monotonic()
+    deadline = started + ACCRUAL_TIME_BUDGET_SECONDS
+    as_of_day = (as_of - date(1970, 1, 1)).days
+    processed = closed = overdue = 0
+    compute_seconds = 0.0
+    complete = False
+
+    conn = psycopg2.connect(database_url)
+    try:
+        cur = conn.cursor()
+        # Два параллельных запуска начислили бы проценты дважды за одни и те же дни
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (ACCRUAL_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            return {
+                'statusCode': 409,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'Расчёт уже выполняется'}, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
+
+        after_id = 0
+        while time.monotonic() < deadline:
+            cur.execute(ACTIVE_LOANS_SQL, {'as_of': as_of, 'after_id': after_id, 'limit': ACCRUAL_BATCH_SIZE})
+            rows = cur.fetchall()
+            if not rows:
+                complete = True
+                break
+
+            compute_started = time.monotonic()
+            result = compute_accruals(rows, as_of_day)
+            compute_seconds += time.monotonic() - compute_started
+
+            write_back(cur, result, as_of)
+            conn.commit()
+
+            processed += len(rows)
+            closed += int(result['closed'].sum())
+            overdue += int((result['days_overdue'] > 0).sum())
+            after_id = rows[-1][0]
+            if len(rows) < ACCRUAL_BATCH_SIZE:
+                complete = True
+                break
+
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (ACCRUAL_LOCK_KEY,))
+        cur.close()
+    finally:
+        conn.close()
+
+    duration = time.monotonic() - started
+    loans_per_second = int(processed / duration) if duration > 0 else 0
+    print(
+        f"[LOAN-ACCRUAL] as_of={as_of} processed={processed} closed={closed} overdue={overdue} "
+        f"complete={complete} duration_ms={int(duration * 1000)} compute_ms={int(compute_seconds * 1000)} "
+        f"loans_per_second={loans_per_second}"
+    )
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'as_of': as_of.isoformat(),
+            'processed': processed,
+            'closed': closed,
+            'overdue': overdue,
+            'complete': complete,
+            'duration_ms': int(duration * 1000),
+            'loans_per_second': loans_per_second
+        }),
+        'isBase64Encoded': False
+    }
@@ -8,10 +8,31 @@ Returns: HTTP response dict with MegaCRM API result
 import json
 import hashlib
 import os
-from typing import Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
 from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError, URLError
+import host_cache
+
+# TTL кэша GET-ответов по ресурсу (первый сегмент endpoint); остальные ресурсы не кэшируются
+CACHE_TTLS = {
+    '/deals': 30,
+    '/clients': 60
+}
+# Сколько после истечения TTL отдаём устаревший ответ, обновляя его в фоне
+STALE_WHILE_REVALIDATE_SECONDS = 120
+CACHE_MAX_ENTRIES = 500
+INFLIGHT_WAIT_SECONDS = 15
+
+# Кэш живёт в памяти тёплого экземпляра функции; при HOST_CACHE_PATH ответы ещё и делятся
+# между процессами сервера через host_cache
+_cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+_cache_lock = threading.Lock()
+_inflight: Dict[str, threading.Event] = {}
+_cache_stats = {'hits': 0, 'stale': 0, 'misses': 0, 'coalesced': 0, 'revalidated': 0}
 
 
 def generate_signature(method: str, query_string: str, body: str, api_key: str) -> str:
@@ -19,7 +40,7 @@ def generate_signature(method: str, query_string: str, body: str, api_key: str)
     return hashlib.md5(data.encode('utf-8')).hexdigest()
 
 
-def call_megacrm_api(endpoint: str, method: str, query_params: Dict[str, str], body: str, account_id: str, api_key: str) -> Dict[str, Any]:
+def call_megacrm_api(endpoint: str, method: str, query_params: Dict[str, str], body: str, account_id: str, api_key: str, extra_headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
     query_string = '?' + urlencode(query_params) if query_params else ''
     
     signature = generate_signature(method, query_string, body, api_key)
@@ -31,19 +52,25 @@ def call_megacrm_api(endpoint: str, method: str, query_params: Dict[str, str], b
         'X-MegaCrm-ApiSignature': signature,
         'Content-Type': 'application/json'
     }
+    if extra_headers:
+        headers.update(extra_headers)
     
     body_bytes = body.encode('utf-8') if body and method != 'GET' else None
     
     req = Request(url, data=body_bytes, headers=headers, method=method)
     
     try:
-        with urlopen(req) as response:
+        with urlopen(req, timeout=10) as response:
             response_data = response.read().decode('utf-8')
             return {
                 'status': response.status,
-                'data': json.loads(response_data)
+                'data': json.loads(response_data),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
             }
     except HTTPError as e:
+        if e.code == 304:
+            return {'status': 304, 'data': None}
         error_data = e.read().decode('utf-8')
         return {
             'status': e.code,
@@ -56,6 +83,169 @@ def call_megacrm_api(endpoint: str, method: str, query_params: Dict[str, str], b
         }
 
 
+def cache_ttl(endpoint: str) -> int:
+    resource = '/' + endpoint.strip('/').split('/')[0]
+    return CACHE_TTLS.get(resource, 0)
+
+
+def cache_key(account_id: str, endpoint: str, query_params: Dict[str, str]) -> str:
+    return f"{account_id}:{endpoint}?{urlencode(sorted(query_params.items()))}"
+
+
+def share_entry(key: str, endpoint: str, entry: Dict[str, Any]) -> None:
+    '''Кладёт ответ в общий кеш сервера; возраст переводится из monotonic в настенное время'''
+    if not host_cache.enabled():
+        return
+    shared = {name: entry.get(name) for name in ('status', 'data', 'etag', 'last_modified')}
+    shared['stored_at'] = time.time() - (time.monotonic() - entry['fetched_at'])
+    host_cache.put(key, shared, cache_ttl(endpoint) + STALE_WHILE_REVALIDATE_SECONDS)
+
+
+def adopt_shared(key: str) -> None:
+    '''Берёт ответ, полученный другим процессом сервера, если он свежее локального'''
+    shared = host_cache.get(key)
+    if shared is None:
+        return
+    entry = {name: shared.get(name) for name in ('status', 'data', 'etag', 'last_modified')}
+    entry['fetched_at'] = time.monotonic() - max(0.0, time.time() - shared['stored_at'])
+    with _cache_lock:
+        current = _cache.get(key)
+        if current is None or current['fetched_at'] < entry['fetched_at']:
+            _cache[key] = entry
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_MAX_ENTRIES:
+                _cache.popitem(last=False)
+
+
+def fetch_into_cache(key: str, endpoint: str, query_params: Dict[str, str], account_id: str, api_key: str) -> Dict[str, Any]:
+    '''Запрашивает MegaCRM (условно, если есть ETag/Last-Modified) и кладёт успешный ответ в кэш'''
+    with _cache_lock:
+        entry = _cache.get(key)
+    
+    validators = {}
+    if entry and entry.get('etag'):
+        validators['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        validators['If-Modified-Since'] = entry['last_modified']
+    
+    result = call_megacrm_api(endpoint, 'GET', query_params, '', account_id, api_key, validators)
+    
+    with _cache_lock:
+        if result['status'] == 304 and entry:
+            entry['fetched_at'] = time.monotonic()
+            _cache[key] = entry
+            _cache.move_to_end(key)
+            _cache_stats['revalidated'] += 1
+        elif result['status'] == 200:
+            result['fetched_at'] = time.monotonic()
+            _cache[key] = result
+            _cache.move_to_end(key)
+            while len(_cache) > CACHE_MAX_ENTRIES:
+                _cache.popitem(last=False)
+    
+    if result['status'] == 304 and entry:
+        share_entry(key, endpoint, entry)
+        return entry
+    if result['status'] == 200:
+        share_entry(key, endpoint, result)
+    return result
+
+
+def revalidate_in_background(key: str, endpoint: str, query_params: Dict[str, str], account_id: str, api_key: str, done: threading.Event) -> None:
+    try:
+        fetch_into_cache(key, endpoint, query_params, account_id, api_key)
+    except Exception as e:
+        print(f'[MEGACRM-PROXY] Background revalidation failed for {key}: {e}')
+    finally:
+        with _cache_lock:
+            _inflight.pop(key, None)
+        done.set()
+
+
+def cached_get(endpoint: str, query_params: Dict[str, str], account_id: str, api_key: str) -> Tuple[Dict[str, Any], str]:
+    '''GET через кэш: свежий ответ, устаревший с фоновым обновлением, или один запрос на ключ для всех ожидающих'''
+    ttl = cache_ttl(endpoint)
+    if not ttl:
+        return call_megacrm_api(endpoint, 'GET', query_params, '', account_id, api_key), 'BYPASS'
+    
+    key = cache_key(account_id, endpoint, query_params)
+    if host_cache.enabled():
+        with _cache_lock:
+            entry = _cache.get(key)
+        if entry is None or time.monotonic() - entry['fetched_at'] >= ttl:
+            adopt_shared(key)
+    
+    with _cache_lock:
+        entry = _cache.get(key)
+        age = time.monotonic() - entry['fetched_at'] if entry else None
+        if entry and age < ttl:
+            _cache.move_to_end(key)
+            _cache_stats['hits'] += 1
+            return entry, 'HIT'
+        
+        inflight = _inflight.get(key)
+        if entry and age < ttl + STALE_WHILE_REVALIDATE_SECONDS:
+            _cache_stats['stale'] += 1
+            if inflight is None:
+                done = threading.Event()
+                _inflight[key] = done
+                threading.Thread(
+                    target=revalidate_in_background,
+                    args=(key, endpoint, dict(query_params), account_id, api_key, done),
+                    daemon=True
+                ).start()
+            return entry, 'STALE'
+        
+        if inflight is None:
+            inflight = threading.Event()
+            _inflight[key] = inflight
+            is_leader = True
+        else:
+            is_leader = False
+    
+    if not is_leader:
+        # Тот же запрос уже выполняется - ждём его результат вместо второго обращения к MegaCRM
+        inflight.wait(INFLIGHT_WAIT_SECONDS)
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry and time.monotonic() - entry['fetched_at'] < ttl:
+                _cache_stats['coalesced'] += 1
+                return entry, 'HIT'
+        with _cache_lock:
+            _cache_stats['misses'] += 1
+        return call_megacrm_api(endpoint, 'GET', query_params, '', account_id, api_key), 'MISS'
+    
+    try:
+        with _cache_lock:
+            _cache_stats['misses'] += 1
+        return fetch_into_cache(key, endpoint, query_params, account_id, api_key), 'MISS'
+    finally:
+        with _cache_lock:
+            _inflight.pop(key, None)
+        inflight.set()
+
+
+def invalidate_cache(account_id: str, endpoint: str) -> None:
+    '''Сбрасывает кэш ресурса после изменяющего запроса через прокси'''
+    resource = '/' + endpoint.strip('/').split('/')[0]
+    prefix = f"{account_id}:{resource}"
+    with _cache_lock:
+        for key in [k for k in _cache if k.startswith(prefix)]:
+            del _cache[key]
+    host_cache.delete_prefix(prefix)
+
+
+def cache_stats() -> Dict[str, Any]:
+    with _cache_lock:
+        stats = dict(_cache_stats)
+        stats['entries'] = len(_cache)
+    served_from_cache = stats['hits'] + stats['coalesced'] + stats['stale']
+    total = served_from_cache + stats['misses']
+    stats['hit_ratio'] = round(served_from_cache / total, 4) if total else 0.0
+    stats['host'] = host_cache.stats()
+    return stats
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -88,15 +278,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     query_params = event.get('queryStringParameters', {}) or {}
     endpoint = query_params.pop('endpoint', '/deals')
     
-    request_body = event.get('body', '')
+    if endpoint == '/_cache/stats':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps(cache_stats())
+        }
+    
+    request_body = event.get('body', '') or ''
     
-    result = call_megacrm_api(endpoint, method, query_params, request_body, account_id, api_key)
+    if method == 'GET':
+        result, cache_status = cached_get(endpoint, query_params, account_id, api_key)
+    else:
+        result = call_megacrm_api(endpoint, method, query_params, request_body, account_id, api_key)
+        cache_status = 'BYPASS'
+        invalidate_cache(account_id, endpoint)
     
     return {
         'statusCode': result['status'],
         'headers': {
             'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            'X-Cache': cache_status
         },
         'isBase64Encoded': False,
         'body': json.dumps(result['data'])
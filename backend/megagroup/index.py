@@ -4,12 +4,24 @@ Args: event - dict с httpMethod, queryStringParameters (phone)
       context - объект с атрибутами request_id, function_name
 Returns: HTTP response с данными клиента и заказами
 '''
+import asyncio
 import json
 import os
-import requests
-from typing import Dict, Any, Optional, List
+import random
+from typing import Dict, Any, Optional, List, Iterable, Iterator
+import aio
+import phones
+import retry_policy
 from pydantic import BaseModel, Field
 
+MEGACRM_API_URL = 'https://api.megacrm.ru/v1'
+ORDERS_PAGE_SIZE = 100
+ORDERS_MAX_PAGES = 200
+ORDERS_FETCH_WORKERS = 6
+
+# Доля запросов, для которых пишется подробный трейс (MEGAGROUP_TRACE_SAMPLE_RATE=0.01 - 1%)
+TRACE_SAMPLE_RATE = float(os.environ.get('MEGAGROUP_TRACE_SAMPLE_RATE', '0') or 0)
+
 class MegagroupClient(BaseModel):
     id: str
     name: str
@@ -28,6 +40,18 @@ class MegagroupOrder(BaseModel):
     items_count: int
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    result = aio.run(handler_async(event, context))
+    # Платформа принимает тело только строкой
+    if not isinstance(result.get('body'), str):
+        result['body'] = ''.join(result['body'])
+    return result
+
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Та же функция для асинхронного рантайма: пока ждём MegaCRM, процесс обслуживает другие запросы.
+    Тело ответа 200 - итератор частей JSON: selfhost (AsyncRuntime) отдаёт его клиенту по мере
+    сериализации, не собирая целиком.
+    '''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -65,7 +89,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'success': False, 'error': 'Phone number required'})
             }
         
-        client_data = get_client_by_phone(api_key, account_id, phone)
+        trace = random.random() < TRACE_SAMPLE_RATE
+        deadline_at = retry_policy.deadline(context)
+        try:
+            client_data = await get_client_by_phone(api_key, account_id, phone, deadline_at, trace)
+            orders = await get_client_orders(api_key, account_id, client_data['id'], deadline_at, trace) if client_data else []
+        except retry_policy.UpstreamUnavailable as e:
+            # 429/5xx MegaCRM после повторов - не "клиент не найден" и не заказы с пропущенными страницами
+            print(f'[MEGAGROUP] MegaCRM недоступна: {e} {retry_policy.stats().get("megacrm")}')
+            return {
+                'statusCode': 503,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                    'Retry-After': e.retry_after
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'success': False, 'error': 'MegaCRM temporarily unavailable, retry later'})
+            }
         
         if not client_data:
             return {
@@ -75,17 +116,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'body': json.dumps({'success': False, 'not_found': True, 'error': 'Client not found'})
             }
         
-        orders = get_client_orders(api_key, account_id, client_data['id'])
-        
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'isBase64Encoded': False,
-            'body': json.dumps({
-                'success': True,
-                'client': client_data,
-                'orders': orders
-            })
+            'body': iter_response_body(client_data, orders)
         }
     
     return {
@@ -95,32 +130,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({'success': False, 'error': 'Method not allowed'})
     }
 
-def get_client_by_phone(api_key: str, account_id: str, phone: str) -> Optional[Dict[str, Any]]:
-    clean_phone = ''.join(filter(str.isdigit, phone))
-    print(f'[DEBUG] Searching for phone: {clean_phone}')
-    
-    query_string = f'query={clean_phone}'
-    
-    print(f'[DEBUG] Account ID: {account_id}')
-    print(f'[DEBUG] API Key: {api_key[:10]}...')
-    
-    headers = {
+def trace_log(trace: bool, message: str) -> None:
+    if trace:
+        print(f'[TRACE] {message}')
+
+def megacrm_headers(api_key: str, account_id: str) -> Dict[str, str]:
+    return {
         'X-MegaCrm-ApiAccount': account_id,
         'X-MegaCrm-ApiKey': api_key,
         'Content-Type': 'application/json'
     }
+
+async def get_client_by_phone(api_key: str, account_id: str, phone: str, deadline_at: float, trace: bool = False) -> Optional[Dict[str, Any]]:
+    clean_phone = phones.normalize(phone)
+    trace_log(trace, f'Searching for phone: {clean_phone[:4]}***')
     
-    url = f'https://api.megacrm.ru/v1/clients?{query_string}'
-    print(f'[DEBUG] API URL: {url}')
-    
-    response = requests.get(url, headers=headers, timeout=10)
-    print(f'[DEBUG] Response status: {response.status_code}')
-    print(f'[DEBUG] Response body: {response.text[:500]}')
+    response = await aio.request(
+        'megacrm', 'GET', f'{MEGACRM_API_URL}/clients', deadline_at,
+        headers=megacrm_headers(api_key, account_id),
+        params={'query': clean_phone}
+    )
+    trace_log(trace, f'Clients response status: {response.status_code}')
     
     if response.status_code == 200:
         data = response.json()
         result = data.get('result', [])
-        print(f'[DEBUG] Result count: {len(result)}')
+        trace_log(trace, f'Result count: {len(result)}')
         if result and len(result) > 0:
             client = result[0]
             full_name = f"{client.get('name', '')} {client.get('last_name', '')}".strip()
@@ -136,33 +171,71 @@ def get_client_by_phone(api_key: str, account_id: str, phone: str) -> Optional[D
     
     return None
 
-def get_client_orders(api_key: str, account_id: str, client_id: str) -> List[Dict[str, Any]]:
-    query_string = f'client_id={client_id}'
-    
-    headers = {
-        'X-MegaCrm-ApiAccount': account_id,
-        'X-MegaCrm-ApiKey': api_key,
-        'Content-Type': 'application/json'
+def map_order(deal: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'id': str(deal.get('id', '')),
+        'number': str(deal.get('ui_id', deal.get('id', ''))),
+        'date': deal.get('created', ''),
+        'status': deal.get('stage', {}).get('name', 'Неизвестно') if isinstance(deal.get('stage'), dict) else 'В работе',
+        'total': 0.0,
+        'items_count': 0,
+        'title': deal.get('title', 'Сделка')
     }
+
+async def fetch_orders_page(api_key: str, account_id: str, client_id: str, offset: int, deadline_at: float) -> Dict[str, Any]:
+    response = await aio.request(
+        'megacrm', 'GET', f'{MEGACRM_API_URL}/deals', deadline_at,
+        headers=megacrm_headers(api_key, account_id),
+        params={'client_id': client_id, 'limit': ORDERS_PAGE_SIZE, 'offset': offset}
+    )
+    if response.status_code != 200:
+        return {}
+    return response.json()
+
+async def get_client_orders(api_key: str, account_id: str, client_id: str, deadline_at: float, trace: bool = False) -> List[Dict[str, Any]]:
+    '''Заказы клиента постранично: после первой страницы известен total, остальные грузятся параллельно'''
+    first_page = await fetch_orders_page(api_key, account_id, client_id, 0, deadline_at)
+    first_result = first_page.get('result', [])
+    orders = [map_order(deal) for deal in first_result]
     
-    url = f'https://api.megacrm.ru/v1/deals?{query_string}'
+    total = first_page.get('total', first_page.get('count'))
+    trace_log(trace, f'Orders page 0: {len(first_result)} of {total}')
     
-    response = requests.get(url, headers=headers, timeout=10)
+    if len(first_result) < ORDERS_PAGE_SIZE:
+        return orders
     
-    if response.status_code == 200:
-        data = response.json()
-        result = data.get('result', [])
-        orders = []
-        for deal in result:
-            orders.append({
-                'id': str(deal.get('id', '')),
-                'number': str(deal.get('ui_id', deal.get('id', ''))),
-                'date': deal.get('created', ''),
-                'status': deal.get('stage', {}).get('name', 'Неизвестно') if isinstance(deal.get('stage'), dict) else 'В работе',
-                'total': 0.0,
-                'items_count': 0,
-                'title': deal.get('title', 'Сделка')
-            })
+    if total is None:
+        # Без total страницы можно идти только последовательно до неполной
+        offset = len(first_result)
+        for _ in range(ORDERS_MAX_PAGES - 1):
+            page_result = (await fetch_orders_page(api_key, account_id, client_id, offset, deadline_at)).get('result', [])
+            orders.extend(map_order(deal) for deal in page_result)
+            if len(page_result) < ORDERS_PAGE_SIZE:
+                break
+            offset += len(page_result)
         return orders
     
-    return []
\ No newline at end of file
+    offsets = list(range(ORDERS_PAGE_SIZE, int(total), ORDERS_PAGE_SIZE))[:ORDERS_MAX_PAGES - 1]
+    # Не больше ORDERS_FETCH_WORKERS страниц одного клиента в полёте одновременно
+    semaphore = asyncio.Semaphore(ORDERS_FETCH_WORKERS)
+    
+    async def fetch_page(offset: int) -> Dict[str, Any]:
+        async with semaphore:
+            return await fetch_orders_page(api_key, account_id, client_id, offset, deadline_at)
+    
+    # gather сохраняет порядок страниц
+    pages = await asyncio.gather(*(fetch_page(offset) for offset in offsets))
+    for offset, page in zip(offsets, pages):
+        page_result = page.get('result', [])
+        trace_log(trace, f'Orders page {offset // ORDERS_PAGE_SIZE}: {len(page_result)}')
+        orders.extend(map_order(deal) for deal in page_result)
+    return orders
+
+def iter_response_body(client_data: Dict[str, Any], orders: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    '''JSON ответа по частям: заказы сериализуются по одному, без промежуточной копии'''
+    yield '{"success": true, "client": '
+    yield json.dumps(client_data)
+    yield ', "orders": ['
+    for index, order in enumerate(orders):
+        yield (', ' if index else '') + json.dumps(order)
+    yield ']}'
@@ -1,17 +1,146 @@
+import asyncio
 import json
 import os
-import urllib.request
+import hmac
+import hashlib
+import secrets
 import urllib.parse
-import urllib.error
-from typing import Dict, Any
-import random
+from typing import Dict, Any, Optional, Set
+import httpx
+import aio
+import phone_filter
+import phones
+import retry_policy
+
+SMS_CODE_TTL_MINUTES = 10
+SMS_MAX_VERIFY_ATTEMPTS = 5
+# Скользящее окно отправок: не чаще раза в минуту и не более 5 SMS в час на номер, 20 в час на IP
+SEND_WINDOW_SECONDS = 3600
+PHONE_SENDS_PER_WINDOW = 5
+IP_SENDS_PER_WINDOW = 20
+PHONE_RESEND_INTERVAL_SECONDS = 60
+# Запуск sms-outbox-drain идёт в фоне и ответ на запрос кода не задерживает; таймаут лишь
+# ограничивает сам фоновый вызов (пачка SMS.ru и проверка статусов укладываются с запасом)
+SMS_DRAIN_KICK_TIMEOUT_SECONDS = 30
+
+# Ссылки на фоновые запуски дренера, чтобы задачи не собрал сборщик мусора до завершения
+_drain_kicks: Set[asyncio.Task] = set()
+
+def hash_code(phone: str, code: str, secret: str) -> str:
+    return hmac.new(secret.encode(), f'{phone}:{code}'.encode(), hashlib.sha256).hexdigest()
+
+def get_source_ip(event: Dict[str, Any]) -> str:
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    source_ip = identity.get('sourceIp') or ''
+    if not source_ip:
+        request_headers = event.get('headers') or {}
+        forwarded = request_headers.get('X-Forwarded-For') or request_headers.get('x-forwarded-for') or ''
+        source_ip = forwarded.split(',')[0].strip()
+    return source_ip[:45]
+
+async def acquire_send_slot(conn, phone: str, source_ip: str) -> bool:
+    '''
+    Одним upsert сдвигает скользящие окна номера и IP. Строка, у которой окно исчерпано,
+    не обновляется и не возвращается - тогда транзакция откатывается целиком.
+    '''
+    limit_keys = [f'phone:{phone}']
+    if source_ip:
+        limit_keys.append(f'ip:{source_ip}')
+    values_sql = ', '.join(f'(${index}, ARRAY[LOCALTIMESTAMP], LOCALTIMESTAMP)' for index in range(1, len(limit_keys) + 1))
+    first = len(limit_keys) + 1
+    
+    transaction = conn.transaction()
+    await transaction.start()
+    acquired = False
+    try:
+        rows = await conn.fetch(
+            f"""INSERT INTO t_p14771149_mfo_client_cabinet.sms_send_limits AS l (limit_key, send_times, updated_at) 
+                VALUES {values_sql} 
+                ON CONFLICT (limit_key) DO UPDATE 
+                SET send_times = ARRAY(
+                        SELECT t FROM unnest(l.send_times) AS t 
+                        WHERE t > LOCALTIMESTAMP - make_interval(secs => ${first})
+                    ) || LOCALTIMESTAMP, 
+                    updated_at = LOCALTIMESTAMP 
+                WHERE (
+                        SELECT COUNT(*) FROM unnest(l.send_times) AS t 
+                        WHERE t > LOCALTIMESTAMP - make_interval(secs => ${first})
+                    ) < CASE WHEN l.limit_key LIKE 'ip:%' THEN ${first + 1}::int ELSE ${first + 2}::int END 
+                  AND (l.limit_key LIKE 'ip:%' OR l.updated_at <= LOCALTIMESTAMP - make_interval(secs => ${first + 3})) 
+                RETURNING limit_key""",
+            *limit_keys, SEND_WINDOW_SECONDS, IP_SENDS_PER_WINDOW, PHONE_SENDS_PER_WINDOW, PHONE_RESEND_INTERVAL_SECONDS
+        )
+        acquired = len(rows) == len(limit_keys)
+    finally:
+        if acquired:
+            await transaction.commit()
+        else:
+            await transaction.rollback()
+    return acquired
+
+async def store_code(conn, phone: str, code_hash: str, client_name: str, client_id: Any) -> None:
+    await conn.execute(
+        """INSERT INTO t_p14771149_mfo_client_cabinet.sms_codes 
+           (phone, code, code_hash, attempts, client_name, client_id, expires_at, created_at) 
+           VALUES ($1, NULL, $2, 0, $3, $4, NOW() + make_interval(mins => $5), NOW()) 
+           ON CONFLICT (phone) DO UPDATE 
+           SET code = NULL, code_hash = EXCLUDED.code_hash, attempts = 0, 
+               client_name = EXCLUDED.client_name, client_id = EXCLUDED.client_id, 
+               expires_at = EXCLUDED.expires_at, created_at = NOW()""",
+        phone, code_hash, client_name, str(client_id) if client_id is not None else None, SMS_CODE_TTL_MINUTES
+    )
+
+async def enqueue_sms(conn, phone: str, message: str) -> None:
+    await conn.execute(
+        """INSERT INTO t_p14771149_mfo_client_cabinet.sms_outbox (source, phone, message) 
+           VALUES ('sms-auth', $1, $2)""",
+        phone, message
+    )
+
+async def kick_sms_drain() -> None:
+    '''Запускает sms-outbox-drain сразу, чтобы код не ждал планового запуска из backend/schedules.json'''
+    drain_url = os.environ.get('SMS_OUTBOX_DRAIN_URL')
+    admin_token = os.environ.get('ADMIN_API_TOKEN')
+    if not drain_url or not admin_token:
+        return
+    try:
+        response = await aio.http().post(
+            drain_url, headers={'X-Admin-Token': admin_token}, timeout=SMS_DRAIN_KICK_TIMEOUT_SECONDS
+        )
+        if response.status_code != 200:
+            print(f'[SMS-AUTH] sms-outbox-drain ответил {response.status_code}, SMS уйдёт по расписанию')
+    except httpx.HTTPError as e:
+        # Код уже в очереди: не дождались дренера - его отправит следующий плановый запуск
+        print(f'[SMS-AUTH] Не удалось запустить sms-outbox-drain: {e!r}')
+
+def start_sms_drain_kick() -> None:
+    '''Запускает kick_sms_drain в фоновом цикле aio, не дожидаясь ответа дренера'''
+    task = asyncio.ensure_future(kick_sms_drain())
+    _drain_kicks.add(task)
+    task.add_done_callback(_drain_kicks.discard)
+
+async def consume_attempt(conn, phone: str) -> Optional[Dict[str, Any]]:
+    '''Атомарно списывает попытку ввода; None - кода нет, он истёк или попытки исчерпаны'''
+    record = await conn.fetchrow(
+        """UPDATE t_p14771149_mfo_client_cabinet.sms_codes 
+           SET attempts = attempts + 1 
+           WHERE phone = $1 AND code_hash IS NOT NULL AND expires_at > NOW() AND attempts < $2 
+           RETURNING code_hash, attempts, client_name, client_id""",
+        phone, SMS_MAX_VERIFY_ATTEMPTS
+    )
+    return dict(record) if record else None
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Отправка SMS-кода для авторизации через sms.ru с проверкой в AmoCRM
+    Business: Отправка SMS-кода для авторизации через sms.ru с проверкой в AmoCRM,
+              код хранится хешем в sms_codes, отправки ограничены по номеру и IP
     Args: event с httpMethod, body содержит phone или phone+code для проверки
     Returns: JSON с результатом отправки или проверки SMS
     '''
+    return aio.run(handler_async(event, context))
+
+async def handler_async(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''Та же функция для асинхронного рантайма: Postgres через asyncpg, AmoCRM через общий httpx-клиент'''
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
@@ -39,6 +168,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     api_key = os.environ.get('SMSRU_API_KEY')
+    database_url = os.environ.get('DATABASE_URL')
     amocrm_token = os.environ.get('AMOCRM_ACCESS_TOKEN')
     amocrm_subdomain = os.environ.get('AMOCRM_SUBDOMAIN', 'stepanmalik88')
     
@@ -68,6 +198,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({'error': 'DATABASE_URL not configured'}),
+            'isBase64Encoded': False
+        }
+    
+    code_secret = os.environ.get('SMS_CODE_SECRET') or api_key
+    
     try:
         body_data = json.loads(event.get('body', '{}'))
         phone = body_data.get('phone', '')
@@ -87,9 +230,43 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        clean_phone = phone.replace('+', '').replace(' ', '').replace('(', '').replace(')', '').replace('-', '')
+        clean_phone = phones.normalize(phone)
+        # Соединение берётся из пула только на время запроса к БД и не держится, пока ждём AmoCRM
+        pool = await aio.db_pool(database_url)
         
         if action == 'send':
+            # Лимит отправок проверяется до обращения к AmoCRM и SMS.ru
+            async with pool.acquire() as conn:
+                acquired = await acquire_send_slot(conn, clean_phone, get_source_ip(event))
+            if not acquired:
+                print(f'[SMS-AUTH] Превышен лимит отправок: {clean_phone[:4]}***')
+                return {
+                    'statusCode': 429,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Retry-After': str(PHONE_RESEND_INTERVAL_SECONDS)
+                    },
+                    'body': json.dumps({'error': 'Слишком много запросов кода. Попробуйте позже.'}),
+                    'isBase64Encoded': False
+                }
+            
+            # Номера, которых точно нет в зеркале amocrm_clients, отсекаем без запроса в AmoCRM
+            if not await asyncio.to_thread(phone_filter.might_exist, clean_phone, database_url):
+                print(f'[SMS-AUTH] Номер отсечён фильтром: {clean_phone[:4]}*** {phone_filter.stats()}')
+                return {
+                    'statusCode': 404,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': 'Клиент с таким номером не найден в системе. Обратитесь в поддержку.',
+                        'not_found': True
+                    }),
+                    'isBase64Encoded': False
+                }
+            
             print(f'[SMS-AUTH] Проверка клиента в AmoCRM: {clean_phone}')
             
             # Поиск контакта в AmoCRM по телефону
@@ -107,17 +284,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
             
             try:
-                req = urllib.request.Request(full_url, headers=headers)
-                
-                with urllib.request.urlopen(req, timeout=10) as response:
-                    response_text = response.read().decode()
-                    print(f'[SMS-AUTH] Ответ AmoCRM: {response_text[:200]}...')
-                    contacts_data = json.loads(response_text)
+                response = await aio.request('amocrm', 'GET', full_url, retry_policy.deadline(context), headers=headers)
+                response.raise_for_status()
+                print(f'[SMS-AUTH] Ответ AmoCRM: {response.text[:200]}...')
+                # Ничего не найдено - AmoCRM отвечает 204 без тела
+                contacts_data = response.json() if response.status_code != 204 else {}
                 
                 contacts = contacts_data.get('_embedded', {}).get('contacts', [])
                 
                 if not contacts:
                     print(f'[SMS-AUTH] Клиент не найден в AmoCRM: {clean_phone}')
+                    if phone_filter.PRECHECK_ENABLED:
+                        phone_filter.record_false_positive()
+                        print(f'[SMS-AUTH] Ложное срабатывание фильтра: {phone_filter.stats()}')
                     return {
                         'statusCode': 404,
                         'headers': {
@@ -136,113 +315,103 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 client_id = contact.get('id')
                 print(f'[SMS-AUTH] Клиент найден в AmoCRM: {client_name} (ID: {client_id})')
                 
-            except urllib.error.HTTPError as e:
-                error_body = e.read().decode()
-                print(f'[SMS-AUTH] HTTP Error {e.code}: {error_body}')
+            except retry_policy.UpstreamUnavailable as e:
+                # AmoCRM перегружена: не "ошибка проверки", а просьба повторить позже
+                print(f'[SMS-AUTH] AmoCRM недоступна: {e} {retry_policy.stats().get("amocrm")}')
                 return {
-                    'statusCode': 500,
+                    'statusCode': 503,
                     'headers': {
                         'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
+                        'Access-Control-Allow-Origin': '*',
+                        'Retry-After': e.retry_after
                     },
-                    'body': json.dumps({'error': f'Ошибка проверки данных в AmoCRM: {e.code}'}),
+                    'body': json.dumps({'error': 'AmoCRM временно недоступен, повторите позже'}),
                     'isBase64Encoded': False
                 }
-            except Exception as e:
-                print(f'[SMS-AUTH] Ошибка проверки AmoCRM: {e}')
+            except httpx.HTTPStatusError as e:
+                print(f'[SMS-AUTH] HTTP Error {e.response.status_code}: {e.response.text}')
                 return {
                     'statusCode': 500,
                     'headers': {
                         'Content-Type': 'application/json',
                         'Access-Control-Allow-Origin': '*'
                     },
-                    'body': json.dumps({'error': 'Ошибка проверки данных в AmoCRM'}),
+                    'body': json.dumps({'error': f'Ошибка проверки данных в AmoCRM: {e.response.status_code}'}),
                     'isBase64Encoded': False
                 }
-            
-            # Генерация и отправка SMS-кода
-            sms_code = str(random.randint(1000, 9999))
-            print(f'[SMS-AUTH] Генерирован код: {sms_code}')
-            
-            message = f'Ваш код для входа: {sms_code}'
-            
-            try:
-                params = urllib.parse.urlencode({
-                    'api_id': api_key,
-                    'to': clean_phone,
-                    'msg': message,
-                    'json': 1
-                })
-                
-                sms_url = f'https://sms.ru/sms/send?{params}'
-                print(f'[SMS-AUTH] Отправка SMS на {clean_phone}')
-                
-                req = urllib.request.Request(sms_url)
-                
-                with urllib.request.urlopen(req, timeout=10) as response:
-                    result = json.loads(response.read().decode())
-                
-                print(f'[SMS-AUTH] Ответ SMS.ru: {result}')
-            
-            except Exception as sms_error:
-                print(f'[SMS-AUTH] Ошибка отправки SMS: {sms_error}')
+            except Exception as e:
+                print(f'[SMS-AUTH] Ошибка проверки AmoCRM: {e}')
                 return {
                     'statusCode': 500,
                     'headers': {
                         'Content-Type': 'application/json',
                         'Access-Control-Allow-Origin': '*'
                     },
-                    'body': json.dumps({'error': f'Ошибка отправки SMS: {str(sms_error)}'}),
+                    'body': json.dumps({'error': 'Ошибка проверки данных в AmoCRM'}),
                     'isBase64Encoded': False
                 }
             
-            if result.get('status') == 'OK':
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'application/json',
-                        'Access-Control-Allow-Origin': '*'
-                    },
-                    'body': json.dumps({
-                        'success': True,
-                        'message': 'SMS отправлена',
-                        'code': sms_code,
-                        'phone': clean_phone,
-                        'client_name': client_name,
-                        'client_id': client_id
-                    }),
-                    'isBase64Encoded': False
-                }
-            else:
+            # Код сохраняется хешем, SMS уходит в очередь - её сразу отправляет sms-outbox-drain, запущенный в фоне
+            sms_code = str(secrets.randbelow(9000) + 1000)
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await store_code(conn, clean_phone, hash_code(clean_phone, sms_code, code_secret), client_name, client_id)
+                    await enqueue_sms(conn, clean_phone, f'Ваш код для входа: {sms_code}')
+            print(f'[SMS-AUTH] SMS поставлена в очередь: {clean_phone[:4]}***')
+            start_sms_drain_kick()
+            
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'success': True,
+                    'message': 'SMS отправлена',
+                    'expiresIn': SMS_CODE_TTL_MINUTES * 60,
+                    'phone': clean_phone,
+                    'client_name': client_name,
+                    'client_id': client_id
+                }),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'verify':
+            if not code:
                 return {
                     'statusCode': 400,
                     'headers': {
                         'Content-Type': 'application/json',
                         'Access-Control-Allow-Origin': '*'
                     },
-                    'body': json.dumps({
-                        'error': f'Ошибка отправки SMS: {result.get("status_text", "Неизвестная ошибка")}'
-                    }),
+                    'body': json.dumps({'error': 'Code required'}),
                     'isBase64Encoded': False
                 }
-        
-        elif action == 'verify':
-            stored_code = body_data.get('stored_code', '')
             
-            if not code or not stored_code:
+            async with pool.acquire() as conn:
+                record = await consume_attempt(conn, clean_phone)
+            
+            if not record:
                 return {
                     'statusCode': 400,
                     'headers': {
                         'Content-Type': 'application/json',
                         'Access-Control-Allow-Origin': '*'
                     },
-                    'body': json.dumps({'error': 'Code and stored_code required'}),
+                    'body': json.dumps({
+                        'error': 'Код истёк или превышено число попыток. Запросите новый код',
+                        'verified': False
+                    }),
                     'isBase64Encoded': False
                 }
             
-            if code == stored_code:
-                stored_name = body_data.get('client_name', 'Клиент')
-                client_id = body_data.get('client_id', '')
+            if hmac.compare_digest(record['code_hash'], hash_code(clean_phone, str(code), code_secret)):
+                async with pool.acquire() as conn:
+                    await conn.execute(
+                        "DELETE FROM t_p14771149_mfo_client_cabinet.sms_codes WHERE phone = $1",
+                        clean_phone
+                    )
                 return {
                     'statusCode': 200,
                     'headers': {
@@ -252,8 +421,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({
                         'success': True,
                         'verified': True,
-                        'client_name': stored_name,
-                        'client_id': client_id
+                        'client_name': record['client_name'] or 'Клиент',
+                        'client_id': record['client_id'] or ''
                     }),
                     'isBase64Encoded': False
                 }
@@ -266,7 +435,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     },
                     'body': json.dumps({
                         'error': 'Неверный код',
-                        'verified': False
+                        'verified': False,
+                        'attempts_left': SMS_MAX_VERIFY_ATTEMPTS - record['attempts']
                     }),
                     'isBase64Encoded': False
                 }
@@ -294,4 +464,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             },
             'body': json.dumps({'error': str(e)}),
             'isBase64Encoded': False
-        }
\ No newline at end of file
+        }
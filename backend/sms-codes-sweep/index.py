@@ -0,0 +1,131 @@
+'''
+Business: Плановая очистка просроченных SMS-кодов, устаревших лимитов отправки и отработанных SMS из очереди
+Args: event - dict с httpMethod (POST - запустить очистку) и заголовком X-Admin-Token;
+             вызывается по расписанию из backend/schedules.json
+      context - объект с request_id, function_name
+Returns: HTTP response с количеством удалённых строк по таблицам
+'''
+
+import hmac
+import json
+import os
+import time
+import psycopg2
+from typing import Dict, Any
+
+SWEEP_BATCH_SIZE = 1000
+# Ограничение времени одного запуска, чтобы не упереться в таймаут функции
+SWEEP_TIME_BUDGET_SECONDS = 20
+# Лимиты отправки живут окно в 1 час (см. sms-auth), SMS с кодами в очереди храним неделю
+SEND_LIMITS_RETENTION_SECONDS = 3600
+SMS_OUTBOX_RETENTION_DAYS = 7
+
+SWEEPS = {
+    'sms_codes': """
+        DELETE FROM t_p14771149_mfo_client_cabinet.sms_codes
+        WHERE ctid IN (
+            SELECT ctid FROM t_p14771149_mfo_client_cabinet.sms_codes
+            WHERE expires_at < NOW()
+            LIMIT %s
+        )""",
+    'sms_send_limits': f"""
+        DELETE FROM t_p14771149_mfo_client_cabinet.sms_send_limits
+        WHERE ctid IN (
+            SELECT ctid FROM t_p14771149_mfo_client_cabinet.sms_send_limits
+            WHERE updated_at < LOCALTIMESTAMP - INTERVAL '{SEND_LIMITS_RETENTION_SECONDS} seconds'
+            LIMIT %s
+        )""",
+    'sms_outbox': f"""
+        DELETE FROM t_p14771149_mfo_client_cabinet.sms_outbox
+        WHERE id IN (
+            SELECT id FROM t_p14771149_mfo_client_cabinet.sms_outbox
+            WHERE created_at < NOW() - INTERVAL '{SMS_OUTBOX_RETENTION_DAYS} days'
+            LIMIT %s
+        )"""
+}
+
+
+def sweep_table(conn, sql: str, deadline: float) -> int:
+    '''Удаляет пачками по SWEEP_BATCH_SIZE с коммитом после каждой, чтобы не держать блокировки'''
+    deleted = 0
+    cur = conn.cursor()
+    while time.monotonic() < deadline:
+        cur.execute(sql, (SWEEP_BATCH_SIZE,))
+        batch_deleted = cur.rowcount
+        conn.commit()
+        deleted += batch_deleted
+        if batch_deleted < SWEEP_BATCH_SIZE:
+            break
+    cur.close()
+    return deleted
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method != 'POST':
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Очистка - служебный вызов, без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Database not configured'}),
+            'isBase64Encoded': False
+        }
+
+    started = time.monotonic()
+    deadline = started + SWEEP_TIME_BUDGET_SECONDS
+    deleted = {}
+
+    conn = psycopg2.connect(database_url)
+    try:
+        for table, sql in SWEEPS.items():
+            deleted[table] = sweep_table(conn, sql, deadline)
+    finally:
+        conn.close()
+
+    duration_ms = int((time.monotonic() - started) * 1000)
+    print(f"[SMS-SWEEP] deleted={deleted} duration_ms={duration_ms}")
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': True,
+            'deleted': deleted,
+            'duration_ms': duration_ms
+        }),
+        'isBase64Encoded': False
+    }
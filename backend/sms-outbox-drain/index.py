@@ -0,0 +1,350 @@
+'''
+Business: Отправка очереди sms_outbox через SMS.ru пачками (multi[]) и отслеживание статусов доставки
+Args: event - dict с httpMethod (POST - отправить очередь и обновить статусы, GET - метрики очереди)
+             и заголовком X-Admin-Token; POST по расписанию из backend/schedules.json и сразу
+             после постановки кода в очередь из sms-auth
+      context - объект с request_id, function_name
+Returns: HTTP response с результатом отправки или метриками очереди
+'''
+
+import hmac
+import json
+import os
+import time
+import requests
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from typing import Dict, Any, List, Tuple
+
+SMSRU_API_URL = 'https://sms.ru'
+# SMS.ru принимает до 100 получателей в одном запросе multi[] и до 100 sms_id в запросе статуса
+SMS_BATCH_SIZE = 100
+STATUS_BATCH_SIZE = 100
+MAX_BATCHES_PER_RUN = 10
+MAX_STATUS_BATCHES_PER_RUN = 5
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 600
+SENDING_LEASE_SECONDS = 120
+# В очереди только коды входа: они живут SMS_CODE_TTL_MINUTES (10 мин) в sms-auth и sms-send,
+# позже SMS уже бесполезна - такие строки не отправляются и не повторяются, а помечаются expired
+CODE_TTL_SECONDS = 600
+# Статусы доставки SMS.ru: доставлено/прочитано и окончательные отказы
+DELIVERED_STATUS_CODES = {103, 110}
+UNDELIVERED_STATUS_CODES = {104, 105, 106, 107, 108, 150}
+
+
+def expire_stale(conn) -> int:
+    '''Снимает с очереди SMS, чей код уже истёк'''
+    cur = conn.cursor()
+    cur.execute(
+        """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox
+           SET status = 'expired', last_error = COALESCE(last_error, 'Код истёк до отправки')
+           WHERE status IN ('pending', 'sending') AND created_at <= NOW() - make_interval(secs => %s)""",
+        (CODE_TTL_SECONDS,)
+    )
+    expired = cur.rowcount
+    conn.commit()
+    cur.close()
+    return expired
+
+
+def claim_batch(conn, limit: int) -> List[Dict[str, Any]]:
+    '''Захватывает пачку SMS к отправке, параллельные дренеры их пропустят'''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox
+           SET status = 'sending', attempts = attempts + 1,
+               next_attempt_at = NOW() + make_interval(secs => %s)
+           WHERE id IN (
+               SELECT id FROM t_p14771149_mfo_client_cabinet.sms_outbox
+               WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                 AND created_at > NOW() - make_interval(secs => %s)
+               ORDER BY next_attempt_at, id
+               LIMIT %s
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, phone, message, attempts""",
+        (SENDING_LEASE_SECONDS, CODE_TTL_SECONDS, limit)
+    )
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    rows.sort(key=lambda row: row['id'])
+    return rows
+
+
+def split_superseded(rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[int]]:
+    '''На один номер в пачке уходит только последняя SMS: предыдущий код уже перезаписан'''
+    latest: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        latest[row['phone']] = row
+    keep_ids = {row['id'] for row in latest.values()}
+    return list(latest.values()), [row['id'] for row in rows if row['id'] not in keep_ids]
+
+
+def send_multi(rows: List[Dict[str, Any]], api_key: str) -> Dict[str, Dict[str, Any]]:
+    '''Один запрос SMS.ru на всю пачку, разные тексты разным получателям через multi[]'''
+    data = {'api_id': api_key, 'json': 1}
+    for row in rows:
+        data[f"multi[{row['phone']}]"] = row['message']
+
+    response = requests.post(f'{SMSRU_API_URL}/sms/send', data=data, timeout=15)
+    response.raise_for_status()
+    result = response.json()
+    if result.get('status') != 'OK':
+        raise RuntimeError(f"SMS.ru {result.get('status_code')}: {result.get('status_text', 'Неизвестная ошибка')}")
+    return result.get('sms', {})
+
+
+def update_rows(conn, sql: str, values: List[tuple]) -> None:
+    if not values:
+        return
+    cur = conn.cursor()
+    execute_values(cur, sql, values)
+    conn.commit()
+    cur.close()
+
+
+def mark_retry(conn, errors: Dict[int, str]) -> Tuple[int, int]:
+    '''
+    Возвращает SMS в очередь с экспоненциальной задержкой. Исчерпавшие попытки помечает failed,
+    а те, чей повтор пришёлся бы на момент после истечения кода, - expired.
+    Возвращает (failed, expired).
+    '''
+    backoff = f"make_interval(secs => LEAST({BACKOFF_BASE_SECONDS} * POWER(2, o.attempts - 1), {BACKOFF_MAX_SECONDS}))"
+    cur = conn.cursor()
+    statuses = execute_values(
+        cur,
+        f"""UPDATE t_p14771149_mfo_client_cabinet.sms_outbox AS o
+            SET status = CASE WHEN o.attempts >= {MAX_ATTEMPTS} THEN 'failed'
+                              WHEN NOW() + {backoff} >= o.created_at + make_interval(secs => {CODE_TTL_SECONDS}) THEN 'expired'
+                              ELSE 'pending' END,
+                next_attempt_at = NOW() + {backoff},
+                last_error = v.error
+            FROM (VALUES %s) AS v(id, error)
+            WHERE o.id = v.id
+            RETURNING o.status""",
+        list(errors.items()),
+        fetch=True
+    )
+    conn.commit()
+    cur.close()
+    return sum(1 for row in statuses if row[0] == 'failed'), sum(1 for row in statuses if row[0] == 'expired')
+
+
+def drain(conn, api_key: str) -> Dict[str, Any]:
+    stats = {'batches': 0, 'sent': 0, 'rejected': 0, 'retried': 0, 'failed': 0, 'superseded': 0,
+             'expired': expire_stale(conn)}
+
+    for _ in range(MAX_BATCHES_PER_RUN):
+        rows = claim_batch(conn, SMS_BATCH_SIZE)
+        if not rows:
+            break
+        stats['batches'] += 1
+
+        rows, superseded_ids = split_superseded(rows)
+        update_rows(
+            conn,
+            """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox AS o
+               SET status = 'superseded'
+               FROM (VALUES %s) AS v(id)
+               WHERE o.id = v.id""",
+            [(row_id,) for row_id in superseded_ids]
+        )
+        stats['superseded'] += len(superseded_ids)
+
+        try:
+            per_phone = send_multi(rows, api_key)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError) as e:
+            exhausted, expired = mark_retry(conn, {row['id']: str(e) for row in rows})
+            stats['failed'] += exhausted
+            stats['expired'] += expired
+            stats['retried'] += len(rows) - exhausted - expired
+            print(f"[SMS-OUTBOX] Ошибка отправки пачки из {len(rows)} SMS: {e}")
+            break
+
+        sent, rejected = [], []
+        for row in rows:
+            phone_result = per_phone.get(row['phone'], {})
+            if phone_result.get('status') == 'OK':
+                sent.append((row['id'], str(phone_result.get('sms_id', '')), int(phone_result.get('status_code', 100))))
+            else:
+                # Ошибка по конкретному номеру (неверный номер, запрет) повтором не лечится
+                rejected.append((row['id'], int(phone_result.get('status_code') or 0), phone_result.get('status_text', 'Нет ответа по номеру')))
+
+        update_rows(
+            conn,
+            """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox AS o
+               SET status = 'sent', sms_id = v.sms_id, delivery_status_code = v.status_code, sent_at = NOW(), last_error = NULL
+               FROM (VALUES %s) AS v(id, sms_id, status_code)
+               WHERE o.id = v.id""",
+            sent
+        )
+        update_rows(
+            conn,
+            """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox AS o
+               SET status = 'failed', delivery_status_code = v.status_code, last_error = v.error
+               FROM (VALUES %s) AS v(id, status_code, error)
+               WHERE o.id = v.id""",
+            rejected
+        )
+        stats['sent'] += len(sent)
+        stats['rejected'] += len(rejected)
+
+    return stats
+
+
+def refresh_delivery_statuses(conn, api_key: str) -> Dict[str, int]:
+    '''Запрашивает статусы доставки отправленных SMS пачками по 100 sms_id'''
+    stats = {'delivered': 0, 'undelivered': 0}
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """SELECT id, sms_id FROM t_p14771149_mfo_client_cabinet.sms_outbox
+           WHERE status = 'sent' AND sent_at > NOW() - INTERVAL '1 day' AND sms_id <> ''
+           ORDER BY sent_at
+           LIMIT %s""",
+        (STATUS_BATCH_SIZE * MAX_STATUS_BATCHES_PER_RUN,)
+    )
+    rows = cur.fetchall()
+    cur.close()
+
+    for start in range(0, len(rows), STATUS_BATCH_SIZE):
+        chunk = rows[start:start + STATUS_BATCH_SIZE]
+        try:
+            response = requests.post(
+                f'{SMSRU_API_URL}/sms/status',
+                data={'api_id': api_key, 'sms_id': ','.join(row['sms_id'] for row in chunk), 'json': 1},
+                timeout=15
+            )
+            response.raise_for_status()
+            statuses = response.json().get('sms', {})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"[SMS-OUTBOX] Ошибка запроса статусов: {e}")
+            break
+
+        updates = []
+        for row in chunk:
+            sms_status = statuses.get(row['sms_id'], {})
+            status_code = int(sms_status.get('status_code') or 0)
+            if status_code in DELIVERED_STATUS_CODES:
+                new_status = 'delivered'
+            elif status_code in UNDELIVERED_STATUS_CODES:
+                new_status = 'undelivered'
+            else:
+                new_status = 'sent'
+            updates.append((row['id'], new_status, status_code, sms_status.get('status_text', '')))
+            if new_status in stats:
+                stats[new_status] += 1
+
+        update_rows(
+            conn,
+            """UPDATE t_p14771149_mfo_client_cabinet.sms_outbox AS o
+               SET status = v.status, delivery_status_code = v.status_code, delivery_status_text = v.status_text,
+                   delivered_at = CASE WHEN v.status = 'delivered' THEN NOW() ELSE o.delivered_at END
+               FROM (VALUES %s) AS v(id, status, status_code, status_text)
+               WHERE o.id = v.id""",
+            updates
+        )
+
+    return stats
+
+
+def queue_metrics(conn) -> Dict[str, Any]:
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        """SELECT COUNT(*) AS queue_depth,
+                  EXTRACT(EPOCH FROM NOW() - MIN(created_at)) AS oldest_age_seconds
+           FROM t_p14771149_mfo_client_cabinet.sms_outbox
+           WHERE status IN ('pending', 'sending')"""
+    )
+    queue = cur.fetchone()
+    cur.execute(
+        """SELECT COUNT(*) AS sent,
+                  COUNT(*) FILTER (WHERE status = 'delivered') AS delivered,
+                  COUNT(*) FILTER (WHERE status = 'undelivered') AS undelivered,
+                  AVG(EXTRACT(EPOCH FROM sent_at - created_at)) AS send_latency_seconds,
+                  AVG(EXTRACT(EPOCH FROM delivered_at - created_at)) AS delivery_latency_seconds
+           FROM t_p14771149_mfo_client_cabinet.sms_outbox
+           WHERE sent_at > NOW() - INTERVAL '1 hour'"""
+    )
+    last_hour = cur.fetchone()
+    cur.close()
+
+    return {
+        'queue_depth': queue['queue_depth'],
+        'oldest_age_seconds': float(queue['oldest_age_seconds'] or 0),
+        'sent_last_hour': last_hour['sent'],
+        'delivered_last_hour': last_hour['delivered'],
+        'undelivered_last_hour': last_hour['undelivered'],
+        'send_latency_avg_seconds': float(last_hour['send_latency_seconds'] or 0),
+        'delivery_latency_avg_seconds': float(last_hour['delivery_latency_seconds'] or 0)
+    }
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+
+    if method not in ['GET', 'POST']:
+        return {
+            'statusCode': 405,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+
+    # Запуск отправки и метрики очереди - служебные, без настроенного ADMIN_API_TOKEN функция закрыта
+    admin_token = os.environ.get('ADMIN_API_TOKEN', '')
+    headers = event.get('headers') or {}
+    request_token = headers.get('X-Admin-Token') or headers.get('x-admin-token') or ''
+    if not admin_token or not hmac.compare_digest(request_token, admin_token):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Forbidden'}),
+            'isBase64Encoded': False
+        }
+
+    database_url = os.environ.get('DATABASE_URL')
+    api_key = os.environ.get('SMSRU_API_KEY')
+    if not database_url or (method == 'POST' and not api_key):
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'DATABASE_URL or SMSRU_API_KEY not configured'}),
+            'isBase64Encoded': False
+        }
+
+    conn = psycopg2.connect(database_url)
+    try:
+        if method == 'GET':
+            result = queue_metrics(conn)
+        else:
+            started = time.monotonic()
+            result = drain(conn, api_key)
+            result.update(refresh_delivery_statuses(conn, api_key))
+            result['duration_ms'] = int((time.monotonic() - started) * 1000)
+            result.update(queue_metrics(conn))
+            print(f"[SMS-OUTBOX] {json.dumps(result)}")
+    finally:
+        conn.close()
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'success': True, **result}),
+        'isBase64Encoded': False
+    }
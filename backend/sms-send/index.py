@@ -1,19 +1,71 @@
 '''
-Business: Генерация и отправка SMS-кода для авторизации
+Business: Генерация SMS-кода для входа и регистрации и постановка SMS в очередь отправки.
+          Отправки ограничены тем же скользящим окном sms_send_limits, что и в sms-auth
+          (общий счётчик на номер и на IP), код хранится хешем - его проверяет sms-verify
 Args: event с httpMethod, queryStringParameters (phone)
 Returns: HTTP response с success и временем жизни кода
 '''
 
 import json
 import os
-import random
+import hmac
+import hashlib
+import secrets
 from typing import Dict, Any
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import phones
+
+SMS_CODE_TTL_MINUTES = 10
+# Те же лимиты, что в sms-auth: не чаще раза в минуту и не более 5 SMS в час на номер, 20 в час на IP
+SEND_WINDOW_SECONDS = 3600
+PHONE_SENDS_PER_WINDOW = 5
+IP_SENDS_PER_WINDOW = 20
+PHONE_RESEND_INTERVAL_SECONDS = 60
 
 def generate_code() -> str:
     '''Генерирует 4-значный SMS-код'''
-    return str(random.randint(1000, 9999))
+    return str(secrets.randbelow(9000) + 1000)
+
+def hash_code(phone: str, code: str, secret: str) -> str:
+    return hmac.new(secret.encode(), f'{phone}:{code}'.encode(), hashlib.sha256).hexdigest()
+
+def get_source_ip(event: Dict[str, Any]) -> str:
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    source_ip = identity.get('sourceIp') or ''
+    if not source_ip:
+        request_headers = event.get('headers') or {}
+        forwarded = request_headers.get('X-Forwarded-For') or request_headers.get('x-forwarded-for') or ''
+        source_ip = forwarded.split(',')[0].strip()
+    return source_ip[:45]
+
+def acquire_send_slot(cur, phone: str, source_ip: str) -> bool:
+    '''
+    Сдвигает скользящие окна номера и IP одним upsert, как acquire_send_slot в sms-auth.
+    Строка с исчерпанным окном не обновляется и не возвращается - тогда вызывающий откатывает транзакцию.
+    '''
+    limit_keys = [f'phone:{phone}']
+    if source_ip:
+        limit_keys.append(f'ip:{source_ip}')
+    values_sql = ', '.join(['(%s, ARRAY[LOCALTIMESTAMP], LOCALTIMESTAMP)'] * len(limit_keys))
+    cur.execute(
+        f"""INSERT INTO t_p14771149_mfo_client_cabinet.sms_send_limits AS l (limit_key, send_times, updated_at) 
+            VALUES {values_sql} 
+            ON CONFLICT (limit_key) DO UPDATE 
+            SET send_times = ARRAY(
+                    SELECT t FROM unnest(l.send_times) AS t 
+                    WHERE t > LOCALTIMESTAMP - make_interval(secs => %s)
+                ) || LOCALTIMESTAMP, 
+                updated_at = LOCALTIMESTAMP 
+            WHERE (
+                    SELECT COUNT(*) FROM unnest(l.send_times) AS t 
+                    WHERE t > LOCALTIMESTAMP - make_interval(secs => %s)
+                ) < CASE WHEN l.limit_key LIKE 'ip:%%' THEN %s ELSE %s END 
+              AND (l.limit_key LIKE 'ip:%%' OR l.updated_at <= LOCALTIMESTAMP - make_interval(secs => %s)) 
+            RETURNING limit_key""",
+        (*limit_keys, SEND_WINDOW_SECONDS, SEND_WINDOW_SECONDS, IP_SENDS_PER_WINDOW, PHONE_SENDS_PER_WINDOW,
+         PHONE_RESEND_INTERVAL_SECONDS)
+    )
+    return cur.rowcount == len(limit_keys)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
@@ -47,22 +99,68 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'success': False, 'error': 'Укажите номер телефона'})
         }
     
+    if not phones.is_valid(phone):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'Некорректный номер телефона'})
+        }
+    
     dsn = os.environ.get('DATABASE_URL')
+    # Тот же секрет, что у sms-auth: строка sms_codes проверяется одинаково в обоих потоках
+    code_secret = os.environ.get('SMS_CODE_SECRET') or os.environ.get('SMSRU_API_KEY')
+    if not dsn or not code_secret:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'DATABASE_URL or SMS_CODE_SECRET not configured'})
+        }
+    
+    clean_phone = phones.normalize(phone)
     sms_code = generate_code()
     
     try:
         conn = psycopg2.connect(dsn)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur = conn.cursor()
+        
+        # Лимит в отдельной транзакции: исчерпанное окно откатывается и не сдвигается
+        if not acquire_send_slot(cur, clean_phone, get_source_ip(event)):
+            conn.rollback()
+            cur.close()
+            conn.close()
+            print(f'[SMS-SEND] Превышен лимит отправок: {clean_phone[:4]}***')
+            return {
+                'statusCode': 429,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*',
+                    'Retry-After': str(PHONE_RESEND_INTERVAL_SECONDS)
+                },
+                'body': json.dumps({'success': False, 'error': 'Слишком много запросов кода. Попробуйте позже.'})
+            }
+        conn.commit()
         
+        # Строка в том же виде, что пишет store_code в sms-auth: код только хешем, попытки с нуля
         cur.execute(
             """
             INSERT INTO t_p14771149_mfo_client_cabinet.sms_codes 
-            (phone, code, expires_at, created_at) 
-            VALUES (%s, %s, NOW() + INTERVAL '10 minutes', NOW())
+            (phone, code, code_hash, attempts, client_name, client_id, expires_at, created_at) 
+            VALUES (%s, NULL, %s, 0, NULL, NULL, NOW() + make_interval(mins => %s), NOW())
             ON CONFLICT (phone) 
-            DO UPDATE SET code = EXCLUDED.code, expires_at = EXCLUDED.expires_at, created_at = NOW()
+            DO UPDATE SET code = NULL, code_hash = EXCLUDED.code_hash, attempts = 0, 
+                          client_name = NULL, client_id = NULL, 
+                          expires_at = EXCLUDED.expires_at, created_at = NOW()
+            """,
+            (clean_phone, hash_code(clean_phone, sms_code, code_secret), SMS_CODE_TTL_MINUTES)
+        )
+        
+        # Отправку через SMS.ru выполнит sms-outbox-drain
+        cur.execute(
+            """
+            INSERT INTO t_p14771149_mfo_client_cabinet.sms_outbox (source, phone, message) 
+            VALUES ('sms-send', %s, %s)
             """,
-            (phone, sms_code)
+            (clean_phone, f'Ваш код для входа: {sms_code}')
         )
         
         conn.commit()
@@ -74,9 +172,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'message': f'SMS-код отправлен на номер {phone}',
-                'expiresIn': 600,
-                'code': sms_code
+                'message': f'SMS-код отправлен на номер {clean_phone}',
+                'expiresIn': SMS_CODE_TTL_MINUTES * 60
             })
         }
         
@@ -0,0 +1,162 @@
+'''
+Подключения к БД с маршрутизацией чтения на реплику.
+Если задан DATABASE_REPLICA_URL (можно несколько через запятую), читающие запросы идут
+на реплику с отставанием не больше REPLICA_MAX_LAG_SECONDS, иначе - на основную БД.
+После первой записи в рамках запроса все чтения этого запроса идут на основную БД.
+Функции деплоятся независимо, поэтому файл лежит копией в каталоге каждой функции.
+'''
+
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Iterator, List
+import psycopg2
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+LAG_CHECK_INTERVAL_SECONDS = 5
+REPLICA_RETRY_AFTER_SECONDS = 30
+REPLICA_CONNECT_TIMEOUT_SECONDS = 2
+
+# Отставание 0, если реплика проиграла всё полученное: иначе на простаивающей основной БД
+# pg_last_xact_replay_timestamp() стареет и реплика выглядела бы отстающей
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+    END"""
+
+# Состояние реплик и метрики живут в тёплом экземпляре функции между вызовами
+_replicas: Dict[str, Dict[str, Any]] = {}
+_metrics: Dict[str, Dict[str, float]] = {}
+_lock = threading.Lock()
+
+
+def _replica_urls() -> List[str]:
+    return [url.strip() for url in os.environ.get('DATABASE_REPLICA_URL', '').split(',') if url.strip()]
+
+
+def _record(target: str, elapsed_ms: float) -> None:
+    with _lock:
+        metric = _metrics.setdefault(target, {'queries': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        metric['queries'] += 1
+        metric['total_ms'] += elapsed_ms
+        metric['max_ms'] = max(metric['max_ms'], elapsed_ms)
+
+
+def metrics() -> Dict[str, Dict[str, float]]:
+    '''Число запросов и задержка по целям (primary/replica) - видно, какую долю чтений сняли с основной БД'''
+    with _lock:
+        return {
+            target: {
+                'queries': int(metric['queries']),
+                'avg_ms': round(metric['total_ms'] / metric['queries'], 2),
+                'max_ms': round(metric['max_ms'], 2)
+            }
+            for target, metric in _metrics.items() if metric['queries']
+        }
+
+
+def _replica_usable(url: str, conn) -> bool:
+    '''Проверяет отставание не чаще раза в LAG_CHECK_INTERVAL_SECONDS на реплику'''
+    now = time.monotonic()
+    state = _replicas.setdefault(url, {'checked_at': 0.0, 'lag': 0.0, 'down_until': 0.0})
+    if now - state['checked_at'] < LAG_CHECK_INTERVAL_SECONDS:
+        return state['lag'] <= REPLICA_MAX_LAG_SECONDS
+    cur = conn.cursor()
+    cur.execute(LAG_SQL)
+    state['lag'] = float(cur.fetchone()[0])
+    state['checked_at'] = now
+    cur.close()
+    if state['lag'] > REPLICA_MAX_LAG_SECONDS:
+        print(f'[DB] Реплика отстаёт на {state["lag"]:.1f}s, чтение идёт на основную БД')
+        return False
+    return True
+
+
+class RequestDB:
+    '''Подключения одного вызова функции: основная БД и (лениво) реплика'''
+
+    def __init__(self, primary_url: str):
+        self.primary_url = primary_url
+        self.pinned = False
+        self._primary = None
+        self._replica = None
+        self._replica_checked = False
+
+    def primary(self):
+        if self._primary is None:
+            self._primary = psycopg2.connect(self.primary_url)
+        return self._primary
+
+    def _replica_conn(self):
+        if self._replica_checked:
+            return self._replica
+        self._replica_checked = True
+        urls = _replica_urls()
+        random.shuffle(urls)
+        for url in urls:
+            state = _replicas.get(url)
+            if state and state['down_until'] > time.monotonic():
+                continue
+            try:
+                conn = psycopg2.connect(url, connect_timeout=REPLICA_CONNECT_TIMEOUT_SECONDS)
+                conn.set_session(readonly=True, autocommit=True)
+                if _replica_usable(url, conn):
+                    self._replica = conn
+                    return conn
+                conn.close()
+            except psycopg2.Error as e:
+                print(f'[DB] Реплика недоступна, чтение идёт на основную БД: {e}')
+                _replicas.setdefault(url, {'checked_at': 0.0, 'lag': 0.0, 'down_until': 0.0})['down_until'] = \
+                    time.monotonic() + REPLICA_RETRY_AFTER_SECONDS
+        return None
+
+    @contextmanager
+    def cursor(self, readonly: bool = False, primary: bool = False, **kwargs) -> Iterator[Any]:
+        '''Курсор на реплике для чтения (если она есть и запрос ещё ничего не писал), иначе на основной БД.
+        Курсор для записи закрепляет остаток запроса за основной БД (read-your-writes).
+        primary=True - чтение таблиц, которых нет на реплике (UNLOGGED), без закрепления.'''
+        conn = None
+        if readonly and not primary and not self.pinned:
+            conn = self._replica_conn()
+        if not readonly:
+            self.pinned = True
+        if conn is None:
+            conn = self.primary()
+
+        cur = conn.cursor(**kwargs)
+        started = time.monotonic()
+        try:
+            yield cur
+        finally:
+            _record('replica' if conn is self._replica else 'primary', (time.monotonic() - started) * 1000)
+            cur.close()
+
+    def fetch_one(self, sql: str, params: Optional[tuple] = None, **kwargs) -> Any:
+        '''Чтение одной строки; если на реплике её нет (могла ещё не доехать), перечитывает с основной БД'''
+        with self.cursor(readonly=True, **kwargs) as cur:
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            from_replica = self._replica is not None and cur.connection is self._replica
+        if row is None and from_replica:
+            # Промах на реплике - перечитываем с основной БД и дальше в этом запросе читаем только с неё
+            self.pinned = True
+            with self.cursor(readonly=True, **kwargs) as cur:
+                cur.execute(sql, params)
+                row = cur.fetchone()
+        return row
+
+    def commit(self) -> None:
+        if self._primary is not None:
+            self._primary.commit()
+
+    def close(self) -> None:
+        for conn in (self._primary, self._replica):
+            if conn is not None:
+                conn.close()
+        self._primary = None
+        self._replica = None
+        if _metrics:
+            print(f'[DB] {metrics()}')
@@ -6,9 +6,17 @@ Returns: HTTP response с success и данными клиента
 
 import json
 import os
+import hmac
+import hashlib
 from typing import Dict, Any
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db import RequestDB
+import phones
+
+SMS_MAX_VERIFY_ATTEMPTS = 5
+
+def hash_code(phone: str, code: str, secret: str) -> str:
+    return hmac.new(secret.encode(), f'{phone}:{code}'.encode(), hashlib.sha256).hexdigest()
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
@@ -44,80 +52,103 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     dsn = os.environ.get('DATABASE_URL')
+    code_secret = os.environ.get('SMS_CODE_SECRET') or os.environ.get('SMSRU_API_KEY')
+    if not dsn or not code_secret:
+        return {
+            'statusCode': 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': 'DATABASE_URL or SMS_CODE_SECRET not configured'})
+        }
+    clean_phone = phones.normalize(phone)
     
     try:
-        conn = psycopg2.connect(dsn)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(
-            """
-            SELECT code, expires_at > NOW() as is_valid 
-            FROM t_p14771149_mfo_client_cabinet.sms_codes 
-            WHERE phone = %s
-            """,
-            (phone,)
-        )
-        sms_record = cur.fetchone()
-        
-        if not sms_record:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': False, 'error': 'SMS-код не найден. Запросите новый код'})
-            }
-        
-        if not sms_record['is_valid']:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': False, 'error': 'SMS-код истёк. Запросите новый код'})
-            }
-        
-        if sms_record['code'] != code:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': False, 'error': 'Неверный SMS-код'})
-            }
-        
-        cur.execute(
-            """
-            SELECT id, phone, full_name, last_name, first_name, middle_name, 
-                   birth_date, passport_series, passport_number
-            FROM t_p14771149_mfo_client_cabinet.clients 
-            WHERE phone = %s
-            """,
-            (phone,)
-        )
-        client = cur.fetchone()
-        
-        if not client:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'needsRegistration': True,
-                    'phone': phone
-                })
-            }
-        
-        cur.execute(
-            "DELETE FROM t_p14771149_mfo_client_cabinet.sms_codes WHERE phone = %s",
-            (phone,)
-        )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        db = RequestDB(dsn)
+        try:
+            # sms_codes - UNLOGGED и на реплику не попадает, поэтому код проверяем на основной БД.
+            # Попытка списывается до сравнения, как consume_attempt в sms-auth - перебор ограничен
+            with db.cursor(primary=True, cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    UPDATE t_p14771149_mfo_client_cabinet.sms_codes 
+                    SET attempts = attempts + 1 
+                    WHERE phone = %s AND code_hash IS NOT NULL AND expires_at > NOW() AND attempts < %s 
+                    RETURNING code_hash
+                    """,
+                    (clean_phone, SMS_MAX_VERIFY_ATTEMPTS)
+                )
+                sms_record = cur.fetchone()
+                stale_record = None
+                if not sms_record:
+                    cur.execute(
+                        """
+                        SELECT expires_at > NOW() AS is_valid 
+                        FROM t_p14771149_mfo_client_cabinet.sms_codes 
+                        WHERE phone = %s AND code_hash IS NOT NULL
+                        """,
+                        (clean_phone,)
+                    )
+                    stale_record = cur.fetchone()
+            db.commit()
+            
+            if not sms_record and not stale_record:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': False, 'error': 'SMS-код не найден. Запросите новый код'})
+                }
+            
+            if not sms_record and not stale_record['is_valid']:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': False, 'error': 'SMS-код истёк. Запросите новый код'})
+                }
+            
+            if not sms_record:
+                return {
+                    'statusCode': 429,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': False, 'error': 'Превышено число попыток. Запросите новый код'})
+                }
+            
+            if not hmac.compare_digest(sms_record['code_hash'], hash_code(clean_phone, code, code_secret)):
+                return {
+                    'statusCode': 401,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': False, 'error': 'Неверный SMS-код'})
+                }
+            
+            # Поиск клиента - только чтение; после списания попытки запрос закреплён за основной БД
+            client = db.fetch_one(
+                """
+                SELECT id, phone, full_name, last_name, first_name, middle_name, 
+                       birth_date, passport_series, passport_number
+                FROM t_p14771149_mfo_client_cabinet.clients 
+                WHERE phone = %s
+                """,
+                (phone,),
+                cursor_factory=RealDictCursor
+            )
+            
+            if not client:
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({
+                        'success': True,
+                        'needsRegistration': True,
+                        'phone': phone
+                    })
+                }
+            
+            with db.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM t_p14771149_mfo_client_cabinet.sms_codes WHERE phone = %s",
+                    (clean_phone,)
+                )
+            db.commit()
+        finally:
+            db.close()
         
         return {
             'statusCode': 200,
@@ -0,0 +1,22 @@
+-- Очередь заявок на отправку в AmoCRM (outbox): обработчики пишут сюда,
+-- фоновый дренер отправляет сделки пачками
+CREATE TABLE IF NOT EXISTS lead_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    phone VARCHAR(20) NOT NULL,
+    contact_name VARCHAR(255),
+    lead_name VARCHAR(255) NOT NULL,
+    price INTEGER NOT NULL DEFAULT 0,
+    contact_id BIGINT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    amocrm_lead_id BIGINT,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- Выборка очереди дренером: ожидающие отправки и зависшие в отправке записи
+CREATE INDEX IF NOT EXISTS idx_lead_outbox_pending ON lead_outbox(next_attempt_at) WHERE status IN ('pending', 'sending');
+CREATE INDEX IF NOT EXISTS idx_lead_outbox_sent_at ON lead_outbox(sent_at) WHERE status = 'sent';
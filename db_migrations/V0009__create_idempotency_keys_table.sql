@@ -0,0 +1,14 @@
+-- Ключи идемпотентности для создания заявок: повтор запроса с тем же ключом
+-- возвращает сохранённый ответ и не создаёт дубль сделки
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    endpoint VARCHAR(50) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    response_status INTEGER,
+    response_body TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (endpoint, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
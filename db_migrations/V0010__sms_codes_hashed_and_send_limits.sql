@@ -0,0 +1,13 @@
+-- sms-auth хранит в sms_codes только хеш кода, счётчик попыток и найденного в AmoCRM клиента
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes ALTER COLUMN code DROP NOT NULL;
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes ADD COLUMN IF NOT EXISTS code_hash VARCHAR(64);
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes ADD COLUMN IF NOT EXISTS client_name VARCHAR(255);
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes ADD COLUMN IF NOT EXISTS client_id VARCHAR(50);
+
+-- Скользящее окно отправок SMS по телефону (phone:...) и по IP (ip:...)
+CREATE TABLE IF NOT EXISTS sms_send_limits (
+    limit_key VARCHAR(64) PRIMARY KEY,
+    send_times TIMESTAMP[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,22 @@
+-- Очередь исходящих SMS: sms-auth и sms-send пишут сюда, sms-outbox-drain
+-- отправляет пачками через SMS.ru и отслеживает статус доставки
+CREATE TABLE IF NOT EXISTS sms_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    phone VARCHAR(20) NOT NULL,
+    message TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    sms_id VARCHAR(64),
+    delivery_status_code INTEGER,
+    delivery_status_text VARCHAR(255),
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP,
+    delivered_at TIMESTAMP
+);
+
+-- pending/sending ждут отправки; по sent_at выбираются SMS для проверки статуса и метрики
+CREATE INDEX IF NOT EXISTS idx_sms_outbox_pending ON sms_outbox(next_attempt_at) WHERE status IN ('pending', 'sending');
+CREATE INDEX IF NOT EXISTS idx_sms_outbox_sent_at ON sms_outbox(sent_at);
@@ -0,0 +1,20 @@
+-- Одноразовые коды и лимиты отправок не нужно переживать сбой сервера: после аварии
+-- клиент просто запросит новый код. UNLOGGED убирает запись в WAL на каждый upsert.
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes SET UNLOGGED;
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_send_limits SET UNLOGGED;
+
+-- Запас места на странице, чтобы upsert по phone шёл HOT-обновлением без новых версий индекса.
+-- Индекса по expires_at нет намеренно: он сделал бы обновления не-HOT, а таблицу держит маленькой sms-codes-sweep.
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_codes SET (
+    fillfactor = 70,
+    autovacuum_vacuum_scale_factor = 0.02,
+    autovacuum_vacuum_threshold = 200
+);
+ALTER TABLE t_p14771149_mfo_client_cabinet.sms_send_limits SET (
+    fillfactor = 70,
+    autovacuum_vacuum_scale_factor = 0.02,
+    autovacuum_vacuum_threshold = 200
+);
+
+-- Очистка sms_outbox по возрасту в sms-codes-sweep
+CREATE INDEX IF NOT EXISTS idx_sms_outbox_created_at ON sms_outbox(created_at);
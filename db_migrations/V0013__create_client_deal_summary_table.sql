@@ -0,0 +1,150 @@
+-- Сводка по сделкам клиента для единой заявки в кабинете: количество, сумма, id сделок,
+-- статус последней по updated_at сделки и границы по времени. Читается одним запросом по ключу.
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.client_deal_summary (
+    client_id INTEGER PRIMARY KEY,
+    deals_count INTEGER NOT NULL DEFAULT 0,
+    total_price NUMERIC(14, 2) NOT NULL DEFAULT 0,
+    deal_ids TEXT[] NOT NULL DEFAULT '{}',
+    latest_deal_id TEXT,
+    latest_status VARCHAR(100),
+    latest_status_id BIGINT,
+    latest_status_name VARCHAR(255),
+    latest_status_color VARCHAR(50),
+    latest_pipeline_id BIGINT,
+    latest_pipeline_name VARCHAR(255),
+    first_created_at TIMESTAMP,
+    last_updated_at TIMESTAMP,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_amocrm_deals_client_id ON t_p14771149_mfo_client_cabinet.amocrm_deals(client_id);
+
+-- Пересчёт сводки для набора клиентов. Сделок у клиента единицы, поэтому агрегат по индексу
+-- client_id дешёвый и, в отличие от инкрементов, остаётся верным при удалении и смене статуса.
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.refresh_client_deal_summary(p_client_ids INTEGER[])
+RETURNS void AS $$
+BEGIN
+    -- Параллельные транзакции по одному клиенту пересчитывают по очереди: upsert блокирует строку
+    -- сводки до конца транзакции, а в READ COMMITTED каждый следующий оператор берёт новый снимок
+    -- и видит сделки, закоммиченные держателем блокировки. Блокировки строк хранятся в самих строках,
+    -- а не в общей таблице блокировок, поэтому массовые операторы на тысячи клиентов не упираются
+    -- в max_locks_per_transaction. Порядок client_id исключает взаимоблокировки.
+    -- Строки клиентов без сделок удаляются ниже в той же транзакции.
+    INSERT INTO t_p14771149_mfo_client_cabinet.client_deal_summary AS s (client_id)
+    SELECT DISTINCT unnest(p_client_ids) ORDER BY 1
+    ON CONFLICT (client_id) DO UPDATE SET refreshed_at = s.refreshed_at;
+
+    DELETE FROM t_p14771149_mfo_client_cabinet.client_deal_summary s
+    WHERE s.client_id = ANY(p_client_ids)
+      AND NOT EXISTS (
+          SELECT 1 FROM t_p14771149_mfo_client_cabinet.amocrm_deals d WHERE d.client_id = s.client_id
+      );
+
+    INSERT INTO t_p14771149_mfo_client_cabinet.client_deal_summary AS s (
+        client_id, deals_count, total_price, deal_ids,
+        latest_deal_id, latest_status, latest_status_id, latest_status_name, latest_status_color,
+        latest_pipeline_id, latest_pipeline_name, first_created_at, last_updated_at, refreshed_at
+    )
+    SELECT agg.client_id, agg.deals_count, agg.total_price, agg.deal_ids,
+           latest.id::text, latest.status, latest.status_id, latest.status_name, latest.status_color,
+           latest.pipeline_id, latest.pipeline_name, agg.first_created_at, agg.last_updated_at, NOW()
+    FROM (
+        SELECT client_id,
+               COUNT(*) AS deals_count,
+               COALESCE(SUM(price), 0) AS total_price,
+               array_agg(id::text ORDER BY id) AS deal_ids,
+               MIN(created_at) AS first_created_at,
+               MAX(updated_at) AS last_updated_at
+        FROM t_p14771149_mfo_client_cabinet.amocrm_deals
+        WHERE client_id = ANY(p_client_ids)
+        GROUP BY client_id
+    ) agg
+    CROSS JOIN LATERAL (
+        SELECT d.id, d.status, d.status_id, d.status_name, d.status_color, d.pipeline_id, d.pipeline_name
+        FROM t_p14771149_mfo_client_cabinet.amocrm_deals d
+        WHERE d.client_id = agg.client_id
+        ORDER BY d.updated_at DESC NULLS LAST, d.id DESC
+        LIMIT 1
+    ) latest
+    ON CONFLICT (client_id) DO UPDATE SET
+        deals_count = EXCLUDED.deals_count,
+        total_price = EXCLUDED.total_price,
+        deal_ids = EXCLUDED.deal_ids,
+        latest_deal_id = EXCLUDED.latest_deal_id,
+        latest_status = EXCLUDED.latest_status,
+        latest_status_id = EXCLUDED.latest_status_id,
+        latest_status_name = EXCLUDED.latest_status_name,
+        latest_status_color = EXCLUDED.latest_status_color,
+        latest_pipeline_id = EXCLUDED.latest_pipeline_id,
+        latest_pipeline_name = EXCLUDED.latest_pipeline_name,
+        first_created_at = EXCLUDED.first_created_at,
+        last_updated_at = EXCLUDED.last_updated_at,
+        refreshed_at = EXCLUDED.refreshed_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггеры уровня оператора с таблицами переходов: массовая синхронизация зеркала
+-- пересчитывает каждого затронутого клиента один раз за оператор, а не на каждую строку.
+-- Postgres не разрешает таблицы переходов у триггера с несколькими событиями, поэтому их три.
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_deals_summary_trigger()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM t_p14771149_mfo_client_cabinet.refresh_client_deal_summary(
+            ARRAY(SELECT DISTINCT client_id FROM new_rows WHERE client_id IS NOT NULL)
+        );
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM t_p14771149_mfo_client_cabinet.refresh_client_deal_summary(
+            ARRAY(
+                SELECT client_id FROM new_rows WHERE client_id IS NOT NULL
+                UNION
+                SELECT client_id FROM old_rows WHERE client_id IS NOT NULL
+            )
+        );
+    ELSE
+        PERFORM t_p14771149_mfo_client_cabinet.refresh_client_deal_summary(
+            ARRAY(SELECT DISTINCT client_id FROM old_rows WHERE client_id IS NOT NULL)
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_amocrm_deals_summary_insert ON t_p14771149_mfo_client_cabinet.amocrm_deals;
+CREATE TRIGGER trg_amocrm_deals_summary_insert
+    AFTER INSERT ON t_p14771149_mfo_client_cabinet.amocrm_deals
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_deals_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_amocrm_deals_summary_update ON t_p14771149_mfo_client_cabinet.amocrm_deals;
+CREATE TRIGGER trg_amocrm_deals_summary_update
+    AFTER UPDATE ON t_p14771149_mfo_client_cabinet.amocrm_deals
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_deals_summary_trigger();
+
+DROP TRIGGER IF EXISTS trg_amocrm_deals_summary_delete ON t_p14771149_mfo_client_cabinet.amocrm_deals;
+CREATE TRIGGER trg_amocrm_deals_summary_delete
+    AFTER DELETE ON t_p14771149_mfo_client_cabinet.amocrm_deals
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_deals_summary_trigger();
+
+-- Первичное заполнение по уже загруженным сделкам: порциями по 5000 клиентов, чтобы массивы
+-- и агрегаты одного вызова оставались небольшими
+DO $$
+DECLARE
+    batch INTEGER[];
+    last_client_id INTEGER := -2147483648;
+BEGIN
+    LOOP
+        SELECT array_agg(client_id ORDER BY client_id) INTO batch
+        FROM (
+            SELECT DISTINCT client_id FROM t_p14771149_mfo_client_cabinet.amocrm_deals
+            WHERE client_id > last_client_id
+            ORDER BY client_id
+            LIMIT 5000
+        ) ids;
+        EXIT WHEN batch IS NULL;
+        PERFORM t_p14771149_mfo_client_cabinet.refresh_client_deal_summary(batch);
+        last_client_id := batch[array_length(batch, 1)];
+    END LOOP;
+END $$;
@@ -0,0 +1,9 @@
+-- Кеш справочников AmoCRM (воронки и статусы) на случай холодного старта функций:
+-- экземпляр берёт готовый payload из БД вместо запроса /api/v4/leads/pipelines.
+-- Сброс - expires_at = NOW() (вебхук или неизвестный статус в сделке).
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.amocrm_metadata_cache (
+    cache_key VARCHAR(50) PRIMARY KEY,
+    payload JSONB NOT NULL,
+    fetched_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
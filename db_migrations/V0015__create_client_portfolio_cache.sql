@@ -0,0 +1,82 @@
+-- Активные займы клиента по ближайшему платежу - основной запрос портфеля в кабинете
+CREATE INDEX IF NOT EXISTS idx_loans_client_active_next_payment
+    ON t_p14771149_mfo_client_cabinet.loans(client_id, next_payment_date)
+    WHERE status = 'active';
+
+-- Готовый JSON портфеля (лимит + активные займы) по клиенту. Данные производные, поэтому
+-- UNLOGGED: после сбоя таблица пустая и заполняется заново при первом запросе.
+-- generation растёт при каждой записи в loans/client_limits клиента: читатель сохраняет
+-- проекцию, только если поколение не сменилось, пока он её считал, - устаревший расчёт
+-- не перезапишет сброс от параллельной записи.
+CREATE UNLOGGED TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.client_portfolio_cache (
+    client_id INTEGER PRIMARY KEY,
+    payload JSONB,
+    generation BIGINT NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Любая запись в loans или client_limits сбрасывает проекцию затронутых клиентов.
+-- Триггеры уровня оператора: массовое начисление по миллиону займов - один upsert по клиентам,
+-- а не миллион срабатываний. Таблицы переходов допустимы только у триггера с одним событием.
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio()
+RETURNS trigger AS $$
+DECLARE
+    affected INTEGER[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        affected := ARRAY(SELECT DISTINCT client_id FROM new_rows WHERE client_id IS NOT NULL);
+    ELSIF TG_OP = 'UPDATE' THEN
+        affected := ARRAY(
+            SELECT client_id FROM new_rows WHERE client_id IS NOT NULL
+            UNION
+            SELECT client_id FROM old_rows WHERE client_id IS NOT NULL
+        );
+    ELSE
+        affected := ARRAY(SELECT DISTINCT client_id FROM old_rows WHERE client_id IS NOT NULL);
+    END IF;
+
+    INSERT INTO t_p14771149_mfo_client_cabinet.client_portfolio_cache AS cache (client_id, payload, generation)
+    SELECT client_id, NULL, 1 FROM unnest(affected) AS client_id ORDER BY client_id
+    ON CONFLICT (client_id) DO UPDATE SET
+        payload = NULL,
+        generation = cache.generation + 1,
+        refreshed_at = NOW();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_loans_portfolio_insert ON t_p14771149_mfo_client_cabinet.loans;
+CREATE TRIGGER trg_loans_portfolio_insert
+    AFTER INSERT ON t_p14771149_mfo_client_cabinet.loans
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
+
+DROP TRIGGER IF EXISTS trg_loans_portfolio_update ON t_p14771149_mfo_client_cabinet.loans;
+CREATE TRIGGER trg_loans_portfolio_update
+    AFTER UPDATE ON t_p14771149_mfo_client_cabinet.loans
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
+
+DROP TRIGGER IF EXISTS trg_loans_portfolio_delete ON t_p14771149_mfo_client_cabinet.loans;
+CREATE TRIGGER trg_loans_portfolio_delete
+    AFTER DELETE ON t_p14771149_mfo_client_cabinet.loans
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
+
+DROP TRIGGER IF EXISTS trg_client_limits_portfolio_insert ON t_p14771149_mfo_client_cabinet.client_limits;
+CREATE TRIGGER trg_client_limits_portfolio_insert
+    AFTER INSERT ON t_p14771149_mfo_client_cabinet.client_limits
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
+
+DROP TRIGGER IF EXISTS trg_client_limits_portfolio_update ON t_p14771149_mfo_client_cabinet.client_limits;
+CREATE TRIGGER trg_client_limits_portfolio_update
+    AFTER UPDATE ON t_p14771149_mfo_client_cabinet.client_limits
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
+
+DROP TRIGGER IF EXISTS trg_client_limits_portfolio_delete ON t_p14771149_mfo_client_cabinet.client_limits;
+CREATE TRIGGER trg_client_limits_portfolio_delete
+    AFTER DELETE ON t_p14771149_mfo_client_cabinet.client_limits
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.invalidate_client_portfolio();
@@ -0,0 +1,12 @@
+-- Поля, которые ведёт ночной расчёт loan-accrual: начисленные проценты, дата, по которую
+-- они начислены, и просрочка по ближайшему платежу
+ALTER TABLE t_p14771149_mfo_client_cabinet.loans
+    ADD COLUMN IF NOT EXISTS accrued_interest DECIMAL(12, 2) NOT NULL DEFAULT 0.00,
+    ADD COLUMN IF NOT EXISTS accrued_through DATE,
+    ADD COLUMN IF NOT EXISTS is_overdue BOOLEAN NOT NULL DEFAULT FALSE,
+    ADD COLUMN IF NOT EXISTS days_overdue INTEGER NOT NULL DEFAULT 0;
+
+-- Выборка расчёта: активные займы порциями по id, ещё не начисленные на дату запуска
+CREATE INDEX IF NOT EXISTS idx_loans_active_accrual
+    ON t_p14771149_mfo_client_cabinet.loans(id, accrued_through)
+    WHERE status = 'active';
@@ -0,0 +1,18 @@
+-- Журнал пересчётов client_limits: watermark - максимальный loans.updated_at, учтённый запуском.
+-- Следующий запуск пересчитывает только клиентов, чьи займы менялись позже него.
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.client_limits_recalc_runs (
+    id BIGSERIAL PRIMARY KEY,
+    mode VARCHAR(20) NOT NULL,
+    since_watermark TIMESTAMP,
+    watermark TIMESTAMP,
+    clients_checked INTEGER NOT NULL DEFAULT 0,
+    rows_inserted INTEGER NOT NULL DEFAULT 0,
+    rows_updated INTEGER NOT NULL DEFAULT 0,
+    duration_ms INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Поиск изменённых займов по watermark и MAX(updated_at) без полного прохода по loans
+CREATE INDEX IF NOT EXISTS idx_loans_updated_at
+    ON t_p14771149_mfo_client_cabinet.loans(updated_at);
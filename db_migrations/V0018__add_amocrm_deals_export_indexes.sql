@@ -0,0 +1,11 @@
+-- Выгрузка сделок для отчётности (deals-export): порции идут по курсору в порядке индекса,
+-- поэтому в каждый индекс входит ключ сортировки до id включительно.
+-- Фильтр по периоду создания - порядок (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_amocrm_deals_created_at_id
+    ON t_p14771149_mfo_client_cabinet.amocrm_deals(created_at, id);
+-- Статус в периоде - тот же порядок внутри статуса
+CREATE INDEX IF NOT EXISTS idx_amocrm_deals_status_created_at_id
+    ON t_p14771149_mfo_client_cabinet.amocrm_deals(status_id, created_at, id);
+-- Только статус, без периода - порядок id
+CREATE INDEX IF NOT EXISTS idx_amocrm_deals_status_id
+    ON t_p14771149_mfo_client_cabinet.amocrm_deals(status_id, id);
@@ -0,0 +1,136 @@
+-- История смен статусов сделок: только добавление, пишет вебхук amocrm-webhook.
+-- entered_old_at - когда сделка попала в old_status_id (предыдущая смена статуса), по нему
+-- считается время в статусе. Повторная доставка того же вебхука отсекается уникальным ключом.
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.deal_status_history (
+    id BIGSERIAL PRIMARY KEY,
+    lead_id BIGINT NOT NULL,
+    pipeline_id BIGINT,
+    old_status_id BIGINT,
+    new_status_id BIGINT NOT NULL,
+    changed_at TIMESTAMP NOT NULL,
+    entered_old_at TIMESTAMP,
+    seconds_in_old_status BIGINT GENERATED ALWAYS AS (
+        CASE WHEN entered_old_at IS NOT NULL AND changed_at >= entered_old_at
+             THEN EXTRACT(EPOCH FROM changed_at - entered_old_at)::BIGINT END
+    ) STORED,
+    recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT unique_deal_status_change UNIQUE (lead_id, new_status_id, changed_at)
+);
+
+-- Строки приходят почти по порядку времени - BRIN на несколько страниц вместо B-дерева на всю таблицу
+CREATE INDEX IF NOT EXISTS idx_deal_status_history_changed_at_brin
+    ON t_p14771149_mfo_client_cabinet.deal_status_history USING BRIN (changed_at);
+CREATE INDEX IF NOT EXISTS idx_deal_status_history_recorded_at_brin
+    ON t_p14771149_mfo_client_cabinet.deal_status_history USING BRIN (recorded_at);
+
+-- Таблица только на добавление: правка или удаление истории исказили бы накопленные срезы
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.deal_status_history_append_only()
+RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'deal_status_history is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_deal_status_history_append_only ON t_p14771149_mfo_client_cabinet.deal_status_history;
+CREATE TRIGGER trg_deal_status_history_append_only
+    BEFORE UPDATE OR DELETE ON t_p14771149_mfo_client_cabinet.deal_status_history
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.deal_status_history_append_only();
+
+-- Срезы воронки по часам и по дням: переходы old_status_id -> new_status_id в этапе воронки и
+-- суммарное время, проведённое в old_status_id. NULL-воронка и NULL-статус хранятся как 0,
+-- чтобы войти в первичный ключ.
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.deal_funnel_hourly (
+    bucket TIMESTAMP NOT NULL,
+    pipeline_id BIGINT NOT NULL,
+    old_status_id BIGINT NOT NULL,
+    new_status_id BIGINT NOT NULL,
+    transitions INTEGER NOT NULL DEFAULT 0,
+    timed_transitions INTEGER NOT NULL DEFAULT 0,
+    seconds_in_old_status BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, pipeline_id, old_status_id, new_status_id)
+);
+
+CREATE TABLE IF NOT EXISTS t_p14771149_mfo_client_cabinet.deal_funnel_daily (
+    bucket DATE NOT NULL,
+    pipeline_id BIGINT NOT NULL,
+    old_status_id BIGINT NOT NULL,
+    new_status_id BIGINT NOT NULL,
+    transitions INTEGER NOT NULL DEFAULT 0,
+    timed_transitions INTEGER NOT NULL DEFAULT 0,
+    seconds_in_old_status BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, pipeline_id, old_status_id, new_status_id)
+);
+
+-- Срезы пополняются триггером уровня оператора: пачка событий вебхука - один upsert в каждый
+-- срез по сгруппированным строкам, без повторного чтения истории
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.deal_status_history_rollup()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO t_p14771149_mfo_client_cabinet.deal_funnel_hourly AS f
+        (bucket, pipeline_id, old_status_id, new_status_id, transitions, timed_transitions, seconds_in_old_status)
+    SELECT date_trunc('hour', changed_at), COALESCE(pipeline_id, 0), COALESCE(old_status_id, 0), new_status_id,
+           COUNT(*), COUNT(seconds_in_old_status), COALESCE(SUM(seconds_in_old_status), 0)
+    FROM new_rows
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (bucket, pipeline_id, old_status_id, new_status_id) DO UPDATE SET
+        transitions = f.transitions + EXCLUDED.transitions,
+        timed_transitions = f.timed_transitions + EXCLUDED.timed_transitions,
+        seconds_in_old_status = f.seconds_in_old_status + EXCLUDED.seconds_in_old_status;
+
+    INSERT INTO t_p14771149_mfo_client_cabinet.deal_funnel_daily AS f
+        (bucket, pipeline_id, old_status_id, new_status_id, transitions, timed_transitions, seconds_in_old_status)
+    SELECT changed_at::date, COALESCE(pipeline_id, 0), COALESCE(old_status_id, 0), new_status_id,
+           COUNT(*), COUNT(seconds_in_old_status), COALESCE(SUM(seconds_in_old_status), 0)
+    FROM new_rows
+    GROUP BY 1, 2, 3, 4
+    ORDER BY 1, 2, 3, 4
+    ON CONFLICT (bucket, pipeline_id, old_status_id, new_status_id) DO UPDATE SET
+        transitions = f.transitions + EXCLUDED.transitions,
+        timed_transitions = f.timed_transitions + EXCLUDED.timed_transitions,
+        seconds_in_old_status = f.seconds_in_old_status + EXCLUDED.seconds_in_old_status;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_deal_status_history_rollup ON t_p14771149_mfo_client_cabinet.deal_status_history;
+CREATE TRIGGER trg_deal_status_history_rollup
+    AFTER INSERT ON t_p14771149_mfo_client_cabinet.deal_status_history
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.deal_status_history_rollup();
+
+-- Воронка по дням для дашбордов: по каждому статусу - сколько сделок вошло и вышло,
+-- конверсия в каждый следующий статус и среднее время в статусе. Читает только срез.
+CREATE OR REPLACE VIEW t_p14771149_mfo_client_cabinet.deal_funnel_daily_stats AS
+WITH entered AS (
+    SELECT bucket, pipeline_id, new_status_id AS status_id, SUM(transitions) AS entered
+    FROM t_p14771149_mfo_client_cabinet.deal_funnel_daily
+    GROUP BY 1, 2, 3
+)
+SELECT f.bucket,
+       f.pipeline_id,
+       f.old_status_id AS status_id,
+       f.new_status_id AS next_status_id,
+       f.transitions,
+       e.entered,
+       ROUND(f.transitions::numeric / NULLIF(e.entered, 0), 4) AS conversion,
+       ROUND(f.seconds_in_old_status::numeric / NULLIF(f.timed_transitions, 0)) AS avg_seconds_in_status
+FROM t_p14771149_mfo_client_cabinet.deal_funnel_daily f
+LEFT JOIN entered e
+    ON e.bucket = f.bucket AND e.pipeline_id = f.pipeline_id AND e.status_id = f.old_status_id;
+
+-- Перенос уже накопленных уведомлений: воронки в них нет, время в статусе - по предыдущему
+-- уведомлению той же сделки. Срезы заполнит триггер.
+INSERT INTO t_p14771149_mfo_client_cabinet.deal_status_history
+    (lead_id, old_status_id, new_status_id, changed_at, entered_old_at)
+SELECT lead_id, old_status_id, new_status_id, changed_at, entered_old_at
+FROM (
+    SELECT lead_id, old_status_id, new_status_id,
+           created_at AS changed_at,
+           CASE WHEN LAG(new_status_id) OVER w = old_status_id THEN LAG(created_at) OVER w END AS entered_old_at
+    FROM t_p14771149_mfo_client_cabinet.webhook_notifications
+    WHERE created_at IS NOT NULL
+    WINDOW w AS (PARTITION BY lead_id ORDER BY created_at, id)
+) n
+ORDER BY changed_at
+ON CONFLICT ON CONSTRAINT unique_deal_status_change DO NOTHING;
@@ -0,0 +1,24 @@
+-- Время последнего изменения строки зеркала amocrm_clients: по нему фильтр телефонов
+-- (phone_filter) дозагружает не только новые строки, но и строки с изменённым номером.
+-- Существующие строки получают время миграции - их и так прочитает полная перестройка фильтра.
+ALTER TABLE t_p14771149_mfo_client_cabinet.amocrm_clients
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- clock_timestamp, а не время начала транзакции: долгий импорт clients-bulk не должен
+-- проставить строкам время намного раньше своей фиксации
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_clients_touch_updated_at()
+RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_amocrm_clients_touch_updated_at ON t_p14771149_mfo_client_cabinet.amocrm_clients;
+CREATE TRIGGER trg_amocrm_clients_touch_updated_at
+    BEFORE INSERT OR UPDATE ON t_p14771149_mfo_client_cabinet.amocrm_clients
+    FOR EACH ROW EXECUTE FUNCTION t_p14771149_mfo_client_cabinet.amocrm_clients_touch_updated_at();
+
+-- Дозагрузка фильтра раз в минуту читает только строки новее отметки
+CREATE INDEX IF NOT EXISTS idx_amocrm_clients_updated_at
+    ON t_p14771149_mfo_client_cabinet.amocrm_clients(updated_at);
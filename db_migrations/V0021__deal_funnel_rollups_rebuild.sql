@@ -0,0 +1,56 @@
+-- Обслуживание истории статусов и срезов воронки: удаление подложных записей за окно приёма
+-- (например, пока вебхук принимал запросы без секрета) и пересборка срезов из истории.
+-- Удаление разрешено только внутри rebuild_deal_funnel_rollups: она включает на время своей
+-- транзакции настройку deal_status_history.purge, остальные UPDATE/DELETE по-прежнему запрещены.
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.deal_status_history_append_only()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('deal_status_history.purge', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    RAISE EXCEPTION 'deal_status_history is append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Срезы собираются заново той же группировкой, что и в триггере deal_status_history_rollup.
+-- purge_from/purge_to (по recorded_at, полуинтервал) - необязательное окно удаляемых записей.
+-- entered_old_at у записей после удалённых не пересчитывается: время в статусе по таким
+-- сделкам может остаться завышенным или заниженным, переходы считаются верно.
+CREATE OR REPLACE FUNCTION t_p14771149_mfo_client_cabinet.rebuild_deal_funnel_rollups(
+    purge_from TIMESTAMP DEFAULT NULL,
+    purge_to TIMESTAMP DEFAULT NULL
+)
+RETURNS TABLE (purged_rows BIGINT, history_rows BIGINT) AS $$
+DECLARE
+    v_purged BIGINT := 0;
+BEGIN
+    -- Вставки вебхука ждут конца пересборки: иначе их строки попали бы в срез дважды или ни разу
+    LOCK TABLE t_p14771149_mfo_client_cabinet.deal_status_history IN SHARE ROW EXCLUSIVE MODE;
+
+    IF purge_from IS NOT NULL AND purge_to IS NOT NULL THEN
+        PERFORM set_config('deal_status_history.purge', 'on', true);
+        DELETE FROM t_p14771149_mfo_client_cabinet.deal_status_history
+        WHERE recorded_at >= purge_from AND recorded_at < purge_to;
+        GET DIAGNOSTICS v_purged = ROW_COUNT;
+        PERFORM set_config('deal_status_history.purge', 'off', true);
+    END IF;
+
+    TRUNCATE t_p14771149_mfo_client_cabinet.deal_funnel_hourly, t_p14771149_mfo_client_cabinet.deal_funnel_daily;
+
+    INSERT INTO t_p14771149_mfo_client_cabinet.deal_funnel_hourly
+        (bucket, pipeline_id, old_status_id, new_status_id, transitions, timed_transitions, seconds_in_old_status)
+    SELECT date_trunc('hour', h.changed_at), COALESCE(h.pipeline_id, 0), COALESCE(h.old_status_id, 0), h.new_status_id,
+           COUNT(*), COUNT(h.seconds_in_old_status), COALESCE(SUM(h.seconds_in_old_status), 0)
+    FROM t_p14771149_mfo_client_cabinet.deal_status_history h
+    GROUP BY 1, 2, 3, 4;
+
+    INSERT INTO t_p14771149_mfo_client_cabinet.deal_funnel_daily
+        (bucket, pipeline_id, old_status_id, new_status_id, transitions, timed_transitions, seconds_in_old_status)
+    SELECT h.changed_at::date, COALESCE(h.pipeline_id, 0), COALESCE(h.old_status_id, 0), h.new_status_id,
+           COUNT(*), COUNT(h.seconds_in_old_status), COALESCE(SUM(h.seconds_in_old_status), 0)
+    FROM t_p14771149_mfo_client_cabinet.deal_status_history h
+    GROUP BY 1, 2, 3, 4;
+
+    RETURN QUERY SELECT v_purged, (SELECT COUNT(*) FROM t_p14771149_mfo_client_cabinet.deal_status_history);
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,205 @@
+'''
+Сколько запросов одновременно держит один процесс, когда CRM отвечают медленно.
+
+Сеть подменяется httpx.MockTransport, который отвечает заготовками AmoCRM, Битрикс24 и MegaCRM
+с задержкой --latency мс (плюс случайные --jitter мс). Для каждой функции три режима:
+  blocking - handler() по одному, как платформа вызывает функцию: в полёте один запрос;
+  threads  - handler() из --threads потоков, как selfhost под gthread: все ждут в общем цикле aio;
+  async    - --concurrency корутин handler_async() в одном цикле, как асинхронный рантайм.
+Печатает запросов в секунду, p50/p95 и среднее число запросов в полёте (rps x среднее время).
+
+    python selfhost/async_bench.py --latency 200 --concurrency 500 --duration 10
+
+sms-auth ходит в Postgres: она участвует, только если задан DATABASE_URL (нужна схема из
+db_migrations). Справочник воронок amocrm_metadata грузится через requests и в замер не входит -
+он подставляется заготовкой до прогона.
+'''
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType, SimpleNamespace
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+PHONE = '79991234567'
+
+CONTACT = {
+    'id': 101, 'name': 'Иван Петров', 'first_name': 'Иван', 'last_name': 'Петров',
+    'custom_fields_values': [{'field_code': 'PHONE', 'values': [{'value': f'+{PHONE}'}]}]
+}
+LEADS = [
+    {'id': 9000 + i, 'name': f'Заявка {i}', 'price': 10000 + i, 'status_id': 142, 'pipeline_id': 7,
+     'created_at': 1700000000 + i, 'updated_at': 1700100000 + i}
+    for i in range(20)
+]
+METADATA = {'pipelines': {'7': 'Займы'}, 'statuses': {'7:142': {'name': 'Выдан', 'color': '#99ccff'}}}
+
+
+def upstream(request: httpx.Request) -> httpx.Response:
+    '''Заготовленный ответ по адресу запроса'''
+    path = request.url.path
+    if path == '/api/v4/contacts':
+        return httpx.Response(200, json={'_embedded': {'contacts': [CONTACT]}})
+    if path.startswith('/api/v4/contacts/'):
+        return httpx.Response(200, json=CONTACT)
+    if path == '/api/v4/leads':
+        return httpx.Response(200, json={'_page': 1, '_embedded': {'leads': LEADS}})
+    if path.endswith('/batch.json'):
+        deals = [{'ID': str(lead['id']), 'TITLE': lead['name'], 'STAGE_ID': 'NEW', 'OPPORTUNITY': '1000',
+                  'DATE_CREATE': '2024-01-01', 'DATE_MODIFY': '2024-01-02'} for lead in LEADS]
+        return httpx.Response(200, json={'result': {
+            'result': {'find': {'CONTACT': [101]}, 'contact': [{'ID': '101', 'NAME': 'Иван', 'LAST_NAME': 'Петров'}],
+                       'deals': deals},
+            'result_error': {}, 'result_next': {}, 'result_total': {'deals': len(deals)}
+        }})
+    if path == '/v1/clients':
+        return httpx.Response(200, json={'result': [{'id': 55, 'name': 'Иван', 'last_name': 'Петров'}]})
+    if path == '/v1/deals':
+        return httpx.Response(200, json={'result': [{'id': lead['id'], 'title': lead['name']} for lead in LEADS],
+                                         'total': len(LEADS)})
+    return httpx.Response(404, json={})
+
+
+def latency_transport(latency: float, jitter: float) -> httpx.MockTransport:
+    async def respond(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency + random.random() * jitter)
+        return upstream(request)
+    return httpx.MockTransport(respond)
+
+
+def load(name: str) -> ModuleType:
+    '''index.py функции со своими модулями-копиями (aio, phones, ...), как при деплое'''
+    directory = os.path.join(BACKEND_DIR, name)
+    for module_name in [f[:-3] for f in os.listdir(directory) if f.endswith('.py')]:
+        sys.modules.pop(module_name, None)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f'bench_{name.replace("-", "_")}', os.path.join(directory, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    return module
+
+
+def event_for(name: str) -> Dict[str, Any]:
+    if name == 'sms-auth':
+        return {'httpMethod': 'POST', 'body': json.dumps({'phone': PHONE, 'action': 'verify', 'code': '0000'}),
+                'requestContext': {'identity': {'sourceIp': '127.0.0.1'}}}
+    return {'httpMethod': 'GET', 'queryStringParameters': {'phone': PHONE}}
+
+
+def summarize(mode: str, latencies: List[float], failed: int, elapsed: float) -> Dict[str, Any]:
+    ordered = sorted(latencies) or [0.0]
+    rps = len(latencies) / elapsed
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'rps': round(rps, 1),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 1),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+        # Закон Литтла: сколько запросов в среднем было в полёте одновременно
+        'in_flight': round(rps * statistics.mean(ordered), 1),
+        'failed': failed
+    }
+
+
+def run_threads(module: ModuleType, event: Dict[str, Any], expected: int, threads: int, duration: float) -> Tuple[List[float], int, float]:
+    latencies: List[float] = []
+    failed = [0]
+    lock = threading.Lock()
+    started_at = time.monotonic()
+    deadline = started_at + duration
+    context = SimpleNamespace(request_id='bench', function_name='bench')
+
+    def worker() -> None:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            status = module.handler(dict(event), context)['statusCode']
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                failed[0] += status != expected
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in range(threads):
+            executor.submit(worker)
+    return latencies, failed[0], time.monotonic() - started_at
+
+
+async def run_async(module: ModuleType, event: Dict[str, Any], expected: int, concurrency: int, duration: float) -> Tuple[List[float], int, float]:
+    latencies: List[float] = []
+    failed = 0
+    started_at = time.monotonic()
+    deadline = started_at + duration
+    context = SimpleNamespace(request_id='bench', function_name='bench')
+
+    async def worker() -> None:
+        nonlocal failed
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            status = (await module.handler_async(dict(event), context))['statusCode']
+            latencies.append(time.perf_counter() - started)
+            failed += status != expected
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failed, time.monotonic() - started_at
+
+
+def bench(name: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    module = load(name)
+    module.aio.use_transport(latency_transport(args.latency / 1000, args.jitter / 1000))
+    if hasattr(module, 'amocrm_metadata'):
+        module.amocrm_metadata.fetch_pipelines = lambda base_url, access_token: METADATA
+    event = event_for(name)
+    # Для sms-auth verify без запрошенного кода - 400, остальные отдают клиента и сделки
+    expected = 400 if name == 'sms-auth' else 200
+    module.handler(dict(event), None)
+
+    rows = []
+    # Время прогона - до последнего ответа: запросы, начатые до конца окна, тоже считаются
+    rows.append(summarize('blocking', *run_threads(module, event, expected, 1, args.duration)))
+    rows.append(summarize(f'threads x{args.threads}', *run_threads(module, event, expected, args.threads, args.duration)))
+    rows.append(summarize(f'async x{args.concurrency}', *asyncio.run(run_async(module, event, expected, args.concurrency, args.duration))))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Конкурентность функций с handler_async на один процесс')
+    parser.add_argument('--functions', default='get-client-deals,amocrm-get-deals,bitrix24-get-deals,megagroup,sms-auth')
+    parser.add_argument('--latency', type=float, default=200.0, help='задержка ответа CRM, мс')
+    parser.add_argument('--jitter', type=float, default=50.0, help='случайная добавка к задержке, мс')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    os.environ.update({
+        'AMOCRM_SUBDOMAIN': 'bench', 'AMOCRM_ACCESS_TOKEN': 'bench', 'BITRIX24_WEBHOOK_URL': 'https://bench.bitrix24.ru/rest/1/x',
+        'MEGAGROUP_API_KEY': 'bench', 'MEGAGROUP_ACCOUNT_ID': 'bench', 'SMSRU_API_KEY': 'bench'
+    })
+    names = [name.strip() for name in args.functions.split(',') if name.strip()]
+    if 'sms-auth' in names and not os.environ.get('DATABASE_URL'):
+        print('sms-auth пропущена: не задан DATABASE_URL')
+        names.remove('sms-auth')
+
+    print(f'latency={args.latency}ms jitter={args.jitter}ms duration={args.duration}s')
+    print(f"{'function':<22}{'mode':<14}{'req':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'in_flight':>11}{'bad':>6}")
+    for name in names:
+        for row in bench(name, args):
+            print(f"{name:<22}{row['mode']:<14}{row['requests']:>8}{row['rps']:>9}{row['p50_ms']:>9}"
+                  f"{row['p95_ms']:>9}{row['in_flight']:>11}{row['failed']:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Плановый запуск служебных функций по расписанию из backend/schedules.json.
+
+Очереди (lead_outbox, sms_outbox) и очистка просроченных кодов работают, только пока их
+функции вызываются. Платформа функций по расписанию их не вызывает, поэтому рядом с
+развёртыванием запускается этот процесс (один на всё развёртывание - задачи не должны
+дублироваться):
+
+    ADMIN_API_TOKEN=... python selfhost/cron.py --target per-function
+    ADMIN_API_TOKEN=... python selfhost/cron.py --target http://127.0.0.1:8000
+
+--target per-function - URL из func2url.json, иначе базовый адрес selfhost/runtime.py (путь /<имя>).
+--once вызывает все задачи один раз и завершается - для системного crontab или таймера systemd.
+Запрос идёт с заголовком X-Admin-Token; одна и та же задача не запускается, пока не ответил
+предыдущий её вызов.
+'''
+
+import argparse
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+from urllib.parse import urlparse
+
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+def load_jobs(target: str) -> List[Dict[str, Any]]:
+    with open(os.path.join(BACKEND_DIR, 'schedules.json')) as f:
+        schedules = json.load(f)
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        func2url = json.load(f)
+    jobs = []
+    for name, schedule in schedules.items():
+        if target != 'per-function':
+            url = f"{target.rstrip('/')}/{name}"
+        elif name in func2url:
+            url = func2url[name]
+        else:
+            raise SystemExit(f'{name} нет в func2url.json - укажите --target с адресом рантайма')
+        jobs.append({
+            'name': name,
+            'url': url,
+            'method': schedule.get('method', 'POST'),
+            'interval': float(schedule['interval_seconds']),
+            'next_run': 0.0,
+            'running': threading.Event()
+        })
+    return jobs
+
+
+def run_job(job: Dict[str, Any], token: str) -> None:
+    started = time.monotonic()
+    try:
+        response = requests.request(job['method'], job['url'], headers={'X-Admin-Token': token},
+                                    timeout=REQUEST_TIMEOUT_SECONDS)
+        print(f"[CRON] {job['name']}: HTTP {response.status_code} за {time.monotonic() - started:.1f}s {response.text[:300]}")
+    except requests.exceptions.RequestException as e:
+        print(f"[CRON] {job['name']}: ошибка вызова: {e}")
+    finally:
+        job['running'].clear()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Вызов функций по расписанию из backend/schedules.json')
+    parser.add_argument('--target', required=True, help='per-function или базовый URL рантайма')
+    parser.add_argument('--once', action='store_true', help='вызвать все задачи один раз и выйти')
+    args = parser.parse_args()
+
+    token = os.environ.get('ADMIN_API_TOKEN', '')
+    if not token:
+        raise SystemExit('ADMIN_API_TOKEN не задан: служебные функции без него отвечают 403')
+    jobs = load_jobs(args.target)
+    for job in jobs:
+        print(f"[CRON] {job['name']}: {job['method']} {urlparse(job['url']).path} каждые {job['interval']:g}s")
+
+    if args.once:
+        for job in jobs:
+            run_job(job, token)
+        return
+
+    while True:
+        now = time.monotonic()
+        for job in jobs:
+            if now < job['next_run'] or job['running'].is_set():
+                continue
+            job['running'].set()
+            job['next_run'] = now + job['interval']
+            threading.Thread(target=run_job, args=(job, token), name=f"cron-{job['name']}", daemon=True).start()
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+# Конфигурация gunicorn для selfhost/runtime.py: процессы и потоки задаются окружением
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WORKERS', str(multiprocessing.cpu_count())))
+# Функции ждут AmoCRM/SMS-шлюзы по секундам - потоки в процессе держат несколько запросов разом
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', '8'))
+# Функции грузятся один раз в мастере и достаются процессам через fork; пулы соединений
+# и HTTP-сессии создаются уже в процессе при первом запросе
+preload_app = True
+timeout = int(os.environ.get('TIMEOUT', '60'))
+accesslog = '-'
@@ -0,0 +1,136 @@
+'''
+Нагрузочное сравнение: функции по своим URL из func2url.json против selfhost/runtime.py.
+Запросы берутся из tests.json выбранных функций, поэтому проверяется то же, что и в тестах.
+
+    python selfhost/loadtest.py --target per-function --functions client-deals,sms-verify
+    python selfhost/loadtest.py --target http://127.0.0.1:8000 --functions client-deals,sms-verify
+
+--target per-function - URL из func2url.json, иначе базовый адрес рантайма (путь /<uuid> тот же).
+Печатает по каждой функции и в сумме: запросов в секунду, p50/p95/p99 и долю ответов
+с неожиданным статусом. --cold-pause N выдерживает паузу перед прогоном, чтобы платформа
+успела выгрузить экземпляры и в результат попал холодный старт.
+'''
+
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+
+
+def load_scenarios(functions: List[str], target: str) -> List[Tuple[str, Dict[str, Any], str]]:
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        func2url = json.load(f)
+    scenarios = []
+    for name in functions:
+        if name in func2url:
+            path = urlparse(func2url[name]).path
+            base = func2url[name] if target == 'per-function' else target.rstrip('/') + path
+        elif target != 'per-function':
+            base = f"{target.rstrip('/')}/{name}"
+        else:
+            raise SystemExit(f'{name} нет в func2url.json')
+        with open(os.path.join(BACKEND_DIR, name, 'tests.json')) as f:
+            for test in json.load(f)['tests']:
+                scenarios.append((name, test, base))
+    return scenarios
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(scenarios: List[Tuple[str, Dict[str, Any], str]], concurrency: int, duration: float) -> Dict[str, Dict[str, Any]]:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    failures: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset: int) -> None:
+        session = requests.Session()
+        index = offset
+        while time.monotonic() < deadline:
+            name, test, base = scenarios[index % len(scenarios)]
+            index += 1
+            path = test.get('path', '/')
+            query = ''
+            if '?' in path:
+                path, query = path.split('?', 1)
+            url = base.rstrip('/') + (path if path != '/' else '') + (f'?{query}' if query else '')
+            body = test.get('body')
+            started = time.perf_counter()
+            try:
+                response = session.request(
+                    test.get('method', 'GET'), url,
+                    data=json.dumps(body) if body is not None else None,
+                    headers={'Content-Type': 'application/json'}, timeout=30
+                )
+                ok = response.status_code == test.get('expectedStatus', response.status_code)
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[name].append(elapsed)
+                if not ok:
+                    failures[name] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = {}
+    for name, values in sorted(latencies.items()):
+        report[name] = summarize(values, failures[name], duration)
+    everything = [value for values in latencies.values() for value in values]
+    report['TOTAL'] = summarize(everything, sum(failures.values()), duration)
+    return report
+
+
+def summarize(values: List[float], failed: int, duration: float) -> Dict[str, Any]:
+    return {
+        'requests': len(values),
+        'rps': round(len(values) / duration, 1),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+        'mean_ms': round(statistics.mean(values) * 1000, 1) if values else 0.0,
+        'unexpected_status': round(failed / len(values), 4) if values else 0.0
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочное сравнение отдельных функций и selfhost-рантайма')
+    parser.add_argument('--target', required=True, help='per-function или базовый URL рантайма')
+    parser.add_argument('--functions', required=True, help='имена каталогов backend/ через запятую')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--cold-pause', type=float, default=0.0)
+    args = parser.parse_args()
+
+    scenarios = load_scenarios([name.strip() for name in args.functions.split(',') if name.strip()], args.target)
+    if args.cold_pause:
+        time.sleep(args.cold_pause)
+    report = run(scenarios, args.concurrency, args.duration)
+
+    print(f"target={args.target} concurrency={args.concurrency} duration={args.duration}s")
+    print(f"{'function':<22}{'req':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'bad':>8}")
+    for name, row in report.items():
+        print(f"{name:<22}{row['requests']:>8}{row['rps']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}"
+              f"{row['p99_ms']:>9}{row['unexpected_status']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Заказы клиента megagroup против поддельной MegaCRM с тысячами сделок.
+
+MegaCRM подменяется httpx.MockTransport: /v1/clients находит клиента, /v1/deals отдаёт
+--deals сделок страницами по limit/offset с задержкой --latency мс на запрос. Режимы:
+  sequential - страницы по одной (ORDERS_FETCH_WORKERS=1);
+  concurrent - после первой страницы остальные параллельно, как в функции;
+  no-total   - MegaCRM не сообщает total, страницы идут последовательно до неполной.
+Для каждого режима - время ответа, число запросов к MegaCRM, пик памяти Python (tracemalloc)
+при сборке тела строкой (handler) и при отдаче частями (handler_async, как в AsyncRuntime).
+
+    python selfhost/megagroup_bench.py --deals 5000 --latency 100
+'''
+
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict
+
+import httpx
+
+from async_bench import PHONE, load
+
+
+def fake_megacrm(deals: int, latency: float, with_total: bool, counter: Dict[str, int]) -> httpx.MockTransport:
+    async def respond(request: httpx.Request) -> httpx.Response:
+        counter['requests'] += 1
+        await asyncio.sleep(latency)
+        if request.url.path == '/v1/clients':
+            return httpx.Response(200, json={'result': [{'id': 55, 'name': 'Иван', 'last_name': 'Петров'}]})
+        offset = int(request.url.params.get('offset', 0))
+        limit = int(request.url.params.get('limit', 100))
+        page = [
+            {'id': i, 'ui_id': f'D-{i}', 'created': '2024-01-01 12:00:00', 'title': f'Сделка {i}',
+             'stage': {'name': 'В работе'}}
+            for i in range(offset, min(offset + limit, deals))
+        ]
+        payload: Dict[str, Any] = {'result': page}
+        if with_total:
+            payload['total'] = deals
+        return httpx.Response(200, json=payload)
+    return httpx.MockTransport(respond)
+
+
+async def streamed_size(module: Any, event: Dict[str, Any], context: Any) -> int:
+    '''Как AsyncRuntime: тело читается итератором и сразу отбрасывается'''
+    result = await module.handler_async(dict(event), context)
+    return sum(len(chunk.encode('utf-8')) for chunk in result['body'])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='megagroup: постраничная загрузка заказов против поддельной MegaCRM')
+    parser.add_argument('--deals', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=100.0, help='задержка ответа MegaCRM, мс')
+    args = parser.parse_args()
+
+    os.environ.update({'MEGAGROUP_API_KEY': 'bench', 'MEGAGROUP_ACCOUNT_ID': 'bench'})
+    module = load('megagroup')
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'phone': PHONE}}
+    context = SimpleNamespace(request_id='bench', function_name='bench')
+    workers = module.ORDERS_FETCH_WORKERS
+
+    print(f'deals={args.deals} latency={args.latency}ms page={module.ORDERS_PAGE_SIZE} workers={workers}')
+    print(f"{'mode':<12}{'status':>8}{'seconds':>10}{'requests':>10}{'body_kb':>10}{'peak_join_kb':>14}{'peak_stream_kb':>16}")
+    for mode, fetch_workers, with_total in (('sequential', 1, True), ('concurrent', workers, True), ('no-total', workers, False)):
+        module.ORDERS_FETCH_WORKERS = fetch_workers
+        counter = {'requests': 0}
+        module.aio.use_transport(fake_megacrm(args.deals, args.latency / 1000, with_total, counter))
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        result = module.handler(dict(event), context)
+        elapsed = time.perf_counter() - started
+        status, requests_made = result['statusCode'], counter['requests']
+        body_size = len(result['body'].encode('utf-8'))
+        peak_join = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+
+        tracemalloc.start()
+        module.aio.run(streamed_size(module, event, context))
+        peak_stream = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"{mode:<12}{status:>8}{elapsed:>10.2f}{requests_made:>10}{body_size // 1024:>10}"
+              f"{peak_join // 1024:>14}{peak_stream // 1024:>16}")
+    module.ORDERS_FETCH_WORKERS = workers
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+'''
+Пакетная нормализация телефонов: phones.normalize_many против прежних циклов.
+
+Генерирует --count номеров в смеси записей (канонические из зеркала, +7 (...), 8 ..., 10 цифр)
+с долей дублей --dup и сравнивает на одном и том же списке:
+  legacy_loop    - прежний цикл phone_filter: normalize по одному + set для дублей;
+  normalize_loop - phones.normalize по одному + dict.fromkeys;
+  normalize_many - один проход с быстрым путём для канонических номеров.
+Печатает лучшее время из --repeat прогонов и нс на номер.
+
+    python selfhost/phones_bench.py --count 300000
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from phones_check import FORMS, legacy_phone_filter, phones, subscriber  # noqa: E402
+
+
+def legacy_loop(batch: List[str]) -> List[str]:
+    seen = set()
+    result = []
+    for value in batch:
+        digits = legacy_phone_filter(value)
+        if digits and digits not in seen:
+            seen.add(digits)
+            result.append(digits)
+    return result
+
+
+def normalize_loop(batch: List[str]) -> List[str]:
+    return list(dict.fromkeys(n for n in (phones.normalize(value) for value in batch) if n))
+
+
+def best_of(fn: Callable[[List[str]], List[str]], batch: List[str], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(batch)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Скорость пакетной нормализации телефонов')
+    parser.add_argument('--count', type=int, default=300000)
+    parser.add_argument('--dup', type=float, default=0.1, help='доля повторов в пачке')
+    parser.add_argument('--canonical', type=float, default=0.5, help='доля уже канонических номеров')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=35)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    forms = [form for name, form in FORMS.items() if name != 'canonical']
+    batch: List[str] = []
+    for _ in range(args.count):
+        if batch and rng.random() < args.dup:
+            batch.append(rng.choice(batch))
+        elif rng.random() < args.canonical:
+            batch.append('7' + subscriber(rng))
+        else:
+            batch.append(rng.choice(forms)(subscriber(rng)))
+
+    # Результаты совпадают: 10-значные 8XX прежний цикл тоже дополняет 7 впереди
+    assert legacy_loop(batch) == normalize_loop(batch) == phones.normalize_many(batch)
+
+    print(f'count={args.count} dup={args.dup} canonical={args.canonical} repeat={args.repeat}')
+    print(f"{'variant':<16}{'seconds':>10}{'ns/phone':>10}")
+    for name, fn in (('legacy_loop', legacy_loop), ('normalize_loop', normalize_loop), ('normalize_many', phones.normalize_many)):
+        seconds = best_of(fn, batch, args.repeat)
+        print(f'{name:<16}{seconds:>10.3f}{seconds / args.count * 1e9:>10.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+Проверка phones.py против пяти прежних нормализаций телефона, которые он заменил.
+
+Прежние варианты (до общего модуля):
+  phone_filter - 10 цифр -> 7 + цифры, ведущая 8 -> 7 (amocrm-get-deals, get-client-deals, sms-auth);
+  e164         - 8 -> 7, без 7 впереди - дописать 7, затем + (client-auth, client-deals, create-deal);
+  search       - то же без + (normalize_phone в get-client-deals);
+  strip        - убрать + - ( ) и пробелы (sms-auth, bitrix24-get-deals);
+  digits       - оставить только цифры (megagroup, sms-send).
+
+Свойства на сгенерированных номерах (--count, --seed):
+  1. любая запись валидного номера (+7 (999) ..., 8 999 ..., 8999..., 7999..., 999..., с мусором
+     между цифрами) даёт каноническое 7XXXXXXXXXX, to_e164 - его же с +, is_valid - True;
+  2. если прежний вариант давал канонический номер (или +канонический у e164), новый даёт тот же;
+     расхождения допустимы только там, где прежний вариант выдавал неканонический номер -
+     они печатаются по варианту и записи, чтобы было видно, что меняется;
+  3. normalize_many(x) == порядок первых вхождений непустых normalize(x) на смеси валидных
+     номеров, дублей, мусора и нелатинских цифр;
+  4. все копии backend/*/phones.py совпадают.
+Завершается с ошибкой, если хоть одно свойство нарушено.
+
+    python selfhost/phones_check.py --count 100000
+'''
+
+import argparse
+import glob
+import hashlib
+import os
+import random
+import string
+import sys
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'get-client-deals'))
+
+import phones  # noqa: E402
+
+
+def legacy_phone_filter(phone: str) -> str:
+    digits = ''.join(filter(str.isdigit, phone))
+    if len(digits) == 10:
+        digits = '7' + digits
+    if digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return digits
+
+
+def legacy_search(phone: str) -> str:
+    clean = ''.join(filter(str.isdigit, phone))
+    if clean.startswith('8'):
+        clean = '7' + clean[1:]
+    if not clean.startswith('7'):
+        clean = '7' + clean
+    return clean
+
+
+def legacy_e164(phone: str) -> str:
+    return '+' + legacy_search(phone)
+
+
+def legacy_strip(phone: str) -> str:
+    return phone.replace('+', '').replace('-', '').replace('(', '').replace(')', '').replace(' ', '')
+
+
+def legacy_digits(phone: str) -> str:
+    return ''.join(filter(str.isdigit, phone))
+
+
+# Вариант -> (прежняя функция, чем её заменили)
+LEGACY: Dict[str, Tuple[Callable[[str], str], Callable[[str], str]]] = {
+    'phone_filter': (legacy_phone_filter, phones.normalize),
+    'e164': (legacy_e164, phones.to_e164),
+    'search': (legacy_search, phones.normalize),
+    'strip': (legacy_strip, phones.normalize),
+    'digits': (legacy_digits, phones.normalize),
+}
+
+FORMS: Dict[str, Callable[[str], str]] = {
+    'canonical': lambda s: '7' + s,
+    'plus7': lambda s: '+7' + s,
+    'pretty': lambda s: f'+7 ({s[:3]}) {s[3:6]}-{s[6:8]}-{s[8:]}',
+    'eight': lambda s: '8' + s,
+    'eight_spaced': lambda s: f'8 {s[:3]} {s[3:6]} {s[6:8]} {s[8:]}',
+    'ten': lambda s: s,
+    'dashed': lambda s: f'7-{s[:3]}-{s[3:6]}-{s[6:]}',
+}
+
+
+def subscriber(rng: random.Random) -> str:
+    # Мобильные 9XX и городские/бесплатные 3XX, 4XX, 8XX
+    return rng.choice('99993488') + ''.join(rng.choice(string.digits) for _ in range(9))
+
+
+def garbage(rng: random.Random) -> str:
+    alphabet = string.digits * 3 + ' +-()./' + 'abcx' + '٣٤۵²'
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 16)))
+
+
+def is_canonical(value: str) -> bool:
+    return len(value) == 11 and value[0] == '7' and value.isdigit() and value.isascii()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='phones.py против прежних нормализаций телефона')
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=35)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    failures: List[str] = []
+    changed: Counter = Counter()
+
+    def fail(message: str) -> None:
+        if len(failures) < 20:
+            print(f'FAIL {message}')
+        failures.append(message)
+
+    for _ in range(args.count):
+        s = subscriber(rng)
+        canonical = '7' + s
+        for form_name, form in FORMS.items():
+            value = form(s)
+            if phones.normalize(value) != canonical:
+                fail(f'normalize({value!r}) = {phones.normalize(value)!r}, ожидалось {canonical!r}')
+            if phones.to_e164(value) != '+' + canonical or not phones.is_valid(value):
+                fail(f'to_e164/is_valid({value!r})')
+            for legacy_name, (legacy, replacement) in LEGACY.items():
+                before, after = legacy(value), replacement(value)
+                if before != after:
+                    changed[(legacy_name, form_name)] += 1
+                    if is_canonical(before.lstrip('+')):
+                        fail(f'{legacy_name}({value!r}) = {before!r} -> {after!r}')
+
+    for _ in range(args.count):
+        value = garbage(rng)
+        for legacy_name, (legacy, replacement) in LEGACY.items():
+            before, after = legacy(value), replacement(value)
+            if before != after and is_canonical(before.lstrip('+')):
+                fail(f'{legacy_name}({value!r}) = {before!r} -> {after!r}')
+
+    for _ in range(max(1, args.count // 100)):
+        batch = []
+        for _ in range(rng.randint(0, 300)):
+            kind = rng.random()
+            if kind < 0.6:
+                batch.append(rng.choice(list(FORMS.values()))(subscriber(rng)))
+            elif kind < 0.8 and batch:
+                batch.append(rng.choice(batch))
+            elif kind < 0.9:
+                batch.append('')
+            else:
+                batch.append(garbage(rng))
+        expected = list(dict.fromkeys(n for n in (phones.normalize(value) for value in batch) if n))
+        if phones.normalize_many(batch) != expected:
+            fail(f'normalize_many расходится с normalize на пачке из {len(batch)}')
+
+    digests = {hashlib.sha256(open(path, 'rb').read()).hexdigest() for path in glob.glob(os.path.join(BACKEND_DIR, '*', 'phones.py'))}
+    if len(digests) != 1:
+        fail(f'копии backend/*/phones.py различаются: {len(digests)} вариантов')
+
+    print(f'номеров: {args.count} x {len(FORMS)} записей, мусорных строк: {args.count}, пачек normalize_many: {max(1, args.count // 100)}')
+    print('Изменившийся результат (прежний был неканоническим, новый - 7XXXXXXXXXX):')
+    for (legacy_name, form_name), count in sorted(changed.items()):
+        print(f'  {legacy_name:<14}{form_name:<14}{count:>8}')
+    if failures:
+        raise SystemExit(f'нарушений: {len(failures)}')
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
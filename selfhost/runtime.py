@@ -0,0 +1,369 @@
+'''
+Собственное развёртывание: все функции из backend/ в одном WSGI-приложении.
+
+Каждая функция доступна по тому же пути, что и в func2url.json (/<uuid> - клиентам достаточно
+поменять хост), и по имени каталога (/<имя>). Внутри процесса функции делят:
+  - пул соединений Postgres: psycopg2.connect отдаёт соединение из пула, close() возвращает его;
+  - HTTP-сессию requests с keep-alive к AmoCRM/MegaCRM/SMS-шлюзам, а функциям с handler_async -
+    httpx-клиент и пул asyncpg из aio.py;
+  - общие модули-копии (phones, amocrm_metadata, host_cache, ...): одинаковые копии загружаются
+    один раз, поэтому их кеши в памяти общие для всех функций процесса;
+  - host_cache между процессами (HOST_CACHE_PATH, по умолчанию в /dev/shm).
+
+Запуск (число процессов и потоков - WORKERS и THREADS, см. gunicorn.conf.py):
+    pip install -r selfhost/requirements.txt
+    gunicorn -c selfhost/gunicorn.conf.py selfhost.runtime:app
+Без gunicorn, для отладки - один процесс:
+    python selfhost/runtime.py --port 8000
+Асинхронный вариант - функции с handler_async выполняются прямо в цикле сервера, остальные
+в пуле потоков; один процесс держит сотни запросов, ждущих CRM. Если handler_async отдаёт
+тело итератором строк (megagroup), ответ уходит частями:
+    uvicorn selfhost.runtime:asgi_app --host 0.0.0.0 --port 8000 --workers 4
+'''
+
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from types import ModuleType, SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlparse
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import requests
+import requests.api
+from requests.adapters import HTTPAdapter
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+HTTP_POOL_MAX = int(os.environ.get('HTTP_POOL_MAX', '20'))
+
+os.environ.setdefault('HOST_CACHE_PATH', '/dev/shm/mfo-host-cache.sqlite')
+
+
+class PooledConnection:
+    '''Соединение из пула: всё как у psycopg2, только close() сбрасывает сессию и возвращает его в пул'''
+
+    def __init__(self, pool: psycopg2.pool.ThreadedConnectionPool, conn) -> None:
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in ('_pool', '_conn'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            # Функции рассчитывают на чистое соединение: без транзакции, временных таблиц,
+            # advisory-блокировок сессии и read only от set_session
+            conn.rollback()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('DISCARD ALL')
+            conn.set_session(isolation_level='DEFAULT', readonly='DEFAULT', deferrable='DEFAULT', autocommit=False)
+            self._pool.putconn(conn)
+        except psycopg2.Error:
+            self._pool.putconn(conn, close=True)
+
+    @property
+    def closed(self) -> int:
+        return 1 if self._conn is None else self._conn.closed
+
+
+_pools: Dict[Tuple[Any, ...], psycopg2.pool.ThreadedConnectionPool] = {}
+_pools_lock = threading.Lock()
+_original_connect = psycopg2.connect
+
+
+def pooled_connect(dsn: Optional[str] = None, connection_factory=None, cursor_factory=None, **kwargs):
+    '''Замена psycopg2.connect: пул на DSN с параметрами и на процесс (после fork пулы не наследуются)'''
+    if dsn is None or connection_factory is not None:
+        return _original_connect(dsn, connection_factory=connection_factory, cursor_factory=cursor_factory, **kwargs)
+    key = (os.getpid(), dsn) + tuple(sorted(kwargs.items()))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # connection_factory - чтобы пул открывал соединения исходным connect, а не этой обёрткой
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                0, DB_POOL_MAX, dsn, connection_factory=psycopg2.extensions.connection, **kwargs
+            )
+            _pools[key] = pool
+    try:
+        conn = pool.getconn()
+    except psycopg2.pool.PoolError:
+        # Все соединения пула заняты - отдельное соединение, как без пула
+        return _original_connect(dsn, cursor_factory=cursor_factory, **kwargs)
+    conn.cursor_factory = cursor_factory
+    return PooledConnection(pool, conn)
+
+
+_sessions: Dict[int, requests.Session] = {}
+
+
+def shared_request(method: str, url: str, **kwargs) -> requests.Response:
+    '''Замена requests.api.request: одна сессия с keep-alive на процесс вместо новой на каждый вызов'''
+    session = _sessions.get(os.getpid())
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_MAX, pool_maxsize=HTTP_POOL_MAX)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _sessions[os.getpid()] = session
+    return session.request(method=method, url=url, **kwargs)
+
+
+def install_shared_resources() -> None:
+    psycopg2.connect = pooled_connect
+    requests.api.request = shared_request
+
+
+def _file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+_helpers: Dict[Tuple[str, str], ModuleType] = {}
+_import_lock = threading.Lock()
+
+
+def load_function(name: str) -> ModuleType:
+    '''Импортирует backend/<name>/index.py. Модули рядом с ним (phones.py и т.п.) с одинаковым
+    содержимым загружаются один раз на все функции; отличающаяся копия - своя у функции'''
+    directory = os.path.join(BACKEND_DIR, name)
+    local = {
+        filename[:-3]: _file_hash(os.path.join(directory, filename))
+        for filename in os.listdir(directory) if filename.endswith('.py') and filename != 'index.py'
+    }
+    with _import_lock:
+        previous = {module_name: sys.modules.pop(module_name, None) for module_name in local}
+        for module_name, digest in local.items():
+            if (module_name, digest) in _helpers:
+                sys.modules[module_name] = _helpers[(module_name, digest)]
+        sys.path.insert(0, directory)
+        try:
+            spec = importlib.util.spec_from_file_location(
+                f'selfhost_{name.replace("-", "_")}', os.path.join(directory, 'index.py')
+            )
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            # Впервые загруженные копии запоминаем для следующих функций
+            for module_name, digest in local.items():
+                if module_name in sys.modules:
+                    _helpers.setdefault((module_name, digest), sys.modules[module_name])
+        finally:
+            sys.path.remove(directory)
+            for module_name, module_before in previous.items():
+                if module_before is None:
+                    sys.modules.pop(module_name, None)
+                else:
+                    sys.modules[module_name] = module_before
+    return module
+
+
+def load_routes() -> Dict[str, Tuple[str, ModuleType]]:
+    '''Первый сегмент пути -> (имя функции, модуль index.py): uuid из func2url.json и имя каталога'''
+    with open(os.path.join(BACKEND_DIR, 'func2url.json')) as f:
+        func2url = json.load(f)
+    routes: Dict[str, Tuple[str, ModuleType]] = {}
+    for name in sorted(os.listdir(BACKEND_DIR)):
+        if not os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py')):
+            continue
+        module = load_function(name)
+        routes[name] = (name, module)
+        if name in func2url:
+            routes[urlparse(func2url[name]).path.strip('/')] = (name, module)
+    return routes
+
+
+def build_event(environ: Dict[str, Any], path: str) -> Dict[str, Any]:
+    headers = {
+        key[5:].replace('_', '-').title(): value
+        for key, value in environ.items() if key.startswith('HTTP_')
+    }
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    raw = environ['wsgi.input'].read(length) if length else b''
+    return make_event(environ.get('REQUEST_METHOD', 'GET'), path, headers, environ.get('QUERY_STRING', ''),
+                      raw, environ.get('REMOTE_ADDR'))
+
+
+def make_event(method: str, path: str, headers: Dict[str, str], query_string: str, raw: bytes,
+               source_ip: Optional[str]) -> Dict[str, Any]:
+    '''Событие в формате, который функции получают от платформы'''
+    try:
+        body, is_base64 = raw.decode('utf-8'), False
+    except UnicodeDecodeError:
+        body, is_base64 = base64.b64encode(raw).decode(), True
+    request_id = headers.get('X-Request-Id') or str(uuid.uuid4())
+    return {
+        'httpMethod': method,
+        'path': path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(query_string, keep_blank_values=True)),
+        'body': body,
+        'isBase64Encoded': is_base64,
+        'requestContext': {'requestId': request_id, 'identity': {'sourceIp': source_ip}}
+    }
+
+
+def make_context(name: str, event: Dict[str, Any]) -> SimpleNamespace:
+    return SimpleNamespace(
+        request_id=event['requestContext']['requestId'], function_name=name,
+        function_version='selfhost', memory_limit_in_mb=None
+    )
+
+
+def encode_result(result: Dict[str, Any], started: float) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    '''Ответ функции -> статус, заголовки и тело HTTP'''
+    status = int(result.get('statusCode', 200))
+    body = result.get('body') or ''
+    if result.get('isBase64Encoded'):
+        payload = base64.b64decode(body)
+    else:
+        payload = body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode('utf-8')
+    response_headers: List[Tuple[str, str]] = [(k, str(v)) for k, v in (result.get('headers') or {}).items()]
+    response_headers.append(('X-Function-Duration-Ms', str(int((time.monotonic() - started) * 1000))))
+    return status, response_headers, payload
+
+
+STATUS_TEXT = {200: 'OK', 201: 'Created', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request',
+               401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+               409: 'Conflict', 429: 'Too Many Requests', 500: 'Internal Server Error', 502: 'Bad Gateway',
+               503: 'Service Unavailable'}
+
+
+class Runtime:
+    def __init__(self) -> None:
+        install_shared_resources()
+        self.routes = load_routes()
+
+    def __call__(self, environ: Dict[str, Any], start_response) -> Iterable[bytes]:
+        segments = environ.get('PATH_INFO', '/').strip('/').split('/', 1)
+        route = self.routes.get(segments[0])
+        if route is None:
+            start_response('404 Not Found', [('Content-Type', 'application/json')])
+            return [b'{"error": "Function not found"}']
+
+        name, module = route
+        event = build_event(environ, '/' + (segments[1] if len(segments) > 1 else ''))
+        started = time.monotonic()
+        try:
+            result = module.handler(event, make_context(name, event))
+        except Exception as e:
+            print(f'[SELFHOST] {name} упала: {e!r}')
+            start_response('500 Internal Server Error', [('Content-Type', 'application/json')])
+            return [json.dumps({'error': 'Internal error'}).encode()]
+
+        status, response_headers, payload = encode_result(result, started)
+        start_response(f'{status} {STATUS_TEXT.get(status, "")}'.strip(), response_headers)
+        return [payload]
+
+
+class AsyncRuntime:
+    '''ASGI-приложение на тех же маршрутах: handler_async - в цикле сервера, handler - в потоке'''
+
+    def __init__(self, routes: Dict[str, Tuple[str, ModuleType]]) -> None:
+        self.routes = routes
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] != 'http':
+            return
+        segments = scope['path'].strip('/').split('/', 1)
+        route = self.routes.get(segments[0])
+        if route is None:
+            await self._send(send, 404, [('Content-Type', 'application/json')], b'{"error": "Function not found"}')
+            return
+
+        raw, more = b'', True
+        while more:
+            message = await receive()
+            raw += message.get('body', b'')
+            more = message.get('more_body', False)
+        headers = {key.decode('latin-1').title(): value.decode('latin-1') for key, value in scope['headers']}
+        event = make_event(scope['method'], '/' + (segments[1] if len(segments) > 1 else ''), headers,
+                           scope.get('query_string', b'').decode('latin-1'), raw, (scope.get('client') or [None])[0])
+
+        name, module = route
+        context = make_context(name, event)
+        started = time.monotonic()
+        try:
+            handler_async = getattr(module, 'handler_async', None)
+            if handler_async is not None:
+                result = await handler_async(event, context)
+            else:
+                result = await asyncio.to_thread(module.handler, event, context)
+        except Exception as e:
+            print(f'[SELFHOST] {name} упала: {e!r}')
+            await self._send(send, 500, [('Content-Type', 'application/json')], json.dumps({'error': 'Internal error'}).encode())
+            return
+        body = result.get('body')
+        if body is not None and not isinstance(body, (str, bytes, dict, list)):
+            # Итератор частей (megagroup): отдаём по мере сериализации, без сборки тела в памяти
+            status, response_headers, _ = encode_result({**result, 'body': ''}, started)
+            await self._send_stream(send, status, response_headers, body)
+            return
+        await self._send(send, *encode_result(result, started))
+
+    @staticmethod
+    async def _send(send: Callable, status: int, headers: List[Tuple[str, str]], payload: bytes) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+
+    @staticmethod
+    async def _send_stream(send: Callable, status: int, headers: List[Tuple[str, str]], chunks: Iterable[str]) -> None:
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers]
+        })
+        for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+app = Runtime()
+asgi_app = AsyncRuntime(app.routes)
+
+
+if __name__ == '__main__':
+    import argparse
+    from wsgiref.simple_server import make_server, WSGIServer
+    from socketserver import ThreadingMixIn
+
+    parser = argparse.ArgumentParser(description='Все функции backend/ в одном процессе (для отладки)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    print(f'[SELFHOST] {len(app.routes)} маршрутов, http://{args.host}:{args.port}')
+    make_server(args.host, args.port, app, server_class=ThreadingWSGIServer).serve_forever()
@@ -18,7 +18,6 @@ const LoginPage = ({ onLogin }: LoginPageProps) => {
   const [error, setError] = useState('');
   const [step, setStep] = useState<'phone' | 'code'>('phone');
   const [smsInfo, setSmsInfo] = useState<string>('');
-  const [storedCode, setStoredCode] = useState<string>('');
   const [clientName, setClientName] = useState<string>('');
 
   const formatPhone = (value: string) => {
@@ -62,13 +61,8 @@ const LoginPage = ({ onLogin }: LoginPageProps) => {
 
       if (response.ok && data.success) {
         setStep('code');
-        setStoredCode(data.code || '');
         setClientName(data.client_name || '');
-        if (data.code) {
-          setSmsInfo(`Код для входа: ${data.code}`);
-        } else {
-          setSmsInfo('Код отправлен на ваш телефон');
-        }
+        setSmsInfo('Код отправлен на ваш телефон');
       } else {
         if (response.status === 404 || data.not_found) {
           setError('Клиент с таким номером не найден в системе');
@@ -99,7 +93,7 @@ const LoginPage = ({ onLogin }: LoginPageProps) => {
       const response = await fetch('https://functions.poehali.dev/291aa98a-124e-4714-8e23-ab5309099dea', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ action: 'verify', phone: digits, code, stored_code: storedCode, client_name: clientName })
+        body: JSON.stringify({ action: 'verify', phone: digits, code })
       });
 
       const data = await response.json();
@@ -1,4 +1,4 @@
-import { useState } from 'react';
+import { useRef, useState } from 'react';
 import { Button } from '@/components/ui/button';
 import { Label } from '@/components/ui/label';
 import { Slider } from '@/components/ui/slider';
@@ -17,16 +17,23 @@ const NewApplicationDialog = ({ clientPhone, onApplicationSubmit, canSubmitNewAp
   const [amount, setAmount] = useState(50000);
   const [termDays, setTermDays] = useState(30);
   const [submitting, setSubmitting] = useState(false);
+  // Один ключ на заявку: повторная отправка после таймаута не создаст дубль сделки
+  const idempotencyRef = useRef<{ key: string; amount: number; termDays: number } | null>(null);
 
   const interestRate = 1.0;
   const totalReturn = amount + (amount * (interestRate / 100) * termDays);
 
   const handleSubmitApplication = async () => {
     setSubmitting(true);
+    let pending = idempotencyRef.current;
+    if (!pending || pending.amount !== amount || pending.termDays !== termDays) {
+      pending = { key: crypto.randomUUID(), amount, termDays };
+      idempotencyRef.current = pending;
+    }
     try {
       const response = await fetch('https://functions.poehali.dev/19b4b253-3352-4332-810a-30d128021b66', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': pending.key },
         body: JSON.stringify({
           phone: clientPhone,
           amount: amount,
@@ -41,6 +48,7 @@ const NewApplicationDialog = ({ clientPhone, onApplicationSubmit, canSubmitNewAp
         throw new Error(data.message || 'Ошибка отправки');
       }
 
+      idempotencyRef.current = null;
       toast.success('Заявка успешно создана!');
       setIsDialogOpen(false);
       setAmount(50000);